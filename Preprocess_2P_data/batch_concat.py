@@ -22,8 +22,13 @@ import logging
 import xml.etree.ElementTree as ET 
 
 from src import helper_functions as hf
+from src import discovery
+from src import concat_engine
+from src import frame_index
+from src import movie_store
+from src.manifest import Manifest, fingerprint, now
 
-def process_dir(input_dir):
+def process_dir(input_dir, use_manifest=True, max_workers=4, compression=None, store='tiff'):
     '''
     input_dir should be a parent directory with a subdirectory for each imaging session 
     ie there is one level of nesting from input_dir to imaging session folder
@@ -31,169 +36,171 @@ def process_dir(input_dir):
     
     it will need to be expanded to handle TZ Series, but I need to look
     into the ordering and naming of files to do this
+
+    use_manifest: record each concat in the pipeline manifest at input_dir and skip
+    sessions whose concat already ran and whose inputs/outputs did not change
+    max_workers: number of (plane, channel) stacks of a TZSeries written in parallel
+    compression: None (uncompressed BigTIFF), 'zlib' (deflate, Fiji readable) or 'zstd',
+        see concat_engine.concat_to_bigtiff. selectable per run
+    store: 'tiff' (BigTIFF stacks) or 'zarr' (chunked movie store read with
+        movie_store.open_movie, see src/movie_store.py)
     '''
     # Set up logging for each directory
     logfile = os.path.join(input_dir, 'logfile.txt')
     logging.basicConfig(filename=logfile, level=logging.INFO)
-    for root, dirs, files in os.walk(input_dir):
-        for dir in dirs:
-            directory = os.path.join(root,dir)            
-            logging.info(f"Processing: {directory}") #record to log
-            print(f"Processing: {directory}") #print to console
-            seq_type = hf.get_sequence_type(directory)
-            if seq_type is not None:#sometimes there is no metadata
-                #select ONLY TSeries for batch concat by the process_folder() function
-                if "TSeries" in seq_type and "ZSeries" not in seq_type:
-                    start_time = time.time()
-                    batch_concat_TSeries(directory)
-                    elapsed_time = time.time() - start_time
-                    print(f"batch_concat_TSeries({directory}) took {elapsed_time} seconds to run.")
-                if "ZSeries" in seq_type and "TSeries" not in seq_type:
-                    start_time = time.time()
-                    batch_concat_ZSeries(directory)
-                    elapsed_time = time.time() - start_time
-                    print(f"batch_concat_ZSeries({directory}) took {elapsed_time} seconds to run.")
-                if "TSeries" in seq_type and "ZSeries" in seq_type:
-                    start_time = time.time()
-                    batch_concat_TZSeries(directory)
-                    elapsed_time = time.time() - start_time
-                    print(f"batch_concat_TZSeries({directory}) took {elapsed_time} seconds to run.")
+    manifest = Manifest(input_dir) if use_manifest else None
+    #one scandir pass over the whole tree, each session comes with its files already classified
+    for session in discovery.discover_sessions(input_dir):
+        directory = session.directory
+        seq_type = session.sequence_type
+        if seq_type is None:#sometimes there is no metadata
+            continue
+        #raw frames are deleted by the concat, once they are gone only the outputs are checked
+        inputs = session.raw_tifs
+        if manifest is not None and manifest.is_current(directory, 'batch_concat', inputs):
+            print(f"Skipping (unchanged since last concat): {directory}")
+            continue
+        logging.info(f"Processing: {directory}") #record to log
+        print(f"Processing: {directory}") #print to console
+        started = now()
+        input_fp = fingerprint(inputs, manifest.content) if manifest is not None else None
+        #select ONLY TSeries for batch concat by the process_folder() function
+        if "TSeries" in seq_type and "ZSeries" not in seq_type:
+            start_time = time.time()
+            batch_concat_TSeries(directory, session.raw_tifs, compression, store)
+            elapsed_time = time.time() - start_time
+            print(f"batch_concat_TSeries({directory}) took {elapsed_time} seconds to run.")
+        if "ZSeries" in seq_type and "TSeries" not in seq_type:
+            start_time = time.time()
+            batch_concat_ZSeries(directory, session.raw_tifs, compression, store)
+            elapsed_time = time.time() - start_time
+            print(f"batch_concat_ZSeries({directory}) took {elapsed_time} seconds to run.")
+        if "TSeries" in seq_type and "ZSeries" in seq_type:
+            start_time = time.time()
+            batch_concat_TZSeries(directory, session.raw_tifs, max_workers, compression=compression, store=store)
+            elapsed_time = time.time() - start_time
+            print(f"batch_concat_TZSeries({directory}) took {elapsed_time} seconds to run.")
+        if manifest is not None:
+            outputs = get_concat_outputs(directory)
+            #no output stacks means nothing was concatenated, leave it to be checked again next run
+            manifest.record(directory, 'batch_concat', inputs, outputs, started,
+                            status='done' if outputs else 'no_output', input_fp=input_fp)
     return
 
-def batch_concat_TSeries(directory):
+def get_concat_outputs(directory):
+    #concatenated stacks written by the batch_concat_* functions ({dir_name}-Ch1.tif, {dir_name}-{ID}-Ch2.tif)
+    #and the arrays of the zarr movie store ({dir_name}.zarr/Ch2, {dir_name}.zarr/{ID}/Ch2)
+    dir_name = os.path.basename(directory)
+    tifs = glob.glob(os.path.join(glob.escape(directory), f"{glob.escape(dir_name)}*-Ch[12].tif"))
+    zarr_root = glob.escape(movie_store.store_path(directory))
+    arrays = glob.glob(os.path.join(zarr_root, 'Ch[12]')) + glob.glob(os.path.join(zarr_root, '*', 'Ch[12]'))
+    return sorted(tifs + arrays)
+
+def check_frames(directory, index):
+    '''
+    checks the raw frame files against the xml frame table (missing / duplicate /
+    unexpected frames) before anything is concatenated or deleted.
+    returns True if the session is complete, otherwise logs the problem and returns False
+    '''
+    problems = index.validate(hf.get_session_metadata(directory))
+    msg = frame_index.report_problems(problems)
+    if msg is None:
+        return True
+    logging.warning(f"{msg} in {directory}, nothing concatenated or deleted")
+    print(f"{msg} in {directory}, nothing concatenated or deleted")
+    return False
+
+def batch_concat_TSeries(directory, file_list=None, compression=None, store='tiff'):
     '''
     directory: should be the folder containing all individual tifs from a single imaging session
+    compression: None, 'zlib' or 'zstd' (lossless compressed tiled output, see src/concat_engine.py)
+    store: 'tiff' or 'zarr' (chunked movie store, see src/movie_store.py)
     '''
     dir_name = os.path.basename(directory)
     #list all tiff files with 6 digit identifier '######.ome.tif' -> this allows for specificity of which tif files are selected, concatenated and deleted. 
-    file_list = glob.glob(os.path.join(directory, '*[0-9][0-9][0-9][0-9][0-9][0-9].ome.tif')) 
+    #file_list can be passed in from discovery.Session.raw_tifs to skip the glob
+    if file_list is None:
+        file_list = glob.glob(os.path.join(directory, '*[0-9][0-9][0-9][0-9][0-9][0-9].ome.tif')) 
     n = len(file_list)  # Record number of tifs
     print("number of files: " + str(n))
-    ch1_files = [f for f in file_list if 'Ch1' in f] #get list of ch1 files
-    ch2_files = [f for f in file_list if 'Ch2' in f] #get list of ch2 files
+    #parse cycle / channel / frame index from every file name once, files come out in frame order
+    index = frame_index.FrameIndex(file_list)
     #this is used to select for if concat has  run or not. I should update this! #could also use the logfile maybe to see if concat was run on this data
     if n > 10: #if there are more than 10 tif files in the directory 
-        # Run for Ch1...
-        if len(ch1_files) > 1:  
-            ch1_files.sort() #check ordering of ch1_files.sort() output
-            with tifffile.TiffWriter(os.path.join(directory, f"{dir_name}-Ch1.tif"), bigtiff=True) as tif:
-                for x in ch1_files:
-                    tif.save(tifffile.imread(x, is_ome=False))
-                    logging.info(f"Saved {os.path.join(directory, f'/{dir_name}-Ch1.tif')}") 
-            print(f"Saved {os.path.join(directory, f'/{dir_name}-Ch1.tif')}")
-        else:
-            logging.info("No Channel 1 files.")
-        # Run for Ch2...
-        if len(ch2_files) > 1:  
-            ch2_files.sort()
-            with tifffile.TiffWriter(os.path.join(directory, f"{dir_name}-Ch2.tif"), bigtiff=True) as tif:
-                for x in ch2_files:
-                    tif.save(tifffile.imread(x, is_ome=False))
-                    logging.info(f"Saved {os.path.join(directory, f'/{dir_name}-Ch2.tif')}") 
-            print(f"Saved {os.path.join(directory, f'/{dir_name}-Ch2.tif')}")
-        else:
-            logging.info("No Channel 2 files.")
+        if not check_frames(directory, index):
+            return
+        #each channel is streamed into a preallocated BigTIFF (see src/concat_engine.py)
+        concat_engine.write_stacks(directory, [
+            (f"{dir_name}-Ch1.tif", index.files(1), "Channel 1"),
+            (f"{dir_name}-Ch2.tif", index.files(2), "Channel 2"),
+            ], compression=compression, store=store)
         # Delete individual tif files
-        for file in file_list:
-            logging.info(f"Deleting {file}")
-            os.remove(file)
+        concat_engine.delete_frames(file_list)
     else:
         logging.info(f"Not enough images to concatenate in {directory}")
     return
   
-def batch_concat_ZSeries(directory):        
+def batch_concat_ZSeries(directory, file_list=None, compression=None, store='tiff'):        
     '''
     batch_concat_ZSeries function is exactly the same as batch_concat_TSeries rn
     but will be maintained as a seperate function in case there are different  
     batch concat processes to be selectively apply to TSeries or ZSeries
     '''
-    dir_name = os.path.basename(directory)
-    #list all tiff files with 6 digit identifier '######.ome.tif' -> this allows for specificity of which tif files are selected, concatenated and deleted. 
-    file_list = glob.glob(os.path.join(directory, '*[0-9][0-9][0-9][0-9][0-9][0-9].ome.tif')) 
-    n = len(file_list)  # Record number of tifs
-    print("number of files: " + str(n))
-    ch1_files = [f for f in file_list if 'Ch1' in f] #get list of ch1 files
-    ch2_files = [f for f in file_list if 'Ch2' in f] #get list of ch2 files
-    #this is used to select for if concat has  run or not. I should update this! #could also use the logfile maybe to see if concat was run on this data
-    if n > 10: #if there are more than 10 tif files in the directory 
-        # Run for Ch1...
-        if len(ch1_files) > 1:  
-            ch1_files.sort() #check ordering of ch1_files.sort() output
-            with tifffile.TiffWriter(os.path.join(directory, f"{dir_name}-Ch1.tif"), bigtiff=True) as tif:
-                for x in ch1_files:
-                    tif.save(tifffile.imread(x, is_ome=False))
-                    logging.info(f"Saved {os.path.join(directory, f'/{dir_name}-Ch1.tif')}") 
-            print(f"Saved {os.path.join(directory, f'/{dir_name}-Ch1.tif')}")
-        else:
-            logging.info("No Channel 1 files.")
-        # Run for Ch2...
-        if len(ch2_files) > 1:  
-            ch2_files.sort()
-            with tifffile.TiffWriter(os.path.join(directory, f"{dir_name}-Ch2.tif"), bigtiff=True) as tif:
-                for x in ch2_files:
-                    tif.save(tifffile.imread(x, is_ome=False))
-                    logging.info(f"Saved {os.path.join(directory, f'/{dir_name}-Ch2.tif')}") 
-            print(f"Saved {os.path.join(directory, f'/{dir_name}-Ch2.tif')}")
-        else:
-            logging.info("No Channel 2 files.")
-        # Delete individual tif files
-        for file in file_list:
-            logging.info(f"Deleting {file}")
-            os.remove(file)
-    else:
-        logging.info(f"Not enough images to concatenate in {directory}")
-    return
+    return batch_concat_TSeries(directory, file_list, compression, store)
 
-def batch_concat_TZSeries(directory):
+def batch_concat_TZSeries(directory, file_list=None, max_workers=4, use_processes=False, compression=None,
+                          store='tiff'):
     '''
     directory: should be the folder containing all individual tifs from a single imaging session
     this code assumes all the information included in file name is incldued in the directory. 
     this is the default from Bruker unless you rename your directories independently
     if you ever lose filename info , it should always exist in the metadata! 
+    max_workers: limit on the number of (plane, channel) stacks written at the same time
+        (set to 1 for the old serial behavior). use_processes: process pool instead of threads,
+        the calling script's own calls must be behind if __name__ == '__main__' (spawned workers re-import it)
+    compression: None, 'zlib' or 'zstd' (lossless compressed tiled output, see src/concat_engine.py)
+    store: 'tiff' or 'zarr' (chunked movie store, see src/movie_store.py)
     '''
     #list all tiff files with 6 digit identifier '######.ome.tif' -> this allows for specificity of which tif files are selected, concatenated and deleted. 
-    file_list = glob.glob(os.path.join(directory, '*[0-9][0-9][0-9][0-9][0-9][0-9].ome.tif')) 
+    #file_list can be passed in from discovery.Session.raw_tifs to skip the glob
+    if file_list is None:
+        file_list = glob.glob(os.path.join(directory, '*[0-9][0-9][0-9][0-9][0-9][0-9].ome.tif')) 
     n = len(file_list)  # Record number of tifs
     print("number of files: " + str(n))
     max_Z_index = hf.get_max_Z_index(directory)
     dir_name = os.path.basename(directory)
-    ch1_files = [f for f in file_list if 'Ch1' in f] #get list of ch1 files
-    ch2_files = [f for f in file_list if 'Ch2' in f] #get list of ch2 files
+    #parse cycle / channel / z plane from every file name once
+    index = frame_index.FrameIndex(file_list)
     if n > 10: #if there are more than 10 tif files in the directory
+        if not check_frames(directory, index):
+            return
+        stacks = []
         for i in range(1,max_Z_index+1): #iterate through each ID (specific to z plane)
             ID = str(i).zfill(6) 
-            if len(ch1_files) > 1: 
-                ch1_split_by_ID = [f for f in ch1_files if ID in f] #get all files at z plane specified by 6 digit ID
-                ch1_split_by_ID.sort() #makes sure the images are in order (this will order by cycle no.)
-                with tifffile.TiffWriter(os.path.join(directory, f"{dir_name}-{ID}-Ch1.tif"), bigtiff=True) as tif:
-                    for x in ch1_split_by_ID:
-                        tif.save(tifffile.imread(x,is_ome=False))
-                        logging.info(f"Saved {os.path.join(directory, f'/{dir_name}-{ID}-Ch1.tif')}") 
-                print(f"Saved {os.path.join(directory, f'/{dir_name}-{ID}-Ch1.tif')}")
+            #all files at z plane i, ordered by cycle no.
+            if len(index.files(1)) > 1: 
+                stacks.append((f"{dir_name}-{ID}-Ch1.tif", index.files(1, i), "Channel 1"))
             else:
                 logging.info("No Channel 1 files.")
-            if len(ch2_files) > 1: 
-                ch2_split_by_ID = [f for f in ch2_files if ID in f]
-                ch2_split_by_ID.sort()
-                with tifffile.TiffWriter(os.path.join(directory, f"{dir_name}-{ID}-Ch2.tif"), bigtiff=True) as tif:
-                    for x in ch2_split_by_ID:
-                        tif.save(tifffile.imread(x,is_ome=False))
-                        logging.info(f"Saved {os.path.join(directory, f'/{dir_name}-{ID}-Ch2.tif')}") 
-                print(f"Saved {os.path.join(directory, f'/{dir_name}-{ID}-Ch2.tif')}")
+            if len(index.files(2)) > 1: 
+                stacks.append((f"{dir_name}-{ID}-Ch2.tif", index.files(2, i), "Channel 2"))
             else:
                 logging.info("No Channel 2 files.")
+        concat_engine.write_stacks(directory, stacks, min_frames=1, max_workers=max_workers, use_processes=use_processes,
+                                   compression=compression, store=store)
         # Delete individual tif files
-        for file in file_list:
-            logging.info(f"Deleting {file}")
-            os.remove(file)
+        concat_engine.delete_frames(file_list)
     else:
         logging.info(f"Not enough images to concatenate in {directory}")   
     return       
   
     
 #CALL FUNCTIONS BELOW 
-input_dir = '/Volumes/T7/First_Pilot_Data/S15742_gregg'
-process_dir(input_dir)
+#guarded: with use_processes=True the stack writers are spawned processes (macOS default)
+#that re-import this file, and must not run process_dir again
+if __name__ == '__main__':
+    input_dir = '/Volumes/T7/First_Pilot_Data/S15742_gregg'
+    process_dir(input_dir)
 
 
 '''
@@ -15,15 +15,17 @@ batch preprocessing.
 
 import os
 import re
+import glob
 import logging
 import time
 import subprocess
 
 from src import helper_functions as hf
-
-#CHECK STATUS OF MOTION CORRECTION BEFORE RUNNING BATCH
-#uncomment call to batch_motion_correction, when ready.
-results = hf.record_motion_correct_status('/Volumes/T7/Motor_Spines_Pilot_Data/289N')
+from src import discovery
+from src import registration
+from src import motion_qc
+from src.fiji_pool import FijiPool
+from src.manifest import Manifest, now
 
 # Replace this with the path you got from `/usr/libexec/java_home -v 21`
 java_home_path = "/Library/Java/JavaVirtualMachines/jdk-21.jdk/Contents/Home"
@@ -57,21 +59,31 @@ def motion_correct_TSeries(fiji_path, macro_path, file_path):
     return
 
 ###TEST ALL ABOVE BEFORE INTEGRATING BATCH
-def batch_motion_correction(input_dir, fiji_path, macro_path):
+def batch_motion_correction(input_dir, fiji_path, macro_path, use_manifest=True, engine='python',
+                            ref_slice=10, subpixel=False, fiji_workers=2, fiji_memory='13500m', fiji_timeout=3600,
+                            fiji_headless=False):
     '''
     checks for TSeries type, tiff file pattern, and that stab 1.csv, stab 2.csv, dont already exist
     before making command line call to motion_correct_single_TSeries.ijm macro
-    UPGRADE: once the TZSeries motion correction macro is updated for double pass and batch processing
-    include a call to this macro under the TZSeries condition. 
+    TZSeries are corrected plane by plane with registration.motion_correct_TZSeries (python engine),
+    which also writes the motion corrected mean Z stack (MoCorr_mean/mo_corr_mean_ZStack.tif)
+    use_manifest: record each run in the pipeline manifest at input_dir, a session is
+    corrected again if its stack changed since the stab csvs were written
+    engine: 'python' registers in python (src/registration.py, same two passes and stab csvs
+    as the macro, no Fiji needed), 'fiji' runs macro_path per stack on a pool of
+    persistent Fiji workers (src/fiji_pool.py)
+    ref_slice, subpixel: python engine only, see registration.register_movie
+    fiji_workers, fiji_memory, fiji_timeout: fiji engine only, number of Fiji processes,
+    heap of each (set at launch, no set_memory_and_quit.ijm restart), seconds per stack
+    fiji_headless: start the Fiji workers with --headless. False by default, like the single
+    motion_correct_TSeries call: motion_correct_single_TSeries.ijm uses the ROI Manager and
+    Align slices, which need the GUI
     '''
-    ###THIS NEEDS TO BE RUN ONCE AT START OF BATCH PROCESS. 
-    # Path to the macro file #13.5GB
-    macro_setMemory = "/Volumes/T7/Analysis_code/macros/set_memory_and_quit.ijm"
-    #Construct the command
-    cmd = [fiji_path, '--headless', '-macro', macro_setMemory]
-    # Run the command as a subprocess
-    subprocess.run(cmd)
-    ###END
+    pool = None
+    pending = [] #fiji jobs, recorded in the manifest once they finish
+    if engine == 'fiji':
+        pool = FijiPool(fiji_path, n_workers=fiji_workers, memory=fiji_memory, timeout=fiji_timeout,
+                        headless=fiji_headless)
     
     # Regular expression pattern to match specific file format
         #selection criteria could be more extensive
@@ -80,43 +92,99 @@ def batch_motion_correction(input_dir, fiji_path, macro_path):
     # Set up logging for each directory
     logfile = os.path.join(input_dir, 'logfile.txt')
     logging.basicConfig(filename=logfile, level=logging.INFO)
-    for root, dirs, files in os.walk(input_dir):
-        for dir in dirs:
-            #update this bc you are looking for file tiff list, and just need directory of tiff to save respective results
-            #file_list = glob.glob(os.path.join(directory, '*[0-9][0-9][0-9][0-9][0-9][0-9].ome.tif')) 
-            directory = os.path.join(root,dir)            
-            logging.info(f"Processing: {directory}") #record to log
-            print(f"Processing: {directory}") #print to console
-            seq_type = hf.get_sequence_type(directory)
-            if seq_type is not None:#sometimes there is no metadata
-                if "TSeries" in seq_type and "ZSeries" not in seq_type:
-                    file1_exists, file2_exists, both_exist = hf.check_double_motion_correct(directory)
-                    if both_exist == False:
-                        tiff_files = [f for f in os.listdir(directory) if re.match(patterns, f)] 
-                        if len(tiff_files) == 1:
-                            file_path = os.path.join(directory, tiff_files[0])
-                            print("conditions met: "+file_path)
-                            start_time = time.time() 
-                            #comment out below to check file processing. 
-                            motion_correct_TSeries(fiji_path, macro_path, file_path)
+    manifest = Manifest(input_dir) if use_manifest else None
+    #one scandir pass over the tree, each session comes with its files already classified
+    for session in discovery.imaging_sessions(input_dir):
+        directory = session.directory
+        logging.info(f"Processing: {directory}") #record to log
+        print(f"Processing: {directory}") #print to console
+        seq_type = session.sequence_type
+        if seq_type is not None:#sometimes there is no metadata
+            if "TSeries" in seq_type and "ZSeries" not in seq_type:
+                file1_exists, file2_exists, both_exist = session.double_motion_corrected
+                tiff_files = [os.path.basename(f) for f in session.raw_tifs + session.tif_stacks]
+                tiff_files = [f for f in tiff_files if re.match(patterns, f)] 
+                if manifest is not None and len(tiff_files) == 1:
+                    inputs = [os.path.join(directory, tiff_files[0])]
+                    if manifest.get(directory, 'motion_correction') is None and both_exist:
+                        #corrected before the manifest existed, adopt the existing stab csvs
+                        manifest.record(directory, 'motion_correction', inputs, session.stab1_csvs + session.stab2_csvs)
+                    #rerun if the stack changed (or stab csvs were removed) since the last correction
+                    both_exist = manifest.is_current(directory, 'motion_correction', inputs)
+                if both_exist == False:
+                    if len(tiff_files) == 1:
+                        file_path = os.path.join(directory, tiff_files[0])
+                        print("conditions met: "+file_path)
+                        started = now()
+                        start_time = time.time() 
+                        #comment out below to check file processing. 
+                        if engine == 'fiji':
+                            #queued, the Fiji workers run several sessions at once
+                            pending.append((directory, file_path, started,
+                                            pool.submit(macro_path, file_path, session_dir=directory)))
+                        else:
+                            registration.motion_correct_TSeries(file_path, ref_slice, subpixel)
                             elapsed_time = time.time() - start_time
                             print(f"motion_correction_TSeries({directory}) took {elapsed_time} seconds to run.")
-                if "ZSeries" in seq_type and "TSeries" not in seq_type:
-                    print(f"ZSeries ({directory}) do not need to be motion corrected")
-                if "TSeries" in seq_type and "ZSeries" in seq_type:
-                    file1_exists, file2_exists, both_exist = hf.check_double_motion_correct(directory)
+                            record_motion_correction(manifest, directory, [file_path], started)
+            if "ZSeries" in seq_type and "TSeries" not in seq_type:
+                print(f"ZSeries ({directory}) do not need to be motion corrected")
+            if "TSeries" in seq_type and "ZSeries" in seq_type:
+                file1_exists, file2_exists, both_exist = session.double_motion_corrected
+                if engine == 'fiji':
                     if both_exist == False:
-                        #start_time = time.time()
-                        #motion_correct_TZSeries(directory)
-                        #elapsed_time = time.time() - start_time
+                        #mo_corr_TZ_to_Zstack.ijm needs a hand drawn roi
                         print("TZSeries skip")
-                        #print(f"motion_correction_TZSeries({directory}) took {elapsed_time} seconds to run.")
+                else:
+                    #per plane Ch2 stacks from batch_concat_TZSeries, or the raw frames if not concatenated
+                    inputs = [f for f in session.tif_stacks if re.search(r'-\d{6}-Ch2\.tif$', f)] or session.channel_files('Ch2')
+                    if manifest is not None:
+                        done = manifest.is_current(directory, 'motion_correction', inputs)
+                    else:
+                        done = os.path.exists(os.path.join(directory, 'MoCorr_mean', 'mo_corr_mean_ZStack.tif'))
+                    if not done:
+                        started = now()
+                        start_time = time.time()
+                        outputs = registration.motion_correct_TZSeries(directory)
+                        elapsed_time = time.time() - start_time
+                        print(f"motion_correction_TZSeries({directory}) took {elapsed_time} seconds to run.")
+                        record_motion_correction(manifest, directory, inputs, started, outputs=outputs)
+    for directory, file_path, started, job in pending:
+        result = job.result()
+        print(f"motion_correction_TSeries({directory}): {result.status} after {result.elapsed} seconds ({result.attempts} attempts).")
+        record_motion_correction(manifest, directory, [file_path], started, result.status)
+    if pool is not None:
+        pool.close()
     return
 
-fiji_path = "/Applications/Fiji.app/Contents/MacOS/ImageJ-macosx"
-macro_path = '/Volumes/T7/Analysis_code/macros/motion_correct_single_TSeries.ijm'
-input_dir = '/Volumes/T7/First_Pilot_Data/S15742_gregg/230928'
-#batch_motion_correction(input_dir, fiji_path, macro_path)
+def record_motion_correction(manifest, directory, inputs, started, status='done', outputs=None):
+    '''
+    manifest entry of a finished correction, 'failed' unless at least two outputs were
+    written. outputs default to the stab csvs of the session (TSeries)
+    '''
+    if manifest is None:
+        return
+    if outputs is None:
+        outputs = glob.glob(os.path.join(glob.escape(directory), '*stab [12]*.csv'))
+    manifest.record(directory, 'motion_correction', inputs, outputs, started,
+                    status='done' if (status == 'done' and len(outputs) >= 2) else 'failed')
+    #qc from the python engine: 'flagged' if the session crossed a motion_qc.QC_THRESHOLDS limit
+    qc = motion_qc.read_qc_summary(directory)
+    if qc is not None:
+        manifest.record(directory, 'motion_qc', [], [os.path.join(directory, motion_qc.QC_SUMMARY_NAME)],
+                        started, status='flagged' if qc['qc_flags'] else 'done')
+
+#script calls are guarded: motion_correct_TZSeries registers the planes in a process pool,
+#and with spawn (the macOS default) every worker re-imports this file as a module
+if __name__ == '__main__':
+    #CHECK STATUS OF MOTION CORRECTION BEFORE RUNNING BATCH
+    #uncomment call to batch_motion_correction, when ready.
+    results = hf.record_motion_correct_status('/Volumes/T7/Motor_Spines_Pilot_Data/289N')
+
+    fiji_path = "/Applications/Fiji.app/Contents/MacOS/ImageJ-macosx"
+    macro_path = '/Volumes/T7/Analysis_code/macros/motion_correct_single_TSeries.ijm'
+    input_dir = '/Volumes/T7/First_Pilot_Data/S15742_gregg/230928'
+    #batch_motion_correction(input_dir, fiji_path, macro_path)
 
 
 '''###MEM CAP NEEDS TO BE RUN ONCE AT START OF BATCH PROCESS. 
@@ -12,9 +12,13 @@ import numpy as np
 import pandas as pd
 import read_roi
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 #from read_roi import read_roi_file
 from read_roi import read_roi_zip
 from src import helper_functions as hf
+from src import discovery
+from src import spine_matching
+from src.roi_catalog import ID_COLUMNS, save_roi_catalog, load_roi_catalog
 
 def get_roi_zip_path(directory):
     '''
@@ -41,10 +45,8 @@ def get_roi_zip_path(directory):
     roi_zip_path = roi_zip_files[0]
     return roi_zip_path
 
-def get_roi_sess(directory):
-    roi_zip_path = get_roi_zip_path(directory)
-    if roi_zip_path is None:
-        return None
+def _read_rois(roi_zip_path):
+    #RoiSet.zip -> one row per ROI, None if it can not be read
     try:
         rois = read_roi_zip(roi_zip_path)
     except zipfile.BadZipFile:
@@ -53,15 +55,9 @@ def get_roi_sess(directory):
     except Exception as e:
         print(f"An error occurred while processing {roi_zip_path}: {e}")
         return None
-    ROIs = pd.DataFrame.from_dict(rois, orient='index')
-    #get microns per pixel from metadata
-    microns_per_pixel = hf.get_microns_per_pixel(directory)
-    #add scaled area as column to df #scaling_factor = microns_per_pixel**2
-    #i hope microns x,y in the metadata updates based on objective AND optical zoom!!
-    if microns_per_pixel is not None:
-        ROIs['area (u^2)'] = np.pi * (ROIs['width'] / 2) * (ROIs['height'] / 2) * (microns_per_pixel**2)
-    else:
-        ROIs['area (u^2)'] = None
+    return pd.DataFrame.from_dict(rois, orient='index')
+
+def _add_identifiers(ROIs, directory, date):
     ROIs['directory'] = directory
     #get cell id and dend id
     match = re.search(r'(?i)_cell(\d+)_dend(\d+)_', directory)
@@ -73,7 +69,7 @@ def get_roi_sess(directory):
         dend_id = None
     ROIs['cell'] = cell_id
     ROIs['dend'] = dend_id
-    ROIs['date'] = hf.get_imaging_date(directory)
+    ROIs['date'] = date
     # Search for the pattern in the directory string
     match_id = re.search(r'\/(\d{3}[A-Za-z])\/', directory)
     # Extract and return the animal ID if found
@@ -84,16 +80,67 @@ def get_roi_sess(directory):
     ROIs['animal'] = animal_id
     return ROIs
 
-def pool_roi_info(input_dir):
-    data = pd.DataFrame()
-    for root, dirs, files in os.walk(input_dir):
-        for dir in dirs:
-            directory = os.path.join(root, dir)
-            ROIs = get_roi_sess(directory)
-            if ROIs is not None:
-                data = pd.concat([data, ROIs], ignore_index=True)
+def ellipse_area(width, height, microns_per_pixel):
+    #area in u^2 of the ROI bounding ellipses, vectorized over columns; NaN without a pixel size
+    microns_per_pixel = pd.to_numeric(microns_per_pixel, errors='coerce')
+    return np.pi * (pd.to_numeric(width, errors='coerce') / 2) * (pd.to_numeric(height, errors='coerce') / 2) * (microns_per_pixel**2)
+
+def get_roi_sess(directory, roi_zip_path=None):
+    #roi_zip_path can be passed in from discovery.Session.roi_zip to skip the glob
+    if roi_zip_path is None:
+        roi_zip_path = get_roi_zip_path(directory)
+    if roi_zip_path is None:
+        return None
+    ROIs = _read_rois(roi_zip_path)
+    if ROIs is None:
+        return None
+    #get microns per pixel from metadata
+    microns_per_pixel = hf.get_microns_per_pixel(directory)
+    #add scaled area as column to df #scaling_factor = microns_per_pixel**2
+    #i hope microns x,y in the metadata updates based on objective AND optical zoom!!
+    if microns_per_pixel is not None:
+        ROIs['area (u^2)'] = ellipse_area(ROIs['width'], ROIs['height'], microns_per_pixel)
+    else:
+        ROIs['area (u^2)'] = None
+    return _add_identifiers(ROIs, directory, hf.get_imaging_date(directory))
+
+def _session_rois(session):
+    #worker of pool_roi_info: the session xml is known from discovery and parsed once (cached)
+    ROIs = _read_rois(session.roi_zip)
+    if ROIs is None:
+        return None
+    meta = session.metadata
+    ROIs['microns_per_pixel'] = meta.microns_per_pixel if meta is not None else None
+    return _add_identifiers(ROIs, session.directory, meta.date if meta is not None else None)
+
+def pool_roi_info(input_dir, max_workers=8):
+    '''
+    ROI table of every RoiSet.zip under input_dir
+
+    Parameters
+    ----------
+    input_dir : str
+        top of the data tree
+    max_workers : int
+        RoiSet.zip files read in parallel (I/O bound on the T7 / network volumes)
+
+    Returns
+    -------
+    data : pd.DataFrame
+        one row per ROI, identifier columns first, same columns as get_roi_sess
+    '''
+    #one scandir pass over the tree, only folders that have a RoiSet.zip are read
+    sessions = [s for s in discovery.discover_sessions(input_dir) if s.roi_zip is not None]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        tables = [t for t in pool.map(_session_rois, sessions) if t is not None]
+    if not tables:
+        return pd.DataFrame(columns=ID_COLUMNS)
+    #one concat at the end instead of copying the growing table for every session
+    data = pd.concat(tables, ignore_index=True)
+    #areas for all ROIs at once
+    data['area (u^2)'] = ellipse_area(data['width'], data['height'], data.pop('microns_per_pixel'))
     #Put identifier info at front of dataframe. 
-    new_column_order = ['directory','animal','cell', 'dend', 'date'] + [col for col in data.columns if col not in ['directory','animal', 'cell', 'dend', 'date']]
+    new_column_order = ID_COLUMNS + [col for col in data.columns if col not in ID_COLUMNS]
     # Reorder the DataFrame columns
     data = data[new_column_order]
     return data
@@ -102,6 +149,8 @@ directory = '/Volumes/T7/Motor_Spines_Pilot_Data/289N/231024/289N_231024_Cell1_d
 ROIs = get_roi_sess(directory)
 input_dir = '/Volumes/T7/Motor_Spines_Pilot_Data'
 all_ROIs = pool_roi_info(input_dir)
+#stable spine IDs across imaging dates of the same cell / dend
+all_ROIs = spine_matching.match_spines(all_ROIs)
 
 #ADD SAVE LINES 
 path_parent = '/Volumes/T7/Motor_Spines_Pilot_Data/'
@@ -109,8 +158,8 @@ dir_save = 'python_dataframes'
 path_save = path_parent + dir_save
 if not os.path.exists(path_save):
     os.makedirs(path_save)
-# Save the dataframe to a CSV file in python_dataframes dir
-all_ROIs.to_csv(os.path.join(path_save, 'master_roi_info.csv'), index=False)
+# Save the dataframe to a CSV file (and the typed parquet catalog) in python_dataframes dir
+save_roi_catalog(all_ROIs, path_save)
 print('all_ROIs Dataframe saved to CSV file at:', path_save)
 
 
@@ -15,35 +15,31 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 
 from src import helper_functions as hf
+from src import discovery
+from src.session_analysis import get_session
 
 def get_roi_trace_files(directory):
     #column 0: spine; column 1: background (iterates 0-1)
-    file1 = glob.glob(os.path.join(directory, '**', '*spine0_bgr1*.csv'), recursive=True)
-    file2 = glob.glob(os.path.join(directory, '**', '*0spine_1bgr*.csv'), recursive=True)
-    file_list = file1+file2
+    #finds '*spine0_bgr1*.csv' and '*0spine_1bgr*.csv' in directory and all subdirectories (one scandir pass)
+    sessions = discovery.discover_sessions(directory, include_root=True)
+    file_list = discovery.trace_files(sessions)
     return file_list
 
+#the functions below delegate to the shared src/session_analysis.SessionAnalysis of the csv,
+#so the csv is read, the xml parsed and every table computed once per session.
+#the memoized tables are shared, so every get_* returns a copy the caller is free to modify
+
 def get_raw_fluorescence_trace(file_path):
-    #import data to pandas df
     #csv structure: each column is an ROI, each row is fluorescence (mean grey value) at a timepoint
-    df = pd.read_csv(file_path)
-    #remove first column, which is just index values from imageJ results file
-    df = df.loc[:, df.columns != ' ']
-    return df
+    #the ' ' index column of the imageJ results file is removed
+    return get_session(file_path).raw.copy()
 
 def get_bgr_subtracted_trace(file_path):
-    df = get_raw_fluorescence_trace(file_path)
     #spine_background_subtracted = spine roi mean grey value - mean grey of same roi in background 
-    spine_bgr_subtracted = pd.DataFrame()
-    #subtract background from spine signal for every spine
-    for i in range(0,len(df.columns),2):
-        spine_bgr_subtracted[i//2] = df.iloc[:,i] - df.iloc[:,i+1]
-    return spine_bgr_subtracted
+    return get_session(file_path).bgr_subtracted().copy()
 
 def get_num_spines(file_path):
-    df = get_raw_fluorescence_trace(file_path)
-    num_spines = df.shape[1]/2
-    return int(num_spines)
+    return get_session(file_path).num_spines
 
 #need helper functions to access relevant metadata (ie to determine how many rows/frames go into a rolling window)
 def get_dFF(file_path, f0_ = 'mode', window_size = 30):
@@ -67,34 +63,7 @@ def get_dFF(file_path, f0_ = 'mode', window_size = 30):
         each column is the dFF (change in fluorescence) of a single spine roi 
 
     '''
-    directory = os.path.dirname(file_path)
-    #spine_background_subtracted = spine roi mean grey value - mean grey of same roi in background 
-    spine_bgr_subtracted = get_bgr_subtracted_trace(file_path)
-    if f0_ == 'mode':
-        #calculate f0 as the most common value for each ROI
-        f0 = spine_bgr_subtracted.mode().median() #this will find all mode (most common) values, and select the middle range mode if there are multiple
-        #replace any 0 values with nonzero value, to prevent errors when calculating df/f trace
-        f0 = f0.replace(0,1)#alternative just add one to everything (that way it is also a consistent offset for all values)
-    if f0_ == 'rolling10':
-        #calculate f0 as lowest 10th percentil of moving window
-        frame_period = hf.get_frame_period(directory) #time per frame
-        avg = hf.get_avg(directory) #num averages per scan
-        sampling_rate = 1/(avg*frame_period) #units: Hz, number frames per second
-        window_frames = int(window_size*sampling_rate) #num of frames to match duration of window_size
-        #this calulates the 10th percentile of a rolling window of size window_frames
-            #min_periods=1 allows df.rolling() to report a value for all indeces before the window_frames number is reached 
-            #quantile(0.1) reports the value below which 10 percent of the data falls
-        f0 = spine_bgr_subtracted.rolling(window = window_frames, min_periods = 1).quantile(0.1)
-        #f0 = rolling10 use rolling10 as f0
-    #DFF CODE: calculate df/f stored in dFF dataframe
-    dFF = pd.DataFrame()
-    #perform (f(t)-f0)/f0 in two steps, to avoid a for loop! 
-    #step one, subtract f0 from f(t)
-    dFF = spine_bgr_subtracted.subtract(f0)
-    #step two, divide by f0
-    dFF = dFF.div(f0) #the rolling 10 value needs to be above zero
-    #do we want to save the dFF dataframe?
-    return dFF
+    return get_session(file_path).dFF(f0_, window_size).copy()
 
 def get_event_detection(file_path, f0_ = 'mode', window_size = 30):
     '''
@@ -121,35 +90,26 @@ def get_event_detection(file_path, f0_ = 'mode', window_size = 30):
         currently defined as 3 standard deviations above the mean. std and mean
         are calculated over the rolling period of window_size (sec)
     '''
-    dFF = get_dFF(file_path, f0_, window_size)
-    #get metadata
-    directory = os.path.dirname(file_path)
-    frame_period = hf.get_frame_period(directory) #time per frame
-    avg = hf.get_avg(directory) #num averages per scan
-    sampling_rate = 1/(avg*frame_period) #units: Hz, number frames per second
-    window_frames = int(window_size*sampling_rate) #num of frames to match duration of window_size
-    #calculate rolling std for each spine roi
-        #min periods tells you how many frames are needed to calcualte std
-    rollingSTD = dFF.rolling(window = window_frames, min_periods = 8).std() #why 8?
-    rollingSTD.fillna(1,inplace=True)
-    rollingMean = dFF.rolling(window = window_frames, min_periods = 1).mean()
-    threshold = rollingMean + (3*rollingSTD)
-    event_detect = dFF.gt(threshold) #df1.gt(df2) checks if df1 value is greater than df2 value, element by element
-    return event_detect
+    #threshold = rolling mean + 3 * rolling std of the dFF (min_periods 8 for the std)
+    return get_session(file_path).event_detection(f0_, window_size).copy()
 
 def plot_dFF(file_path, f0_ = 'mode', window_size = 30, event_detection = True):
-    dFF = get_dFF(file_path, f0_, window_size)
+    session = get_session(file_path)
+    dFF = session.dFF(f0_, window_size)
     n = len(dFF) #number of frames, n
     #get metadata
     directory = os.path.dirname(file_path)
-    frame_period = hf.get_frame_period(directory) #time per frame
-    avg = hf.get_avg(directory) #num averages per scan
+    frame_period = session.frame_period #time per frame
+    avg = session.avg #num averages per scan
     time = np.linspace(0,int(n*frame_period*avg),n) 
         #start: 0, end: n*frame_period*avg, number of points:n
         #number of frames * time per frame * num of averages should equal total imaging time
     path_svg = directory +'/svg/'
     if not os.path.exists(path_svg):
         os.makedirs(path_svg)
+    if event_detection == True:
+        #once for the session, not once per spine
+        event_detect = session.event_detection(f0_, window_size)
     for roi in range(dFF.shape[1]):
         plt.figure()
         plt.xlabel('(sec)')
@@ -159,7 +119,6 @@ def plot_dFF(file_path, f0_ = 'mode', window_size = 30, event_detection = True):
         save_svg = directory +'/svg/' + f'spine_{roi}_dFF.svg'
         print(save_svg)
         if event_detection == True:
-            event_detect = get_event_detection(file_path, f0_, window_size)
             plt.title(f"Spine {roi} with event detection")
             save_svg = directory +'/svg/' + f'spine_{roi}_dFF_w_event_detection.svg'
             x = [time[i] for i,j in enumerate(event_detect[roi]) if j==True]
@@ -171,22 +130,12 @@ def plot_dFF(file_path, f0_ = 'mode', window_size = 30, event_detection = True):
     return 
 
 def get_event_rate(file_path, f0_ = 'mode', window_size = 30):
-    directory = os.path.dirname(file_path)
-    dur = hf.get_imaging_session_duration(directory)
-    sum_events = get_event_detection(file_path, f0_, window_size).sum()
-    return sum_events/dur
+    #number of events / session duration (sec) for every spine
+    return get_session(file_path).event_rate(f0_, window_size).copy()
 
 def get_variance(file_path, state = 'dFF', f0_ = 'mode', window_size = 30):
-    if state == 'raw':
-        raw_traces = get_raw_fluorescence_trace(file_path)
-        variances = raw_traces.var()
-    if state == 'bgr_subtracted':
-        F_traces = get_bgr_subtracted_trace(file_path) 
-        variances = F_traces.var()
-    if state == 'dFF':
-        dFF = get_dFF(file_path, f0_, window_size)
-        variances = dFF.var()
-    return variances
+    #state: 'raw', 'bgr_subtracted' or 'dFF'
+    return get_session(file_path).variance(state, f0_, window_size).copy()
 
 def get_baseline_drift():
     #either by linear regression 
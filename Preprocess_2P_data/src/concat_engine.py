@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 09:31:08 2026
+
+@author: emmaodom
+
+streaming concat engine shared by batch_concat_TSeries / _ZSeries / _TZSeries.
+instead of one TiffWriter.save (one IFD + one new array) per frame, the output
+BigTIFF is preallocated once with the final (n_frames, Y, X) shape and filled
+through tifffile.memmap. each single-frame ome.tif is decoded straight into its slot
+of the memmap (one copy per frame) and the memmap is flushed every block_frames
+frames, so memory use does not grow with the length of the session.
+independent stacks (ie every (plane, channel) of a TZSeries) can be written in parallel.
+optionally the stacks are written lossless compressed and tiled (deflate or zstd with
+predictor, multithreaded encoding), which cuts write time to the USB drives and archive
+size for 16 bit GCaMP data. tifffile (and Fiji for deflate) decode these transparently.
+"""
+
+import os
+import logging
+import numpy as np
+import tifffile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+def get_frame_info(file_path):
+    '''
+    returns (shape, dtype) of the first page of a single frame tif
+    '''
+    with tifffile.TiffFile(file_path, is_ome=False) as tif:
+        page = tif.pages[0]
+        return page.shape, page.dtype
+
+def _read_frame(file_path, frame_shape, out=None):
+    with tifffile.TiffFile(file_path, is_ome=False) as tif:
+        page = tif.pages[0]
+        if page.shape != frame_shape:
+            raise ValueError(f"{file_path} has shape {page.shape}, expected {frame_shape}")
+        return page.asarray(out=out)
+
+def _iter_tiles(file_list, frame_shape, dtype, tile, block_frames):
+    '''
+    yields the tiles of every frame in the order tifffile expects for a tiled write
+    (frame by frame, row major). frames are read block_frames at a time into one reused buffer
+    '''
+    height, width = frame_shape
+    th, tw = tile
+    block = np.empty((min(block_frames, len(file_list)),) + frame_shape, dtype=dtype)
+    for start in range(0, len(file_list), block_frames):
+        stop = min(start + block_frames, len(file_list))
+        for i in range(start, stop):
+            _read_frame(file_list[i], frame_shape, out=block[i - start])
+        for frame in block[:stop - start]:
+            for y in range(0, height, th):
+                for x in range(0, width, tw):
+                    segment = frame[y:y + th, x:x + tw]
+                    if segment.shape != (th, tw):
+                        #edge tiles are zero padded to the full tile size
+                        padded = np.zeros((th, tw), dtype=dtype)
+                        padded[:segment.shape[0], :segment.shape[1]] = segment
+                        segment = padded
+                    yield segment
+
+def concat_to_bigtiff(file_list, out_path, frame_shape=None, dtype=None, block_frames=256,
+                      compression=None, compression_level=None, tile=(256, 256), max_workers=None):
+    '''
+    concatenates single frame tifs (in the given order) into one contiguous BigTIFF
+
+    Parameters
+    ----------
+    file_list : list of str
+        single frame tifs, already sorted in frame order
+    out_path : str
+        path of the stack to write (overwritten if it exists)
+    frame_shape, dtype : tuple, numpy dtype
+        frame shape (Y, X) and pixel type. read from the first file if not given
+        (ie pass (linesPerFrame, pixelsPerLine) from the xml metadata)
+    block_frames : int
+        number of frames copied between flushes of the memmap to disk
+        (or read per block in compressed mode)
+    compression : None, 'zlib' or 'zstd'
+        None writes the uncompressed memmap stack. 'zlib' (deflate) or 'zstd' write a
+        lossless, tiled stack with horizontal predictor, encoded on max_workers threads.
+        deflate is readable by Fiji / Bio-Formats, zstd is smaller and faster but
+        needs imagecodecs to read in python and is NOT read by Fiji.
+    compression_level : int
+        encoder level (None = codec default)
+    tile : (int, int)
+        tile size (Y, X) for compressed output, multiples of 16
+    max_workers : int
+        threads used by tifffile to encode tiles (None = tifffile default)
+
+    Returns
+    -------
+    n : int
+        number of frames written
+    '''
+    n = len(file_list)
+    first_shape, first_dtype = get_frame_info(file_list[0])
+    if frame_shape is None:
+        frame_shape = first_shape
+    if dtype is None:
+        dtype = first_dtype
+    frame_shape = tuple(frame_shape)
+    if compression is not None:
+        compressionargs = {'level': compression_level} if compression_level is not None else None
+        tifffile.imwrite(out_path, _iter_tiles(file_list, frame_shape, dtype, tile, block_frames),
+                         shape=(n,) + frame_shape, dtype=dtype, bigtiff=True,
+                         photometric='minisblack', metadata={'axes': 'TYX'}, tile=tile,
+                         compression=compression, compressionargs=compressionargs,
+                         predictor=True, maxworkers=max_workers)
+        return n
+    out = tifffile.memmap(out_path, shape=(n,) + frame_shape, dtype=dtype,
+                          bigtiff=True, photometric='minisblack', metadata={'axes': 'TYX'})
+    try:
+        for start in range(0, n, block_frames):
+            for i in range(start, min(start + block_frames, n)):
+                _read_frame(file_list[i], frame_shape, out=out[i]) #decode directly into the output file
+            out.flush()
+    finally:
+        del out
+    return n
+
+def _write_stack(directory, out_name, file_list, block_frames, compression, store='tiff'):
+    if store == 'zarr':
+        #chunked zarr array instead of a tif, see src/movie_store.py
+        from src import movie_store
+        key = movie_store.key_from_stack_name(directory, out_name)
+        return movie_store.write_zarr_stack(file_list, directory, key)
+    out_path = os.path.join(directory, out_name)
+    n = concat_to_bigtiff(file_list, out_path, block_frames=block_frames, **(compression or {}))
+    logging.info(f"Saved {out_path} ({n} frames)")
+    print(f"Saved {out_path}")
+    return out_path
+
+def write_stacks(directory, stacks, block_frames=256, min_frames=2, max_workers=1, use_processes=False,
+                 compression=None, store='tiff'):
+    '''
+    writes each output stack of a session with concat_to_bigtiff
+
+    Parameters
+    ----------
+    directory : str
+        session folder, stacks are written here
+    stacks : list of (out_name, file_list, label)
+        out_name ie f"{dir_name}-Ch1.tif", the frames to concatenate in frame order
+        (see src/frame_index.py),
+        and a label for the log ie 'Channel 1'
+    min_frames : int
+        stacks with fewer frames are skipped (2 = same rule as the original per-channel loops)
+    max_workers : int
+        number of stacks written at the same time. every stack is an independent
+        output file, so (plane, channel) stacks of a TZSeries can be written in parallel
+        and keep the drive's queue busy. 1 = one after the other
+    use_processes : bool
+        use a process pool instead of threads (helps if decoding, not the disk, is the limit).
+        the workers are started with spawn on macOS and re-import the calling script, so its
+        script level code must be behind if __name__ == '__main__': (see batch_concat.py)
+    compression : None, str or dict
+        None = uncompressed stacks. 'zlib' / 'zstd', or a dict of concat_to_bigtiff
+        compression keywords ie {'compression': 'zstd', 'compression_level': 5, 'max_workers': 8}
+    store : 'tiff' or 'zarr'
+        'zarr' writes each stack as a chunked array in {directory}/{dir_name}.zarr
+        instead of a tif (compression is then the zarr default codec)
+
+    Returns
+    -------
+    written : list of str
+        paths of the stacks that were written, in the order of stacks
+    '''
+    if isinstance(compression, str):
+        compression = {'compression': compression}
+    jobs = []
+    for out_name, file_list, label in stacks:
+        if len(file_list) >= min_frames:
+            jobs.append((out_name, file_list))
+        else:
+            logging.info(f"No {label} files.")
+    if max_workers <= 1 or len(jobs) <= 1:
+        return [_write_stack(directory, out_name, file_list, block_frames, compression, store) for out_name, file_list in jobs]
+    Executor = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with Executor(max_workers=max_workers) as pool:
+        futures = [pool.submit(_write_stack, directory, out_name, file_list, block_frames, compression, store)
+                   for out_name, file_list in jobs]
+        #result() re-raises the first failed stack, before any frame is deleted by the caller
+        return [future.result() for future in futures]
+
+def delete_frames(file_list):
+    #delete the individual ome.tif frames once every stack has been written
+    for file in file_list:
+        logging.info(f"Deleting {file}")
+        os.remove(file)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 16:12:50 2026
+
+@author: emmaodom
+
+session discovery: scans a data tree ONCE with os.scandir and classifies the files
+of every folder (xml metadata, raw ome.tif frames, concatenated stacks, stab csvs,
+RoiSet.zip, spine/background trace csvs) into Session records.
+directory listings are fanned out over a thread pool, which matters on the T7 / network
+volumes where every listdir/stat is slow.
+the entry scripts (batch_concat, summarize, extract_roi_info, batch_motion_correct,
+plot_dFF, hf.record_motion_correct_status) all use discover_sessions instead of
+os.walk + glob per folder.
+"""
+
+import os
+import re
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from src import session_metadata
+
+#same selection as the glob patterns used across the scripts
+RAW_TIF_PATTERN = re.compile(r'\d{6}\.ome\.tif$') #'*[0-9][0-9][0-9][0-9][0-9][0-9].ome.tif'
+TRACE_CSV_PATTERN = re.compile(r'(spine0_bgr1|0spine_1bgr).*\.csv$') #'*spine0_bgr1*.csv', '*0spine_1bgr*.csv'
+
+@dataclass
+class Session:
+    '''
+    files of one folder, classified. all paths are full paths, lists are sorted.
+    a Session is made for every folder under the scanned root (like os.walk dirs),
+    use has_xml / seq_code to select imaging sessions.
+    '''
+    directory: str
+    xml: str = None #imaging metadata xml (VoltageRecording xml excluded), same choice as hf.get_xml_image
+    xml_files: list = field(default_factory=list)
+    raw_tifs: list = field(default_factory=list) #individual '######.ome.tif' frames from PrairieView
+    tif_stacks: list = field(default_factory=list) #every other .tif (concatenated stacks, projections)
+    stab1_csvs: list = field(default_factory=list)
+    stab2_csvs: list = field(default_factory=list)
+    roi_zip: str = None
+    trace_csvs: list = field(default_factory=list) #spine/background Multi Measure exports
+    zarr_store: str = None #chunked movie store written by batch_concat(store='zarr')
+    other_files: list = field(default_factory=list)
+
+    @property
+    def name(self):
+        return os.path.basename(self.directory)
+
+    @property
+    def has_xml(self):
+        return self.xml is not None
+
+    @property
+    def metadata(self):
+        #parse-once (and disk cached) SessionMetadata, None if there is no xml
+        if self.xml is None:
+            return None
+        return session_metadata.load(self.xml)
+
+    @property
+    def sequence_type(self):
+        meta = self.metadata
+        return meta.sequence_type if meta is not None else None
+
+    @property
+    def seq_code(self):
+        #'T', 'Z', 'TZ' or None
+        meta = self.metadata
+        return meta.seq_code if meta is not None else None
+
+    @property
+    def batch_concat(self):
+        #same heuristic as hf.check_batch_concat: fewer than 20 raw tifs means concat has run
+        return len(self.raw_tifs) < 20
+
+    @property
+    def double_motion_corrected(self):
+        #same as hf.check_double_motion_correct: [stab 1 exists, stab 2 exists, both exist]
+        file1_exists = len(self.stab1_csvs) > 0
+        file2_exists = len(self.stab2_csvs) > 0
+        return [file1_exists, file2_exists, (file1_exists and file2_exists)]
+
+    def channel_files(self, channel):
+        #raw frames of one channel ie 'Ch2'
+        return [f for f in self.raw_tifs if channel in os.path.basename(f)]
+
+def classify_files(directory, file_names):
+    '''
+    builds a Session from the file names of directory (no extra filesystem calls)
+    '''
+    session = Session(directory=directory)
+    for name in sorted(file_names):
+        if name.startswith('.'):
+            #hidden / AppleDouble '._' files, glob skips these too
+            continue
+        path = os.path.join(directory, name)
+        if name.endswith('.xml'):
+            session.xml_files.append(path)
+        elif RAW_TIF_PATTERN.search(name):
+            session.raw_tifs.append(path)
+        elif name.endswith('.tif'):
+            session.tif_stacks.append(path)
+        elif name.endswith('.zarr'):
+            session.zarr_store = path
+        elif name == 'RoiSet.zip':
+            session.roi_zip = path
+        elif name.endswith('.csv') and 'stab 1' in name:
+            session.stab1_csvs.append(path)
+        elif name.endswith('.csv') and 'stab 2' in name:
+            session.stab2_csvs.append(path)
+        elif TRACE_CSV_PATTERN.search(name):
+            session.trace_csvs.append(path)
+        else:
+            session.other_files.append(path)
+    if session.xml_files:
+        xml_files = session.xml_files
+        if len(xml_files) > 1:
+            xml_files = [f for f in xml_files if 'VoltageRecording' not in f]
+        session.xml = xml_files[0] if xml_files else None
+    return session
+
+def _list_dir(directory):
+    files, subdirs = [], []
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.name.endswith('.zarr'):
+                    #zarr movie store: listed like a file, its chunk folders are not scanned
+                    files.append(entry.name)
+                elif entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                else:
+                    files.append(entry.name)
+    except OSError as e:
+        print(f"Could not list {directory}: {e}")
+    return files, subdirs
+
+def discover_sessions(parent_dir, max_workers=16, include_root=False):
+    '''
+    scans parent_dir once and returns a Session for every subdirectory at any depth
+
+    Parameters
+    ----------
+    parent_dir : str
+        top of the data tree ie '/Volumes/T7/Motor_Spines_Pilot_Data'
+    max_workers : int
+        number of threads listing directories in parallel
+    include_root : bool
+        also return a Session for parent_dir itself (os.walk based loops skipped it)
+
+    Returns
+    -------
+    sessions : list of Session
+        sorted by directory path
+    '''
+    sessions = []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = {pool.submit(_list_dir, parent_dir): parent_dir}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                directory = pending.pop(future)
+                files, subdirs = future.result()
+                if directory != parent_dir or include_root:
+                    sessions.append(classify_files(directory, files))
+                for subdir in subdirs:
+                    pending[pool.submit(_list_dir, subdir)] = subdir
+    sessions.sort(key=lambda s: s.directory)
+    return sessions
+
+def imaging_sessions(parent_dir, max_workers=16):
+    #only folders that have an imaging xml
+    return [s for s in discover_sessions(parent_dir, max_workers) if s.has_xml]
+
+def trace_files(sessions):
+    #all spine/background trace csvs in the scanned tree, see plot_dFF.get_roi_trace_files
+    return [f for s in sessions for f in s.trace_csvs]
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Oct 22 11:05:39 2026
+
+@author: emmaodom
+
+pool of long lived Fiji workers for the steps that still need a macro.
+instead of one ImageJ launch for set_memory_and_quit.ijm and then one more launch
+(JVM startup + plugin loading) per tif, N Fiji processes are started once, with the
+memory set on the launcher command line (--mem), and each one runs a small worker
+macro that waits for jobs in its own folder:
+    {work_dir}/worker_0/job.txt      <- macro path + argument, written by python
+    {work_dir}/worker_0/status.txt   <- 'done', or 'failed:[aborted]' if runMacro aborted,
+                                        written by the worker after runMacro
+python hands jobs out from a queue, kills and restarts a worker whose job runs past
+its timeout (or whose JVM died), retries aborted and failed jobs, and saves the Fiji
+log of every job next to the session plus its status.
+
+macros run through the pool get getArgument() like on the command line. a
+run("Quit") in the job macro is dropped so it does not end the worker. workers are
+started with --headless unless headless=False, which macros that use the GUI (ROI
+Manager, Align slices ie motion_correct_single_TSeries.ijm) need.
+
+    with FijiPool(fiji_path, n_workers=3) as pool:
+        job = pool.submit(macro_path, file_path, session_dir=directory)
+        result = job.result()   # JobResult(status='done', ...)
+"""
+
+import os
+import re
+import time
+import queue
+import shutil
+import logging
+import tempfile
+import threading
+import subprocess
+from dataclasses import dataclass
+
+WORKER_MACRO = '''// fiji pool worker: runs the queued macro jobs of one worker folder until 'stop' appears
+dir = getArgument();
+while (!File.exists(dir + "/stop")) {
+    if (File.exists(dir + "/job.txt")) {
+        lines = split(File.openAsString(dir + "/job.txt"), "\\n");
+        ok = File.delete(dir + "/job.txt");
+        arg = "";
+        if (lines.length > 1) arg = lines[1];
+        print("job start: " + lines[0] + " " + arg);
+        result = runMacro(lines[0], arg);
+        close("*");
+        //runMacro returns "[aborted]" when the job macro errored or was aborted
+        status = "done";
+        if (result == "[aborted]") status = "failed:" + result;
+        print("job end: " + lines[0] + " " + status);
+        File.saveString(status, dir + "/status.tmp");
+        ok = File.rename(dir + "/status.tmp", dir + "/status.txt");
+    }
+    wait(200);
+}
+run("Quit");
+'''
+
+QUIT_LINE = re.compile(r'^\s*run\("Quit"\);?.*$', re.MULTILINE)
+
+@dataclass
+class JobResult:
+    macro: str
+    arg: str
+    status: str = 'queued' #'done', 'failed' (macro aborted or worker died) or 'timeout', after the last attempt
+    attempts: int = 0
+    elapsed: float = 0.0
+    returncode: int = None #exit code of the worker if it died during the job
+    log_path: str = None
+    message: str = None #status the worker wrote for the last attempt, ie 'failed:[aborted]'
+
+class Job:
+    '''
+    handle returned by FijiPool.submit, result() blocks until the job is finished
+    '''
+    def __init__(self, macro, arg, session_dir, timeout):
+        self.macro = macro
+        self.arg = arg
+        self.session_dir = session_dir
+        self.timeout = timeout
+        self._result = JobResult(macro, arg)
+        self._done = threading.Event()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        self._done.wait(timeout)
+        return self._result
+
+class _Worker:
+    '''
+    one Fiji process and its job folder
+    '''
+    def __init__(self, pool, number):
+        self.pool = pool
+        self.dir = os.path.join(pool.work_dir, f"worker_{number}")
+        os.makedirs(self.dir, exist_ok=True)
+        self.log_path = os.path.join(self.dir, 'fiji.log')
+        self.proc = None
+        self._log = None
+
+    def start(self):
+        for name in ('stop', 'job.txt', 'status.txt', 'status.tmp'):
+            if os.path.exists(os.path.join(self.dir, name)):
+                os.remove(os.path.join(self.dir, name))
+        self._log = open(self.log_path, 'ab')
+        cmd = [self.pool.fiji_path, f"--mem={self.pool.memory}"]
+        if self.pool.headless:
+            cmd.append('--headless')
+        cmd += ['-macro', self.pool.worker_macro, self.dir]
+        self.proc = subprocess.Popen(cmd, stdout=self._log, stderr=subprocess.STDOUT)
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def kill(self):
+        if self.alive():
+            self.proc.kill()
+            self.proc.wait()
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def stop(self):
+        if self.alive():
+            open(os.path.join(self.dir, 'stop'), 'w').close()
+            try:
+                self.proc.wait(timeout=60)
+            except subprocess.TimeoutExpired:
+                pass
+        self.kill()
+
+    def run(self, job, job_number):
+        '''
+        runs one attempt of job, returns (status, returncode, message)
+        '''
+        if not self.alive():
+            self.kill()
+            self.start()
+        #job copy of the macro without run("Quit")
+        with open(job.macro) as f:
+            text = QUIT_LINE.sub('', f.read())
+        job_macro = os.path.join(self.dir, f"job_{job_number}.ijm")
+        with open(job_macro, 'w') as f:
+            f.write(text)
+        status_path = os.path.join(self.dir, 'status.txt')
+        if os.path.exists(status_path):
+            os.remove(status_path)
+        log_start = os.path.getsize(self.log_path)
+        tmp = os.path.join(self.dir, 'job.tmp')
+        with open(tmp, 'w') as f:
+            f.write(f"{job_macro}\n{job.arg}\n")
+        os.replace(tmp, os.path.join(self.dir, 'job.txt')) #the worker never sees a half written job
+        start = time.time()
+        status, returncode, message = 'timeout', None, None
+        while time.time() - start < job.timeout:
+            if os.path.exists(status_path):
+                #written to status.tmp and renamed, so the file is complete
+                with open(status_path) as f:
+                    message = f.read().strip()
+                status = 'done' if message == 'done' else 'failed'
+                break
+            if not self.alive():
+                status, returncode = 'failed', self.proc.returncode
+                break
+            time.sleep(self.pool.poll_interval)
+        if status == 'timeout':
+            self.kill() #restarted for the next job
+        self._save_job_log(job, log_start)
+        os.remove(job_macro)
+        return status, returncode, message
+
+    def _save_job_log(self, job, log_start):
+        #the part of the worker log written during this job
+        if job.session_dir is None:
+            return
+        with open(self.log_path, 'rb') as f:
+            f.seek(log_start)
+            text = f.read()
+        name = os.path.splitext(os.path.basename(job.macro))[0]
+        job._result.log_path = os.path.join(job.session_dir, f"fiji_{name}.log")
+        with open(job._result.log_path, 'ab') as f:
+            f.write(text)
+
+class FijiPool:
+    '''
+    Parameters
+    ----------
+    fiji_path : str
+        ImageJ launcher ie "/Applications/Fiji.app/Contents/MacOS/ImageJ-macosx"
+    n_workers : int
+        number of Fiji processes (sessions corrected at the same time)
+    memory : str
+        maximum heap of each worker, passed as --mem (replaces set_memory_and_quit.ijm)
+    timeout : float
+        default seconds a job may run before its worker is killed and restarted
+    retries : int
+        extra attempts for a job that timed out, aborted or whose worker died
+    headless : bool
+        start Fiji with --headless (macros that need the GUI / waitForUser need False)
+    work_dir : str
+        folder for the worker job folders and logs (a temp folder by default)
+    '''
+    def __init__(self, fiji_path, n_workers=2, memory='13500m', timeout=3600, retries=1,
+                 headless=True, work_dir=None, poll_interval=0.5):
+        self.fiji_path = fiji_path
+        self.memory = memory
+        self.timeout = timeout
+        self.retries = retries
+        self.headless = headless
+        self.poll_interval = poll_interval
+        self._own_work_dir = work_dir is None
+        self.work_dir = work_dir if work_dir is not None else tempfile.mkdtemp(prefix='fiji_pool_')
+        os.makedirs(self.work_dir, exist_ok=True)
+        self.worker_macro = os.path.join(self.work_dir, 'fiji_pool_worker.ijm')
+        with open(self.worker_macro, 'w') as f:
+            f.write(WORKER_MACRO)
+        self._queue = queue.Queue()
+        self._job_count = 0
+        self._lock = threading.Lock()
+        self._workers = [_Worker(self, i) for i in range(n_workers)]
+        for worker in self._workers:
+            worker.start() #all JVMs start up in parallel, once
+        self._threads = [threading.Thread(target=self._dispatch, args=(worker,), daemon=True)
+                         for worker in self._workers]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, macro, arg='', session_dir=None, timeout=None):
+        '''
+        queues a macro job, returns a Job. session_dir: where the job's
+        Fiji log (fiji_{macro name}.log) is saved, ie the session folder
+        '''
+        job = Job(macro, arg, session_dir, timeout if timeout is not None else self.timeout)
+        self._queue.put(job)
+        return job
+
+    def map(self, macro, args, session_dirs=None):
+        #runs macro once per argument, returns the JobResults in order
+        session_dirs = session_dirs if session_dirs is not None else [None]*len(args)
+        jobs = [self.submit(macro, arg, session_dir) for arg, session_dir in zip(args, session_dirs)]
+        return [job.result() for job in jobs]
+
+    def _dispatch(self, worker):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            with self._lock:
+                self._job_count += 1
+                job_number = self._job_count
+            result = job._result
+            start = time.time()
+            while result.attempts <= self.retries:
+                result.attempts += 1
+                try:
+                    result.status, result.returncode, result.message = worker.run(job, job_number)
+                except OSError as e:
+                    print(f"Fiji job {job.macro} {job.arg} could not run: {e}")
+                    result.status = 'failed'
+                if result.status == 'done':
+                    break
+                logging.warning(f"Fiji job {os.path.basename(job.macro)} {job.arg} {result.message or result.status} (attempt {result.attempts})")
+            result.elapsed = time.time() - start
+            logging.info(f"Fiji job {os.path.basename(job.macro)} {job.arg}: {result.status} in {result.elapsed:.1f} s")
+            job._done.set()
+
+    def close(self):
+        #waits for the queued jobs, then stops the workers
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        for worker in self._workers:
+            worker.stop()
+        if self._own_work_dir:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
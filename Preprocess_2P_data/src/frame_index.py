@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 14:47:22 2026
+
+@author: emmaodom
+
+filename index for the single frame OME tifs written by PrairieView:
+    ..._Cycle00002_Ch2_000001.ome.tif
+           cycle   channel  6 digit frame index
+for a TSeries the 6 digit index is the time point (cycle is 1), for a ZSeries it is the
+z slice, and for a TZSeries it is the z plane while the cycle is the time point.
+
+all names are parsed once into a table (path, cycle, channel, plane) so files can be
+grouped by channel / plane in O(1) instead of [f for f in files if ID in f]
+(the 6 digit ID can also match inside the cycle number or the folder name), and the
+files can be checked against the xml frame table for missing or duplicate frames
+BEFORE anything is concatenated or deleted.
+"""
+
+import os
+import re
+import numpy as np
+import pandas as pd
+
+FRAME_NAME = re.compile(r'_Cycle(\d+)_Ch(\d+)_(\d{6})\.ome\.tif$')
+
+class FrameIndex:
+    '''
+    Parameters
+    ----------
+    file_list : list of str
+        raw frame tifs of one session (ie discovery.Session.raw_tifs)
+
+    Attributes
+    ----------
+    table : pd.DataFrame
+        columns path, cycle, channel, plane; sorted by channel, cycle, plane
+    unparsed : list of str
+        files whose name does not follow the PrairieView pattern
+    '''
+    def __init__(self, file_list):
+        paths, cycles, channels, planes = [], [], [], []
+        self.unparsed = []
+        for path in file_list:
+            match = FRAME_NAME.search(os.path.basename(path))
+            if match is None:
+                self.unparsed.append(path)
+                continue
+            paths.append(path)
+            cycles.append(int(match.group(1)))
+            channels.append(int(match.group(2)))
+            planes.append(int(match.group(3)))
+        table = pd.DataFrame({
+            'path': paths,
+            'cycle': np.asarray(cycles, dtype=np.int32),
+            'channel': np.asarray(channels, dtype=np.int16),
+            'plane': np.asarray(planes, dtype=np.int32),
+            })
+        self.table = table.sort_values(['channel', 'cycle', 'plane'], kind='stable').reset_index(drop=True)
+        #row positions per channel and per (channel, plane), built once
+        self._by_channel = self.table.groupby('channel', sort=True).indices
+        self._by_plane = self.table.groupby(['channel', 'plane'], sort=True).indices
+
+    def __len__(self):
+        return len(self.table)
+
+    @property
+    def channels(self):
+        return sorted(int(c) for c in self._by_channel)
+
+    @property
+    def planes(self):
+        return sorted(set(int(p) for _, p in self._by_plane))
+
+    def files(self, channel, plane=None):
+        '''
+        paths of one channel (ordered by cycle then plane), or of one (channel, plane)
+        (ordered by cycle). empty list if there are none
+        '''
+        if plane is None:
+            rows = self._by_channel.get(channel)
+        else:
+            rows = self._by_plane.get((channel, plane))
+        if rows is None:
+            return []
+        return self.table['path'].values[rows].tolist()
+
+    def validate(self, meta=None):
+        '''
+        checks the frame files for duplicates and, if meta (SessionMetadata) is given,
+        against the xml frame table: every channel must have exactly one file for
+        every (cycle, frame index) listed in the xml
+
+        Returns
+        -------
+        problems : dict
+            'duplicates', 'missing', 'unexpected' -> DataFrame (channel, cycle, plane) rows,
+            'unparsed' -> list of paths. everything empty if the session is complete
+        '''
+        key_cols = ['channel', 'cycle', 'plane']
+        dup = self.table.duplicated(key_cols, keep=False)
+        problems = {
+            'duplicates': self.table.loc[dup, key_cols + ['path']].reset_index(drop=True),
+            'missing': pd.DataFrame(columns=key_cols),
+            'unexpected': pd.DataFrame(columns=key_cols),
+            'unparsed': list(self.unparsed),
+            }
+        if meta is None:
+            return problems
+        #encode (cycle, plane) as one integer so set operations run vectorized
+        expected = np.unique(meta.frame_cycle.astype(np.int64)*1_000_000 + meta.frame_index)
+        missing, unexpected = [], []
+        for channel, rows in self._by_channel.items():
+            sub = self.table.iloc[rows]
+            found = np.unique(sub['cycle'].values.astype(np.int64)*1_000_000 + sub['plane'].values)
+            for keys, out in ((np.setdiff1d(expected, found), missing), (np.setdiff1d(found, expected), unexpected)):
+                if len(keys):
+                    out.append(pd.DataFrame({'channel': channel, 'cycle': keys // 1_000_000, 'plane': keys % 1_000_000}))
+        if missing:
+            problems['missing'] = pd.concat(missing, ignore_index=True)
+        if unexpected:
+            problems['unexpected'] = pd.concat(unexpected, ignore_index=True)
+        return problems
+
+def report_problems(problems):
+    '''
+    returns a one line summary of validate() problems, or None if there are none
+    '''
+    parts = []
+    for name in ('missing', 'duplicates', 'unexpected', 'unparsed'):
+        n = len(problems[name])
+        if n:
+            parts.append(f"{n} {name}")
+    if not parts:
+        return None
+    return 'frame check failed: ' + ', '.join(parts)
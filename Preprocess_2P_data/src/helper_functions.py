@@ -7,18 +7,20 @@ Created on Tue Dec 19 18:43:53 2023
 """
 
 #each other module should import helper_functions as hf
-#UPDATE GET DURATION FOR TZSERIES. 
 
 import os
 import glob
-import time
 import tifffile
 import logging
 import pandas as pd
-import xml.etree.ElementTree as ET
-from datetime import datetime
+from functools import lru_cache
+
+from src import session_metadata
+from src import metadata_cache
+from src import discovery
 
 #get_xml_image, get_sequence_type, and get_max_z_index are duplicates from batch_concat.py
+#all xml getters below are thin wrappers around src/session_metadata.SessionMetadata (parsed once per xml)
 
 def get_xml_image(directory):
     '''
@@ -47,6 +49,37 @@ for the xml file with imaging metadata (and to exclude voltage recording metadat
     xml_file = xml_files[0]
     return xml_file
 
+@lru_cache(maxsize=1024)
+def _cached_xml_image(directory, mtime_ns):
+    #the directory mtime changes when files are added / removed, so a new or renamed xml is found again
+    return get_xml_image(directory)
+
+def get_session_metadata(directory):
+    '''
+    returns the parse-once SessionMetadata object for the imaging xml in directory
+    (or None if there is no xml / it can not be parsed). The object is memoized on
+    xml path, mtime and size so repeated getter calls do not re-parse the file, and
+    the extracted fields are kept in the on-disk sqlite cache (src/metadata_cache.py)
+    so later runs skip parsing of unchanged xml files.
+    Use this directly when you need several pieces of metadata for one session.
+    '''
+    #one stat of the folder instead of a glob per getter, the xml path is memoized on the folder mtime
+    try:
+        mtime_ns = os.stat(directory).st_mtime_ns
+    except OSError:
+        mtime_ns = None #missing folder, get_xml_image reports it
+    xml_file = _cached_xml_image(directory, mtime_ns)
+    if xml_file is None:
+        return None
+    return session_metadata.load(xml_file)
+
+def rebuild_metadata_cache(parent_dir):
+    '''
+    explicit rebuild of the persistent xml metadata cache for every session under parent_dir
+    (normally not needed, stale entries are detected from the xml mtime and size)
+    '''
+    return metadata_cache.rebuild(parent_dir)
+
 def get_sequence_type(directory):
     '''
     #I wrote this function to identify TSeries, ZSeries, TZSeries
@@ -59,60 +92,33 @@ def get_sequence_type(directory):
     #<Sequence type="TSeries Timed Element"
     #<Sequence type="TSeries ZSeries Element"
     '''
-    #get list of xml files
-    xml_file = get_xml_image(directory)
-    if xml_file is None:
+    meta = get_session_metadata(directory)
+    if meta is None:
         return
-    # Parse the XML file
-    tree = ET.parse(xml_file)
-    # Get the root of the XML document
-    root = tree.getroot()
-    # Iterate over all 'Sequence' elements in the document
-    for sequence in root.iter('Sequence'):
-        # If the 'type' attribute exists, return its value
-        if 'type' in sequence.attrib:
-            return sequence.attrib['type']
+    return meta.sequence_type
 
 def report_sequence_type(directory):
-    seq_type = get_sequence_type(directory)
-    if seq_type is not None:
-        if "TSeries" in seq_type and "ZSeries" not in seq_type:
-            return 'T'
-        if "ZSeries" in seq_type and "TSeries" not in seq_type:
-            return 'Z'
-        if "TSeries" in seq_type and "ZSeries" in seq_type:
-            return 'TZ'
+    meta = get_session_metadata(directory)
+    if meta is not None:
+        return meta.seq_code
 
 def get_max_Z_index(directory):
     '''
     Parameters
     ----------
-    directory : TYPE
-        DESCRIPTION.
+    directory : str
+        imaging session folder
 
     Returns
     -------
-    max_index : TYPE
-        DESCRIPTION.
+    max_index : int
+        max frame index in the Sequence with cycle='1' (number of z planes for TZSeries)
 
     '''
-    xml_file = get_xml_image(directory)
-    if xml_file is None:
+    meta = get_session_metadata(directory)
+    if meta is None:
         return
-    # Parse the XML file
-    tree = ET.parse(xml_file)
-    root = tree.getroot()
-    # Find the first Sequence element with cycle='1'
-    sequence = root.find(".//Sequence[@cycle='1']")
-    if sequence is not None:
-        # Get all Frame elements within this Sequence
-        frames = sequence.findall('.//Frame')
-        # Extract the index attribute from each Frame, convert to int, and find the max
-        max_index = max(int(frame.get('index')) for frame in frames)
-        return max_index
-    else:
-        print("No Sequence element with cycle='1' found.")
-        return None
+    return meta.max_Z_index
 
 
 def get_avg(directory):
@@ -130,47 +136,16 @@ def get_avg(directory):
     int or None
         The number of averages per scan or None if calculation is not possible.
     '''
-    fp = get_frame_period(directory)
-    # Get list of XML files
-    xml_file = get_xml_image(directory)
-    if xml_file is None:
+    meta = get_session_metadata(directory)
+    if meta is None:
         return None
-    
-    # Parse the XML file
-    tree = ET.parse(xml_file)
-    # Get the root of the XML document
-    root = tree.getroot()
-    
-    relativeTimes = []
-    for frame in root.iter('Frame'):
-        relativeTime = frame.attrib.get('relativeTime')
-        if relativeTime is not None:
-            relativeTimes.append(float(relativeTime))
-        if len(relativeTimes) == 2:  # Take only first two recorded points
-            break
-    # Check if we have at least two time points
-    if len(relativeTimes) < 2:
-        print('Only one frame detected')
-        return None 
-
-    T2_T1 = relativeTimes[1] - relativeTimes[0]  # Time between first two frames
-    avg = round(T2_T1 / fp)
-    return avg
+    return meta.avg
     
 def get_frame_period(directory):
-    #get list of xml files
-    xml_file = get_xml_image(directory)
-    if xml_file is None:
+    meta = get_session_metadata(directory)
+    if meta is None:
         return
-    # Parse the XML file
-    tree = ET.parse(xml_file)
-    # Get the root of the XML document
-    root = tree.getroot()
-    for pv_state_value in root.iter('PVStateValue'):
-        if pv_state_value.attrib.get('key') == 'framePeriod':
-            fp = pv_state_value.attrib.get('value')
-            return float(fp)
-    return None
+    return meta.frame_period
 
 def get_laser_power(directory):
     """
@@ -182,30 +157,10 @@ def get_laser_power(directory):
     Returns:
     float: Laser power or None if not found.
     """
-    xml_file = get_xml_image(directory)
-    if xml_file is None:
-        return None
-    try:
-        # Parse the XML file
-        tree = ET.parse(xml_file)
-        root = tree.getroot()
-        # Iterate through PVStateValue elements to find laser power
-        for pv_state_value in root.iter('PVStateValue'):
-            if pv_state_value.attrib.get('key') == 'laserPower':
-                for indexed_value in pv_state_value.findall('IndexedValue'):
-                    if indexed_value.attrib.get('description') == 'Insight Pockels':
-                        laser_power = float(indexed_value.attrib.get('value', 0))
-                        return laser_power
-        return None
-    except ET.ParseError:
-        print("Error parsing the XML file.")
-        return None
-    except ValueError:
-        print("Error in laser power value.")
-        return None
-    except Exception as e:
-        print(f"An error occurred: {e}")
+    meta = get_session_metadata(directory)
+    if meta is None:
         return None
+    return meta.laser_power
 
 def get_pmt_gain(directory, channel_description):
     """
@@ -218,32 +173,10 @@ def get_pmt_gain(directory, channel_description):
     Returns:
     int: PMT gain for the specified channel or None if not found.
     """
-    xml_file = get_xml_image(directory)
-    if xml_file is None:
-        return None
-
-    try:
-        # Parse the XML file
-        tree = ET.parse(xml_file)
-        root = tree.getroot()
-
-        # Iterate through PVStateValue elements to find pmtGain
-        for pv_state_value in root.iter('PVStateValue'):
-            if pv_state_value.attrib.get('key') == 'pmtGain':
-                for indexed_value in pv_state_value.findall('IndexedValue'):
-                    if indexed_value.attrib.get('description') == channel_description:
-                        pmt_gain = int(indexed_value.attrib.get('value', 0))
-                        return pmt_gain
-        return None
-    except ET.ParseError:
-        print("Error parsing the XML file.")
-        return None
-    except ValueError:
-        print("Error in PMT gain value.")
-        return None
-    except Exception as e:
-        print(f"An error occurred: {e}")
+    meta = get_session_metadata(directory)
+    if meta is None:
         return None
+    return meta.pmt_gain(channel_description)
 
 def get_wavelength(directory):
     """
@@ -255,50 +188,10 @@ def get_wavelength(directory):
     Returns:
     int: Wavelength of the active laser or None if not found.
     """
-    xml_file = get_xml_image(directory)
-    if xml_file is None:
-        return None
-    try:
-        # Parse the XML file
-        tree = ET.parse(xml_file)
-        root = tree.getroot()
-
-        # Dictionary to store laser power
-        laser_power = {}
-        # Dictionary to store laser wavelength
-        laser_wavelength = {}
-
-        # Iterate through PVStateValue elements
-        for pv_state_value in root.iter('PVStateValue'):
-            key = pv_state_value.attrib.get('key')
-            if key == 'laserPower':
-                # Find laser power
-                for indexed_value in pv_state_value.findall('IndexedValue'):
-                    index = indexed_value.attrib.get('index')
-                    value = float(indexed_value.attrib.get('value', 0))
-                    laser_power[index] = value
-            elif key == 'laserWavelength':
-                # Find laser wavelength
-                for indexed_value in pv_state_value.findall('IndexedValue'):
-                    index = indexed_value.attrib.get('index')
-                    value = int(indexed_value.attrib.get('value', 0))
-                    laser_wavelength[index] = value
-
-        # Check which laser is active and return its wavelength
-        for index, power in laser_power.items():
-            if power > 0:  # Non-zero power indicates active laser
-                return laser_wavelength.get(index, None)
-
-        return None
-    except ET.ParseError:
-        print("Error parsing the XML file.")
-        return None
-    except ValueError:
-        print("Error in value format.")
-        return None
-    except Exception as e:
-        print(f"An error occurred: {e}")
+    meta = get_session_metadata(directory)
+    if meta is None:
         return None
+    return meta.wavelength
 
 def get_objective(directory):
     '''
@@ -306,154 +199,53 @@ can use objectiveLens for the naming, of objectiveLensMag for just the number ma
 <PVStateValue key="objectiveLens" value="20x_new"/>
 <PVStateValue key="objectiveLensMag" value="20"/>
     '''
-    xml_file = get_xml_image(directory)
-    if xml_file is None:
+    meta = get_session_metadata(directory)
+    if meta is None:
         return None
-    try:
-        # Parse the XML file
-        tree = ET.parse(xml_file)
-        root = tree.getroot()
-        obj_lens = None
-        obj_mag = None
-        for pv_state_value in root.iter('PVStateValue'):
-            if pv_state_value.attrib.get('key') == 'objectiveLens':
-                obj_lens = pv_state_value.get('value')
-            elif pv_state_value.attrib.get('key') == 'objectiveLensMag':
-                obj_mag = pv_state_value.get('value')
-        return obj_lens #can switch out with objective magnification for numerical value
-    except ET.ParseError:
-        return None  
+    return meta.objective
     
 def get_resolution(directory):
-    xml_file = get_xml_image(directory)
-    if xml_file is None:
+    meta = get_session_metadata(directory)
+    if meta is None:
         return None
-    try:
-        # Parse the XML file
-        tree = ET.parse(xml_file)
-        root = tree.getroot()
-        lines_per_frame = None
-        pixels_per_line = None
-        # Iterate through PVStateValue elements to find laser power
-        for pv_state_value in root.iter('PVStateValue'):
-            if pv_state_value.attrib.get('key') == 'linesPerFrame':
-                lines_per_frame = int(pv_state_value.get('value'))
-            elif pv_state_value.attrib.get('key') == 'pixelsPerLine':
-                pixels_per_line = int(pv_state_value.get('value'))
-        # Check if both values are found
-        if lines_per_frame is not None and pixels_per_line is not None:
-            return [lines_per_frame, pixels_per_line]
-        else:
-            return None
-    except ET.ParseError:
-        return None  
+    return meta.resolution
     
 def get_microns_per_pixel(directory):
     ''' 
     returns microns_per_pixels with unit microns squared
     '''
-    xml_file = get_xml_image(directory)
-    if xml_file is None:
-        return None
-    try:
-        # Parse the XML file
-        tree = ET.parse(xml_file)
-        root = tree.getroot()
-        microns_per_pixel = None
-        x = None
-        y = None
-        for pv_state_value in root.iter('PVStateValue'):
-            if pv_state_value.attrib.get('key')=='micronsPerPixel':
-                for indexed_value in pv_state_value.findall('IndexedValue'):
-                    index = indexed_value.get('index')
-                    value = float(indexed_value.get('value', 0))
-                    if index == 'XAxis':
-                        x = value
-                    elif index == 'YAxis':
-                        y = value
-        if x is not None and y is not None:
-            microns_per_pixel = x*y
-            return microns_per_pixel #return [x,y]
-        else:
-            return None
-    except ET.ParseError:
-        print("Error parsing the XML file.")
+    meta = get_session_metadata(directory)
+    if meta is None:
         return None
-    except ValueError:
-        print("Error in value format.")
-        return None
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        return None    
+    return meta.microns_per_pixel
 
 def get_imaging_session_duration(directory):
     '''
     Extracts the duration of the imaging session from the XML file.
     Parameters:
-    xml_file_path (str): Path to the XML file.
+    directory (str): Path to the directory containing the XML file.
     Returns:
-    float: Duration of the imaging session in seconds.
-    UPDATE FOR TZSERIES, NOT REPORTING PROPERLY
+    float: Duration of the imaging session in seconds (first to last frame, also for TZSeries).
     '''
-        #get list of xml files
-    xml_file = get_xml_image(directory)
-    if xml_file is None:
+    meta = get_session_metadata(directory)
+    if meta is None:
         return
-    try:
-        # Parse the XML file
-        tree = ET.parse(xml_file)
-        # Get the root of the XML document
-        root = tree.getroot()
-        # Find all 'Frame' elements
-        frames = root.findall('.//Frame')
-        if not frames:
-            print("No Frame elements found in the XML file.")
-            return None
-        # Get the last frame
-        last_frame = frames[-1]
-        # Extract the 'relativeTime' attribute
-        duration = float(last_frame.get('relativeTime'))
-        return duration
-    except ET.ParseError:
-        print("Error parsing the XML file.")
-        return None
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        return None
+    return meta.duration
 
 def get_imaging_date(directory):
     """
     Extracts the date from the XML metadata file.
 
     Parameters:
-    xml_file_path (str): Path to the XML file.
+    directory (str): Path to the directory containing the XML file.
 
     Returns:
-    str: Date in the format 'YYYY-MM-DD' or None if the date is not found.
+    str: Date in the format 'YYYY/MM/DD' or None if the date is not found.
     """
-    #get list of xml files
-    xml_file = get_xml_image(directory)
-    if xml_file is None:
+    meta = get_session_metadata(directory)
+    if meta is None:
         return
-    try:
-        # Parse the XML file, ignoring namespaces
-        tree = ET.iterparse(xml_file, events=['start'])
-        for event, elem in tree:
-            if elem.tag.endswith('PVScan'):
-                date_str = elem.attrib.get('date', None)
-                if date_str:
-                    date_parts = date_str.split(' ')[0].split('/')
-                    formatted_date = '/'.join([date_parts[2], date_parts[0], date_parts[1]])
-                    return formatted_date
-    except ET.ParseError:
-        print("Error parsing the XML file.")
-        return None
-    except ValueError:
-        print("Error in date format.")
-        return None
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        return None
+    return meta.date
 
 def check_batch_concat(directory):
     '''
@@ -492,59 +284,41 @@ def record_motion_correct_status(parent_dir):
     the code checks the sequence type and only runs function_ if the seq type is TSeries 
     '''
     results = []
-    for root, dirs, files in os.walk(parent_dir):
-        for dir in dirs:
-            directory = os.path.join(root,dir)            
-            seq_type = get_sequence_type(directory)
-            #maybe add a column to record session type (T(10),Z(01),TZ(11))
-            if seq_type is not None:#sometimes there is no metadata
-                #select ONLY TSeries for batch concat by the process_folder() function
-                if "TSeries" in seq_type and "ZSeries" not in seq_type:
-                    file1_exists, file2_exists, both_exist = check_double_motion_correct(directory)
-                    results.append({
-                        'Directory Path': directory,
-                        'type':'TSeries',
-                        'stab 1.csv Exists': file1_exists,
-                        'stab 2.csv Exists': file2_exists,
-                        'stab 1 and stab 2 Exist': both_exist
-                    })
-                if "ZSeries" in seq_type and "TSeries" not in seq_type:
-                    #z series should not be motion corrected
-                    None
-                if "TSeries" in seq_type and "ZSeries" in seq_type:
-                    file1_exists, file2_exists, both_exist = check_double_motion_correct(directory)
-                    results.append({
-                        'Directory Path': directory,
-                        'type': 'TZSeries',
-                        'stab 1.csv Exists': file1_exists,
-                        'stab 2.csv Exists': file2_exists,
-                        'stab 1 and stab 2 Exist': both_exist
-                    })
+    #one scandir pass over the tree, stab csvs are already classified per session
+    for session in discovery.imaging_sessions(parent_dir):
+        directory = session.directory
+        seq_type = session.sequence_type
+        #maybe add a column to record session type (T(10),Z(01),TZ(11))
+        if seq_type is not None:#sometimes there is no metadata
+            #select ONLY TSeries for batch concat by the process_folder() function
+            if "TSeries" in seq_type and "ZSeries" not in seq_type:
+                file1_exists, file2_exists, both_exist = session.double_motion_corrected
+                results.append({
+                    'Directory Path': directory,
+                    'type':'TSeries',
+                    'stab 1.csv Exists': file1_exists,
+                    'stab 2.csv Exists': file2_exists,
+                    'stab 1 and stab 2 Exist': both_exist
+                })
+            if "ZSeries" in seq_type and "TSeries" not in seq_type:
+                #z series should not be motion corrected
+                None
+            if "TSeries" in seq_type and "ZSeries" in seq_type:
+                file1_exists, file2_exists, both_exist = session.double_motion_corrected
+                results.append({
+                    'Directory Path': directory,
+                    'type': 'TZSeries',
+                    'stab 1.csv Exists': file1_exists,
+                    'stab 2.csv Exists': file2_exists,
+                    'stab 1 and stab 2 Exist': both_exist
+                })
     return pd.DataFrame(results)   
 
 def check_if_single_frame(directory):
-    #copied from get_avg, consolidate functions in future
-    # Get list of XML files
-    xml_file = get_xml_image(directory)
-    if xml_file is None:
+    meta = get_session_metadata(directory)
+    if meta is None:
         return None
-    
-    # Parse the XML file
-    tree = ET.parse(xml_file)
-    # Get the root of the XML document
-    root = tree.getroot()
-    
-    relativeTimes = []
-    for frame in root.iter('Frame'):
-        relativeTime = frame.attrib.get('relativeTime')
-        if relativeTime is not None:
-            relativeTimes.append(float(relativeTime))
-        if len(relativeTimes) == 2:  # Take only first two recorded points
-            return False
-    # Check if we have at least two time points
-    if len(relativeTimes) < 2:
-        print('Only one frame detected')
-        return True 
+    return meta.is_single_frame
 
 #write helper function to record if manual roi selection has been done.
 
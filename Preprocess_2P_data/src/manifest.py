@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 18:05:36 2026
+
+@author: emmaodom
+
+persistent pipeline manifest (sqlite) kept at the dataset root, ie
+/Volumes/T7/Motor_Spines_Pilot_Data/pipeline_manifest.sqlite
+
+for every session and pipeline stage ('batch_concat', 'motion_correction', ...)
+it records the fingerprints of the stage inputs and outputs and when it ran.
+a stage only needs to run again if it never ran, its outputs were changed or removed,
+or its inputs changed. this replaces the filesystem heuristics
+(fewer than 20 tifs = concatenated, stab 1/stab 2 csv exist = motion corrected)
+so nightly runs only touch new or changed sessions.
+
+fingerprints are built from file name, size and mtime (no reads on the slow drive).
+with content=True the first and last 64 KB of each file are also hashed.
+"""
+
+import os
+import json
+import sqlite3
+import hashlib
+import pandas as pd
+from datetime import datetime
+
+MANIFEST_NAME = 'pipeline_manifest.sqlite'
+_CHUNK = 64*1024
+
+def fingerprint(paths, content=False):
+    '''
+    returns a hex digest for a list of files, '' for an empty list.
+    missing files are part of the fingerprint so deleting an output changes it.
+    '''
+    h = hashlib.sha1()
+    for path in sorted(paths):
+        h.update(os.path.basename(path).encode())
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            h.update(b'missing')
+            continue
+        h.update(f'{st.st_size}:{st.st_mtime_ns}'.encode())
+        if content:
+            with open(path, 'rb') as f:
+                h.update(f.read(_CHUNK))
+                if st.st_size > 2*_CHUNK:
+                    f.seek(-_CHUNK, os.SEEK_END)
+                    h.update(f.read(_CHUNK))
+    return h.hexdigest() if paths else ''
+
+class Manifest:
+    '''
+    Parameters
+    ----------
+    dataset_root : str
+        top folder of the dataset, the manifest file is created here and sessions
+        are stored relative to it (so the drive can be mounted at another path)
+    content : bool
+        also hash file contents (head and tail) in the fingerprints
+    '''
+    def __init__(self, dataset_root, content=False):
+        self.dataset_root = dataset_root
+        self.content = content
+        self.path = os.path.join(dataset_root, MANIFEST_NAME)
+        self.con = sqlite3.connect(self.path, timeout=30)
+        with self.con:
+            self.con.execute('''CREATE TABLE IF NOT EXISTS stages (
+                session TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                status TEXT NOT NULL,
+                input_fp TEXT,
+                output_fp TEXT,
+                inputs TEXT,
+                outputs TEXT,
+                started TEXT,
+                finished TEXT,
+                PRIMARY KEY (session, stage))''')
+
+    def _key(self, directory):
+        return os.path.relpath(directory, self.dataset_root)
+
+    def get(self, directory, stage):
+        '''
+        returns the recorded row for (session, stage) as a dict, or None
+        '''
+        cur = self.con.execute('SELECT * FROM stages WHERE session = ? AND stage = ?',
+                               (self._key(directory), stage))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        return dict(zip([c[0] for c in cur.description], row))
+
+    def is_current(self, directory, stage, inputs):
+        '''
+        True if stage already ran on this session and nothing changed since:
+            - the recorded outputs still have the recorded fingerprint
+            - the inputs have the recorded fingerprint. inputs that a stage consumed
+              (ie raw tifs deleted by batch_concat) are not held against it, so an
+              empty inputs list counts as unchanged.
+        '''
+        rec = self.get(directory, stage)
+        if rec is None or rec['status'] != 'done':
+            return False
+        outputs = [os.path.join(directory, f) for f in json.loads(rec['outputs'])]
+        if fingerprint(outputs, self.content) != rec['output_fp']:
+            return False
+        if inputs and fingerprint(inputs, self.content) != rec['input_fp']:
+            return False
+        return True
+
+    def record(self, directory, stage, inputs, outputs, started=None, status='done', input_fp=None):
+        '''
+        stores the result of a stage. inputs/outputs are lists of full paths,
+        outputs should be the files the stage wrote (only those that exist are kept)
+        input_fp: fingerprint of the inputs taken before the stage ran, pass it
+            for stages that delete or modify their inputs
+        '''
+        outputs = [f for f in outputs if os.path.exists(f)]
+        if input_fp is None:
+            input_fp = fingerprint(inputs, self.content)
+        finished = datetime.now().isoformat(timespec='seconds')
+        with self.con:
+            self.con.execute('INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+                self._key(directory), stage, status,
+                input_fp, fingerprint(outputs, self.content),
+                json.dumps([os.path.basename(f) for f in inputs]),
+                #relative to the session, outputs can be in subfolders (ie MoCorr_mean/)
+                json.dumps([os.path.relpath(f, directory) for f in outputs]),
+                started or finished, finished))
+
+    def invalidate(self, directory, stage=None):
+        #forget a stage (or every stage) of a session so it runs again
+        with self.con:
+            if stage is None:
+                self.con.execute('DELETE FROM stages WHERE session = ?', (self._key(directory),))
+            else:
+                self.con.execute('DELETE FROM stages WHERE session = ? AND stage = ?', (self._key(directory), stage))
+
+    def to_dataframe(self):
+        #one row per (session, stage), inputs/outputs are left as json strings
+        return pd.read_sql_query('SELECT * FROM stages ORDER BY session, stage', self.con)
+
+    def close(self):
+        self.con.close()
+
+def now():
+    #timestamp format used for 'started'
+    return datetime.now().isoformat(timespec='seconds')
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 13:40:27 2026
+
+@author: emmaodom
+
+persistent sqlite cache of the fields extracted from each session xml.
+an entry is keyed by the full xml path and is only used if the file's mtime and
+size still match what was recorded, otherwise the xml is parsed again and the
+entry is replaced. this lets summarize / record_motion_correct_status /
+batch_motion_correction rerun over the T7 drive without re-reading every xml.
+
+the cache lives on the LOCAL disk (not the data drive). set the environment variable
+PREPROCESS_2P_CACHE to use a different file.
+
+rebuild from terminal (run from Preprocess_2P_data):
+    python -m src.metadata_cache rebuild /Volumes/T7/Motor_Spines_Pilot_Data
+    python -m src.metadata_cache clear
+"""
+
+import os
+import sys
+import json
+import sqlite3
+import threading
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'preprocess_2P', 'metadata_cache.sqlite')
+CACHE_VERSION = 2 #bump if the record layout of SessionMetadata.to_record changes
+
+class MetadataCache:
+    '''
+    Parameters
+    ----------
+    cache_path : str
+        path to the sqlite file, created (with parent dirs) if it does not exist
+    '''
+    def __init__(self, cache_path=None):
+        if cache_path is None:
+            cache_path = os.environ.get('PREPROCESS_2P_CACHE', DEFAULT_CACHE_PATH)
+        self.cache_path = cache_path
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        #one connection per thread, sqlite connections can not be shared across threads
+        self._local = threading.local()
+        with self._connect() as con:
+            con.execute('''CREATE TABLE IF NOT EXISTS xml_metadata (
+                xml_path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                version INTEGER NOT NULL,
+                record TEXT NOT NULL)''')
+
+    def _connect(self):
+        con = getattr(self._local, 'con', None)
+        if con is None:
+            con = sqlite3.connect(self.cache_path, timeout=30)
+            self._local.con = con
+        return con
+
+    def get(self, xml_path, mtime_ns, size):
+        '''
+        returns the cached record dict, or None if missing or stale (mtime/size changed)
+        '''
+        try:
+            row = self._connect().execute(
+                'SELECT mtime_ns, size, version, record FROM xml_metadata WHERE xml_path = ?',
+                (xml_path,)).fetchone()
+        except sqlite3.Error as e:
+            print(f"Metadata cache read failed: {e}")
+            return None
+        if row is None:
+            return None
+        if row[0] != mtime_ns or row[1] != size or row[2] != CACHE_VERSION:
+            return None
+        return json.loads(row[3])
+
+    def put(self, xml_path, mtime_ns, size, record):
+        try:
+            with self._connect() as con:
+                con.execute('INSERT OR REPLACE INTO xml_metadata VALUES (?, ?, ?, ?, ?)',
+                            (xml_path, mtime_ns, size, CACHE_VERSION, json.dumps(record)))
+        except sqlite3.Error as e:
+            print(f"Metadata cache write failed: {e}")
+
+    def invalidate(self, xml_path):
+        with self._connect() as con:
+            con.execute('DELETE FROM xml_metadata WHERE xml_path = ?', (xml_path,))
+
+    def clear(self):
+        with self._connect() as con:
+            con.execute('DELETE FROM xml_metadata')
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM xml_metadata').fetchone()[0]
+
+_cache = None
+
+def get_cache():
+    #module level cache shared by helper_functions / session_metadata
+    global _cache
+    if _cache is None:
+        _cache = MetadataCache()
+    return _cache
+
+def rebuild(parent_dir):
+    '''
+    re-parses every session xml under parent_dir (header and frame table) and overwrites
+    its cache entry, regardless of whether mtime/size changed. returns number of xml files cached.
+    '''
+    from src import discovery
+    from src import session_metadata
+    cache = get_cache()
+    session_metadata._load.cache_clear()
+    n = 0
+    #one threaded scan of the tree, the xml of every session is picked like hf.get_xml_image
+    for session in discovery.imaging_sessions(parent_dir):
+        cache.invalidate(session.xml)
+        meta = session_metadata.load(session.xml)
+        if meta is None:
+            continue
+        #load() only reads the header, the frame table is what makes the entry complete
+        #(frame count, duration, avg, frame period) and is stored by the timing parse
+        meta.timing
+        n += 1
+    print(f"Metadata cache rebuilt for {n} sessions: {cache.cache_path}")
+    return n
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 3 and sys.argv[1] == 'rebuild':
+        rebuild(sys.argv[2])
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'clear':
+        get_cache().clear()
+        print(f"Metadata cache cleared: {get_cache().cache_path}")
+    else:
+        print("usage: python -m src.metadata_cache rebuild <parent_dir> | clear")
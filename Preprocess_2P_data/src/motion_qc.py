@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 23 16:20:44 2026
+
+@author: emmaodom
+
+motion correction qc metrics (numpy + pandas only). src/registration.py computes them in
+the same pass as the shifts and writes them with write_qc:
+    f"{stack}_motion_qc.csv"   per frame net shift, shift change and correlation to the reference
+    motion_qc_summary.csv      one session row with 'qc_flags' (QC_THRESHOLDS that were crossed)
+summarize.py and batch_motion_correct.py only read the summary (read_qc_summary), so they
+do not need to import the registration engine.
+"""
+
+import os
+import logging
+import numpy as np
+import pandas as pd
+
+#motion qc: a session is flagged when any of these is crossed (starting points, tune on the data)
+QC_THRESHOLDS = {
+    'min_mean_corr': 0.5, #mean correlation of the corrected frames to the reference
+    'min_frame_corr_p5': 0.3, #5th percentile of that correlation (bursts of bad frames)
+    'max_shift': 25.0, #largest net shift (pixels)
+    'max_shift_derivative_p99': 5.0, #99th percentile of the frame to frame shift change (pixels)
+    'min_crispness_gain': 0.95, #crispness after / before correction (~1, or a bit below from interpolation, without motion)
+    'crispness_min_shift': 1.0, #the crispness gain is only checked if the largest net shift (pixels) is above this
+    }
+
+def frame_correlation(block, shifts, ref_image, roi):
+    '''
+    pearson correlation of every frame's roi, at its (rounded) corrected position,
+    with the roi of the reference image. vectorized over the block
+    '''
+    y0, x0, h, w = roi
+    height, width = block.shape[1:]
+    r = np.rint(shifts).astype(int)
+    ys = np.clip(y0 - r[:, 0], 0, height - h)
+    xs = np.clip(x0 - r[:, 1], 0, width - w)
+    crops = np.stack([frame[y:y + h, x:x + w] for frame, y, x in zip(block, ys, xs)])
+    crops = crops - crops.mean(axis=(1, 2), keepdims=True)
+    ref = ref_image[y0:y0 + h, x0:x0 + w]
+    ref = ref - ref.mean()
+    denom = np.sqrt((crops*crops).sum(axis=(1, 2)) * (ref*ref).sum())
+    return np.where(denom > 0, (crops*ref).sum(axis=(1, 2)) / np.where(denom > 0, denom, 1), 0.0)
+
+def crispness(image, roi=None):
+    #frobenius norm of the gradient magnitude of a (mean) image, higher = sharper
+    if roi is not None:
+        y0, x0, h, w = roi
+        image = image[y0:y0 + h, x0:x0 + w]
+    gy, gx = np.gradient(np.asarray(image, dtype=np.float64))
+    return float(np.sqrt((gy*gy + gx*gx).sum()))
+
+def qc_table(shifts, frame_corr):
+    '''
+    per frame motion qc: net shift, its magnitude, frame to frame change and the
+    correlation to the reference. frames are 1 based like the stab tables
+    '''
+    shifts = np.asarray(shifts)
+    magnitude = np.hypot(shifts[:, 0], shifts[:, 1])
+    derivative = np.r_[0.0, np.hypot(*np.diff(shifts, axis=0).T)]
+    return pd.DataFrame({'frame': np.arange(1, len(shifts) + 1),
+                         'dy': shifts[:, 0], 'dx': shifts[:, 1],
+                         'shift': magnitude, 'shift_derivative': derivative,
+                         'corr_to_ref': frame_corr}).astype({'dy': np.float32, 'dx': np.float32, 'shift': np.float32,
+                                                              'shift_derivative': np.float32, 'corr_to_ref': np.float32})
+
+def qc_summary(tables, crispness_before, crispness_after, thresholds=QC_THRESHOLDS):
+    '''
+    one row of session qc from the per frame table(s) (several for the planes of a TZSeries,
+    the worst plane counts) and the mean image crispness before / after correction
+
+    Returns
+    -------
+    summary : dict
+        metrics and 'qc_flags' (the thresholds that were crossed, ';' separated, '' if none)
+    '''
+    tables = tables if isinstance(tables, list) else [tables]
+    gains = np.asarray(crispness_after, dtype=float) / np.maximum(np.asarray(crispness_before, dtype=float), 1e-12)
+    summary = {
+        'n_frames': int(sum(len(t) for t in tables)),
+        'mean_corr': float(min(t['corr_to_ref'].mean() for t in tables)),
+        'frame_corr_p5': float(min(t['corr_to_ref'].quantile(0.05) for t in tables)),
+        'max_shift': float(max(t['shift'].max() for t in tables)),
+        'shift_derivative_p99': float(max(t['shift_derivative'].quantile(0.99) for t in tables)),
+        'crispness_before': float(np.min(crispness_before)),
+        'crispness_after': float(np.min(crispness_after)),
+        'crispness_gain': float(np.min(gains)),
+        }
+    flags = []
+    if summary['mean_corr'] < thresholds['min_mean_corr']:
+        flags.append('low_mean_corr')
+    if summary['frame_corr_p5'] < thresholds['min_frame_corr_p5']:
+        flags.append('bad_frames')
+    if summary['max_shift'] > thresholds['max_shift']:
+        flags.append('large_shift')
+    if summary['shift_derivative_p99'] > thresholds['max_shift_derivative_p99']:
+        flags.append('fast_motion')
+    #a still session can not get sharper, only sessions that actually moved are judged on the gain
+    if summary['crispness_gain'] < thresholds['min_crispness_gain'] and summary['max_shift'] > thresholds['crispness_min_shift']:
+        flags.append('not_sharper')
+    summary['qc_flags'] = ';'.join(flags)
+    return summary
+
+QC_SUMMARY_NAME = 'motion_qc_summary.csv'
+
+def write_qc(directory, name, result_tables, crispness_before, crispness_after, qc_dir=None):
+    '''
+    writes the per frame table(s) f"{name}_motion_qc.csv" (into qc_dir, default the session)
+    and the one row session summary motion_qc_summary.csv, returns (paths, summary)
+    '''
+    qc_dir = qc_dir if qc_dir is not None else directory
+    tables = result_tables if isinstance(result_tables, dict) else {name: result_tables}
+    paths = []
+    for table_name, table in tables.items():
+        path = os.path.join(qc_dir, f"{table_name}_motion_qc.csv")
+        table.to_csv(path, index=False, float_format='%.4g')
+        paths.append(path)
+    summary = qc_summary(list(tables.values()), crispness_before, crispness_after)
+    summary_path = os.path.join(directory, QC_SUMMARY_NAME)
+    pd.DataFrame([summary]).to_csv(summary_path, index=False)
+    paths.append(summary_path)
+    if summary['qc_flags']:
+        logging.warning(f"motion qc flagged {directory}: {summary['qc_flags']}")
+    return paths, summary
+
+def read_qc_summary(directory):
+    #motion_qc_summary.csv of a session as a dict, None if motion qc has not run
+    path = os.path.join(directory, QC_SUMMARY_NAME)
+    if not os.path.exists(path):
+        return None
+    row = pd.read_csv(path, keep_default_na=False).iloc[0].to_dict()
+    return row
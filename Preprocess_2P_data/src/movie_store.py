@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 20 10:18:45 2026
+
+@author: emmaodom
+
+chunked, compressed movie store (zarr) as an alternative to the BigTIFF stacks.
+the concat stage can write each stack as a (T, Y, X) chunked array inside
+    {session}/{dir_name}.zarr/Ch2            (TSeries / ZSeries)
+    {session}/{dir_name}.zarr/000001/Ch2     (TZSeries, one array per z plane)
+so any time window or crop can be read without loading the whole movie, and chunks
+can be read / written in parallel.
+
+open_movie(session) is the one reader used downstream. it returns an array-like that
+supports numpy slicing, from the zarr store if there is one, otherwise from the
+concatenated tif (memory mapped if uncompressed), or lazily from the raw frames
+(src/virtual_stack.py) when the session has not been concatenated.
+
+zarr is optional: pip install zarr. without it only the tif stacks can be opened.
+"""
+
+import os
+import re
+import glob
+import logging
+import numpy as np
+import tifffile
+from concurrent.futures import ThreadPoolExecutor
+
+from src import concat_engine
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+def _require_zarr():
+    if zarr is None:
+        raise ImportError("the zarr movie store needs the zarr package (pip install zarr)")
+
+def store_path(directory):
+    #{session}/{dir_name}.zarr
+    return os.path.join(directory, os.path.basename(os.path.normpath(directory)) + '.zarr')
+
+def dataset_key(channel='Ch2', plane=None):
+    #'Ch2' or '000003/Ch2'
+    if plane is None:
+        return channel
+    return f"{str(plane).zfill(6)}/{channel}"
+
+def key_from_stack_name(directory, out_name):
+    '''
+    maps a concat output name to its dataset key:
+    f"{dir_name}-Ch1.tif" -> 'Ch1', f"{dir_name}-{ID}-Ch2.tif" -> '{ID}/Ch2'
+    '''
+    dir_name = os.path.basename(os.path.normpath(directory))
+    stem = out_name[len(dir_name):] if out_name.startswith(dir_name) else out_name
+    parts = [p for p in stem.replace('.tif', '').split('-') if p]
+    return '/'.join(parts)
+
+def write_zarr_stack(file_list, directory, key, chunk_frames=64, chunk_yx=(256, 256), max_workers=4):
+    '''
+    writes single frame tifs (in frame order) into one chunked zarr array
+
+    Parameters
+    ----------
+    file_list : list of str
+        single frame tifs in frame order
+    directory : str
+        session folder, the store is {directory}/{dir_name}.zarr
+    key : str
+        dataset inside the store ie 'Ch2' or '000001/Ch2'
+    chunk_frames, chunk_yx : int, (int, int)
+        chunk shape is (chunk_frames, Y, X). spatial chunks let a crop be read
+        without decoding the full frames
+    max_workers : int
+        chunk-aligned blocks of frames are read and written on this many threads
+        (each thread owns whole chunks, so there is no write contention)
+
+    Returns
+    -------
+    path : str
+        path of the written array
+    '''
+    _require_zarr()
+    n = len(file_list)
+    frame_shape, dtype = concat_engine.get_frame_info(file_list[0])
+    frame_shape = tuple(frame_shape)
+    chunks = (chunk_frames, min(chunk_yx[0], frame_shape[0]), min(chunk_yx[1], frame_shape[1]))
+    path = os.path.join(store_path(directory), key)
+    arr = zarr.open_array(store=path, mode='w', shape=(n,) + frame_shape, chunks=chunks, dtype=dtype)
+
+    def _write_block(start):
+        stop = min(start + chunk_frames, n)
+        block = np.empty((stop - start,) + frame_shape, dtype=dtype)
+        for i in range(start, stop):
+            concat_engine._read_frame(file_list[i], frame_shape, out=block[i - start])
+        arr[start:stop] = block
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for _ in pool.map(_write_block, range(0, n, chunk_frames)):
+            pass
+    logging.info(f"Saved {path} ({n} frames)")
+    print(f"Saved {path}")
+    return path
+
+def find_stack(directory, channel='Ch2', plane=None):
+    #concatenated tif written by batch_concat, None if missing
+    dir_name = os.path.basename(os.path.normpath(directory))
+    name = f"{dir_name}-{channel}.tif" if plane is None else f"{dir_name}-{str(plane).zfill(6)}-{channel}.tif"
+    path = os.path.join(directory, name)
+    if os.path.exists(path):
+        return path
+    #fall back to any stack of this channel (ie renamed sessions)
+    matches = sorted(glob.glob(os.path.join(glob.escape(directory), f"*-{channel}.tif")))
+    return matches[0] if (matches and plane is None) else None
+
+def find_planes(session, channel='Ch2'):
+    '''
+    z plane IDs (1 based) of a TZSeries that have a movie for channel: per plane tif
+    stacks, zarr arrays, or (not concatenated yet) raw frames. empty list if none
+    '''
+    directory = getattr(session, 'directory', session)
+    plane_stack = re.compile(r'-(\d{6})-' + re.escape(channel) + r'\.tif$')
+    planes = set()
+    for name in os.listdir(directory):
+        match = plane_stack.search(name)
+        if match:
+            planes.add(int(match.group(1)))
+    store = store_path(directory)
+    if os.path.isdir(store):
+        planes.update(int(p) for p in os.listdir(store)
+                      if p.isdigit() and os.path.isdir(os.path.join(store, p, channel)))
+    if not planes:
+        from src import frame_index, discovery
+        if not hasattr(session, 'raw_tifs'):
+            session = discovery.classify_files(directory, os.listdir(directory))
+        planes.update(frame_index.FrameIndex(session.channel_files(channel)).planes)
+    return sorted(planes)
+
+def open_movie(session, channel='Ch2', plane=None, mode='r'):
+    '''
+    opens the movie of one channel (and plane) of a session for random access
+
+    Parameters
+    ----------
+    session : str or discovery.Session
+        session folder
+    channel : str
+        'Ch1' or 'Ch2'
+    plane : int
+        z plane (1 based, the 6 digit ID) for TZSeries, None otherwise
+    mode : str
+        'r' read only, 'r+' to modify in place (zarr / uncompressed tif only)
+
+    Returns
+    -------
+    movie : zarr.Array or np.memmap or np.ndarray or virtual_stack view, shape (T, Y, X)
+        slicing (movie[t0:t1, y0:y1, x0:x1]) only reads the chunks / pages / frames it needs,
+        except for compressed tifs when zarr is not installed (read fully into memory)
+    '''
+    directory = getattr(session, 'directory', session)
+    key = dataset_key(channel, plane)
+    path = os.path.join(store_path(directory), key)
+    if zarr is not None and os.path.isdir(path):
+        return zarr.open_array(store=path, mode=mode)
+    tif_path = find_stack(directory, channel, plane)
+    if tif_path is None:
+        #not concatenated (yet): read the raw PrairieView frames in place
+        from src import virtual_stack, discovery
+        if not hasattr(session, 'raw_tifs'):
+            session = discovery.classify_files(directory, os.listdir(directory))
+        if session.channel_files(channel):
+            return virtual_stack.VirtualStack.from_session(session).movie(channel, plane)
+        raise FileNotFoundError(f"No {key} movie in {directory}")
+    return open_tif(tif_path, mode)
+
+def open_tif(tif_path, mode='r'):
+    '''
+    (T, Y, X) tif stack for random access: memory mapped if uncompressed, otherwise
+    decoded lazily through zarr if it is installed, else read into memory
+    '''
+    try:
+        return tifffile.memmap(tif_path, mode=mode)
+    except ValueError:
+        #compressed or not contiguous: decode lazily through zarr if possible
+        if zarr is not None:
+            return zarr.open(tifffile.imread(tif_path, aszarr=True), mode='r')
+        return tifffile.imread(tif_path)
@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 24 10:12:05 2026
+
+@author: emmaodom
+
+online motion correction and trace extraction while PrairieView is still acquiring.
+the session folder is polled for new single frame '*_Cycle#####_Ch2_######.ome.tif'
+files, and every new frame is
+    - registered to a running reference (phase correlation, same spectra as
+      src/registration.py, the reference spectrum is cached and refreshed every
+      ref_update frames from the running mean)
+    - added to the running mean of the corrected frames
+    - measured in every ROI (mean grey value, like Multi Measure, with the sparse ROI
+      weights of src/traces.py)
+so a bad field of view or slow drift shows up during the session, not hours later in
+the batch. the per frame latency (file seen -> traces updated) is recorded and
+compared to the frame period from the xml.
+
+PrairieView writes every frame in place, so a frame is only used once tifffile finds
+all of its pixel data on disk, with the frame shape of the session. a partly written
+file is left for the next poll (and so is everything after it, to keep the order).
+file sizes are not compared: the first frame of a session carries the full OME-XML and
+is larger than the rest.
+
+    online = OnlineSession(directory, roi_zip_path='.../RoiSet.zip')   # or masks=
+    online.run(idle_timeout=10)   # returns when no new frame arrived for 10 s
+    online.save()
+
+replay_session copies a recorded session into another folder at the acquisition rate,
+to test the online mode without the rig:
+    thread = replay_session(recorded_dir, tmp_dir, background=True)
+    OnlineSession(tmp_dir).run(idle_timeout=5)
+"""
+
+import os
+import time
+import shutil
+import logging
+import threading
+import numpy as np
+import pandas as pd
+import tifffile
+
+from src import registration
+from src import traces
+from src.frame_index import FRAME_NAME
+
+def _frame_key(name):
+    #(cycle, channel, plane) of a PrairieView frame name, None for other files
+    match = FRAME_NAME.search(name)
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2)), int(match.group(3))
+
+class _PartialFrameFilter(logging.Filter):
+    #drops tifffile's errors about a frame that is still being written, only on the thread reading it
+    def __init__(self):
+        super().__init__()
+        self.local = threading.local()
+
+    def filter(self, record):
+        return not getattr(self.local, 'reading', False)
+
+_partial_frames = _PartialFrameFilter()
+logging.getLogger('tifffile').addFilter(_partial_frames)
+
+def _read_frame(path, shape=None):
+    '''
+    pixels of a single frame file. ValueError (tifffile's errors are ValueErrors too)
+    while the frame is still being written: pixel data past the end of the file, or a
+    first page that is not (yet) shape
+    '''
+    _partial_frames.local.reading = True
+    try:
+        size = os.path.getsize(path)
+        with tifffile.TiffFile(path, is_ome=False) as tif:
+            page = tif.pages[0]
+            if max(o + n for o, n in zip(page.dataoffsets, page.databytecounts)) > size:
+                raise ValueError(f"{os.path.basename(path)} is incomplete")
+            if shape is not None and tuple(page.shape) != tuple(shape):
+                raise ValueError(f"{os.path.basename(path)} has shape {page.shape}, expected {shape}")
+            return page.asarray()
+    finally:
+        _partial_frames.local.reading = False
+
+class OnlineSession:
+    '''
+    Parameters
+    ----------
+    directory : str
+        session folder PrairieView is writing into
+    channel : str
+        channel that is registered and measured, ie 'Ch2'
+    plane : int
+        6 digit plane ID (1 based) to follow in a TZSeries, None for a TSeries
+    masks : np.ndarray (n_rois, Y, X) bool, optional
+        ROI masks; the traces are the mean grey value inside every mask
+    roi_names : list of str, optional
+        column names of the traces (default 0..n_rois-1)
+    roi_zip_path : str, optional
+        RoiSet.zip (ie drawn on the mean of an earlier session of the same dendrite),
+        rasterized when the first frame arrives; used instead of masks
+    ref_frames : int
+        the first ref_frames frames are averaged (registered to the first one) into
+        the starting reference, the macro uses slice 10
+    ref_update : int
+        the reference is replaced by the running corrected mean every ref_update frames
+    subpixel : bool
+        subpixel shifts
+    roi_fraction : float
+        matched window, central fraction of the field of view
+    frame_period : float
+        seconds between frames, read from the xml (times the averages) when None
+
+    Attributes
+    ----------
+    shifts : list of (dy, dx)
+    traces : list of np.ndarray (n_rois,)
+    latency : list of float, seconds per frame from file seen to traces updated
+    mean : running mean image of the corrected frames (property)
+    '''
+    def __init__(self, directory, channel='Ch2', plane=None, masks=None, roi_names=None, roi_zip_path=None,
+                 ref_frames=10, ref_update=50, subpixel=False, roi_fraction=0.8, frame_period=None):
+        self.directory = directory
+        self.channel = int(channel.replace('Ch', '')) if isinstance(channel, str) else int(channel)
+        self.plane = plane
+        self.ref_frames = max(int(ref_frames), 1)
+        self.ref_update = ref_update
+        self.subpixel = subpixel
+        self.roi_fraction = roi_fraction
+        self.frame_period = frame_period if frame_period is not None else self._frame_period()
+        self.set_masks(masks, roi_names)
+        self._rois = traces.read_rois(roi_zip_path) if roi_zip_path is not None else None
+        self.files = []
+        self.shifts = []
+        self.traces = []
+        self.latency = []
+        self._seen = set()
+        self._first_seen = {}
+        self._sum = None
+        self._ref_stack = []
+        self._ref_spectrum = None
+        self._roi = None
+        self._window = None
+        self._shape = None
+        self._buffer = None
+
+    def _frame_period(self):
+        #frame period * averages, same sampling rate as plot_dFF.get_dFF; None without an xml
+        from src import helper_functions as hf
+        try:
+            frame_period = hf.get_frame_period(self.directory)
+            avg = hf.get_avg(self.directory) or 1
+        except Exception as e:
+            print(f"Could not read the frame period of {self.directory}: {e}")
+            return None
+        if frame_period is None:
+            return None
+        return frame_period * avg
+
+    def set_masks(self, masks, roi_names=None):
+        '''
+        (n_rois, Y, X) masks -> sparse ROI weights, so a trace update is one sparse
+        matrix x frame product
+        '''
+        self.weights = None
+        self.roi_names = []
+        if masks is None:
+            return
+        self.weights = traces.mask_weights(masks)
+        self.roi_names = list(roi_names) if roi_names is not None else list(range(self.weights.shape[0]))
+
+    @property
+    def n_frames(self):
+        return len(self.shifts)
+
+    @property
+    def mean(self):
+        if self._sum is None or self.n_frames == 0:
+            return None
+        return (self._sum / self.n_frames).astype(np.float32)
+
+    def poll(self):
+        '''
+        new frame files of the channel / plane, in acquisition order
+        '''
+        candidates = []
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.name in self._seen or entry.name.startswith('.'):
+                        continue
+                    key = _frame_key(entry.name)
+                    if key is None or key[1] != self.channel:
+                        continue
+                    if self.plane is not None and key[2] != self.plane:
+                        continue
+                    candidates.append((key, entry.name))
+        except OSError as e:
+            print(f"Could not list {self.directory}: {e}")
+            return []
+        candidates.sort()
+        now = time.perf_counter()
+        for _, name in candidates:
+            self._first_seen.setdefault(name, now)
+        return [name for _, name in candidates]
+
+    def process(self, name):
+        '''
+        registers one frame file, updates the running mean and the traces.
+        returns False if the file could not be read yet (retried on the next poll)
+        '''
+        path = os.path.join(self.directory, name)
+        try:
+            #every frame after the first must have its shape
+            frame = _read_frame(path, self._buffer.shape if self._buffer is not None else None)
+        except (OSError, ValueError, IndexError) as e:
+            logging.debug(f"{name} not readable yet: {e}")
+            return False
+        if self._sum is None:
+            self._start(frame.shape)
+        spec = registration.spectrum(frame, self._roi, self._window)
+        if self._ref_spectrum is None:
+            dy, dx = 0.0, 0.0
+        else:
+            dy, dx = registration.phase_correlate(spec, self._ref_spectrum, self._shape, self.subpixel)
+        corrected = registration.shift_frame(frame, dy, dx, out=self._buffer)
+        self._sum += corrected
+        if self.weights is not None:
+            self.traces.append(traces.measure(self.weights, corrected))
+        self.shifts.append((dy, dx))
+        self.files.append(name)
+        self._seen.add(name)
+        self._update_reference(frame, corrected)
+        self.latency.append(time.perf_counter() - self._first_seen.pop(name))
+        return True
+
+    def _start(self, frame_shape):
+        self._roi = registration.central_roi(frame_shape, self.roi_fraction)
+        self._window = registration._window(self._roi)
+        self._shape = registration.fft_shape(self._roi)
+        self._sum = np.zeros(frame_shape)
+        self._buffer = np.zeros(frame_shape, dtype=np.float32)
+        if self._rois:
+            self.weights, self.roi_names = traces.roi_weights(self._rois, frame_shape)
+
+    def _update_reference(self, frame, corrected):
+        n = self.n_frames
+        if n == 1:
+            #first frame is the reference until ref_frames are in
+            self._set_reference(frame)
+        if n <= self.ref_frames:
+            self._ref_stack.append(corrected.copy())
+            if n == self.ref_frames:
+                self._set_reference(np.mean(self._ref_stack, axis=0))
+                self._ref_stack = []
+        elif self.ref_update and n % self.ref_update == 0:
+            self._set_reference(self._sum / n)
+
+    def _set_reference(self, image):
+        self._ref_spectrum = registration.spectrum(image, self._roi, self._window)
+
+    def step(self):
+        #one poll + processing of everything that is ready, returns the number of new frames
+        count = 0
+        for name in self.poll():
+            if not self.process(name):
+                break
+            count += 1
+        return count
+
+    def run(self, idle_timeout=10.0, poll_interval=None, max_frames=None, stop_event=None):
+        '''
+        follows the folder until no new frame arrived for idle_timeout seconds,
+        max_frames frames are done, or stop_event (threading.Event) is set
+
+        Returns
+        -------
+        n_frames : int
+            frames processed so far
+        '''
+        if poll_interval is None:
+            poll_interval = min(self.frame_period / 2, 0.05) if self.frame_period else 0.05
+        last_frame = time.perf_counter()
+        while True:
+            if self.step():
+                last_frame = time.perf_counter()
+            elif time.perf_counter() - last_frame > idle_timeout:
+                break
+            if max_frames is not None and self.n_frames >= max_frames:
+                break
+            if stop_event is not None and stop_event.is_set():
+                self.step()
+                break
+            time.sleep(poll_interval)
+        late = self.late_frames()
+        if late:
+            logging.warning(f"{self.directory}: {late} of {self.n_frames} frames took longer than the frame period")
+        return self.n_frames
+
+    def late_frames(self):
+        #number of frames whose latency was above the frame period
+        if self.frame_period is None:
+            return 0
+        return int(np.sum(np.asarray(self.latency) > self.frame_period))
+
+    def shift_table(self):
+        #(n_frames, 2) net (dy, dx) of every frame
+        return np.asarray(self.shifts, dtype=float).reshape(-1, 2)
+
+    def trace_table(self):
+        #traces as a DataFrame, one column per ROI, one row per frame (Multi Measure layout)
+        return pd.DataFrame(np.asarray(self.traces).reshape(len(self.traces), len(self.roi_names)),
+                            columns=self.roi_names)
+
+    def save(self, out_dir=None):
+        '''
+        writes online_shifts.csv (ImageJ Results layout like stab 1/2), online_mean.tif,
+        online_traces.csv and online_latency.csv into out_dir (default the session folder)
+
+        Returns
+        -------
+        outputs : list of str
+        '''
+        out_dir = out_dir if out_dir is not None else self.directory
+        os.makedirs(out_dir, exist_ok=True)
+        outputs = [os.path.join(out_dir, 'online_shifts.csv')]
+        registration.write_shift_table(outputs[0], self.shift_table())
+        if self.mean is not None:
+            outputs.append(os.path.join(out_dir, 'online_mean.tif'))
+            tifffile.imwrite(outputs[-1], self.mean)
+        if self.weights is not None:
+            outputs.append(os.path.join(out_dir, 'online_traces.csv'))
+            traces.write_traces(outputs[-1], np.asarray(self.traces), self.roi_names)
+        outputs.append(os.path.join(out_dir, 'online_latency.csv'))
+        pd.DataFrame({'file': self.files, 'latency': self.latency}).to_csv(outputs[-1], index=False)
+        return outputs
+
+def replay_session(source_dir, target_dir, frame_period=None, speed=1.0, background=False):
+    '''
+    copies the xml and the raw frames of a recorded session into target_dir, one
+    frame every frame_period / speed seconds in acquisition order (all channels of a
+    cycle / plane together), to test OnlineSession without the rig
+
+    Parameters
+    ----------
+    source_dir : str
+        recorded session folder with its raw '*.ome.tif' frames
+    target_dir : str
+        folder to write into (created), ie a tempfile.mkdtemp()
+    frame_period : float
+        seconds between frames, read from the source xml (times the averages) when None
+    speed : float
+        replay speed factor (2 = twice as fast as the acquisition)
+    background : bool
+        replay on a thread and return it (started) instead of blocking
+
+    Returns
+    -------
+    thread : threading.Thread if background, else the number of frames copied
+    '''
+    if background:
+        thread = threading.Thread(target=replay_session, args=(source_dir, target_dir, frame_period, speed),
+                                  daemon=True)
+        thread.start()
+        return thread
+    os.makedirs(target_dir, exist_ok=True)
+    names = os.listdir(source_dir)
+    for name in names:
+        if name.endswith('.xml') and not name.startswith('.'):
+            shutil.copyfile(os.path.join(source_dir, name), os.path.join(target_dir, name))
+    if frame_period is None:
+        frame_period = OnlineSession(target_dir, frame_period=None).frame_period or 0.0
+    frames = []
+    for name in names:
+        key = _frame_key(name)
+        if key is not None and not name.startswith('.'):
+            frames.append((key[0], key[2], key[1], name))
+    frames.sort()
+    interval = frame_period / speed
+    start = time.perf_counter()
+    time_point = None
+    n = 0
+    for cycle, plane, channel, name in frames:
+        if (cycle, plane) != time_point:
+            #wait for the acquisition time of the next frame
+            if time_point is not None:
+                n += 1
+            time_point = (cycle, plane)
+            delay = start + n*interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        shutil.copyfile(os.path.join(source_dir, name), os.path.join(target_dir, name))
+    return len(frames)
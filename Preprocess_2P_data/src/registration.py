@@ -0,0 +1,829 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Oct 21 09:42:17 2026
+
+@author: emmaodom
+
+rigid motion correction in python (numpy + scipy.fft phase correlation), same
+two pass scheme as macros/motion_correct_single_TSeries.ijm without starting Fiji:
+    pass 1: every frame is registered to reference slice 10
+    pass 2: every frame is registered to the mean of the pass 1 corrected movie
+both passes match on the central 80% of the field of view (same window as the
+macro's getAutomaticROI). the shifts are written as ImageJ Results tables
+    'stab 1_refSlice_10.csv' and 'stab 2.csv'  (columns ' ', Slice, dX, dY)
+so hf.check_double_motion_correct, the manifest and apply_motion_correction.ijm
+work unchanged. dX / dY are the translation to apply to the slice, and stab 2 holds
+the residual shift after stab 1 (apply stab 1 then stab 2, like the macro).
+the average projections before and after correction are saved like the macro too.
+runs headless, so it works on the linux compute nodes.
+frames are registered in blocks: one batched rfft2 per block (scipy.fft workers), partially
+whitened cross power (see WHITENING) against the cached reference spectrum, vectorized
+argmax + parabolic subpixel peak, while the next block is read on a background thread. the block size follows a
+memory budget.
+apply_motion_correction replaces apply_motion_correction.ijm: the stab tables are
+composed into one net shift per frame and applied blockwise (bicubic or fourier shift)
+while streaming the corrected stack to disk.
+motion_correct_piecewise adds a piecewise rigid step (overlapping patches registered
+in one batched fft, smooth displacement field, one remap per frame) for the local
+warping along long dendrites that a rigid shift leaves behind.
+motion_correct_TZSeries replaces mo_corr_TZ_to_Zstack.ijm: the z planes are registered in
+parallel processes and the motion corrected mean Z stack is built from the same pass.
+"""
+
+import os
+import glob
+import logging
+import numpy as np
+import pandas as pd
+import tifffile
+from scipy import fft, ndimage
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+from src import movie_store
+from src.motion_qc import (QC_THRESHOLDS, QC_SUMMARY_NAME, frame_correlation, crispness, qc_table,
+                           qc_summary, write_qc, read_qc_summary)
+
+def central_roi(frame_shape, fraction=0.8):
+    '''
+    (y0, x0, height, width) of the centered rectangle covering fraction of the
+    field of view, same rounding as getAutomaticROI in the macro
+    '''
+    height, width = frame_shape
+    roi_h = int(np.floor(height * fraction))
+    roi_w = int(np.floor(width * fraction))
+    return (int(np.floor((height - roi_h) / 2)), int(np.floor((width - roi_w) / 2)), roi_h, roi_w)
+
+#exponent p of the partial whitening of the cross power spectrum (cross / |cross|**p).
+#p = 1 (pure phase correlation) flattens every frequency, so on sparse images (few
+#spines on a dark background, hann windowed) the near empty high frequencies get the
+#same weight as the spines and integer shifts come out +-1 px toward 0. on 256 px
+#frames of gaussian blobs (sigma 1.5 - 6 px, +-3 and +-12 px motion, with and without
+#poisson noise) p = 0.7 got every integer shift right where p = 1 got up to 105 of 120
+#components wrong (test_scripts/check_registration_sparse.py), and on smooth textures
+#its subpixel error was ~0.15 px against ~1 px for p = 1. a border only (tukey) taper
+#instead of the hann window was worse at every p
+WHITENING = 0.7
+
+def _window(roi):
+    #hann taper so the crop borders do not dominate the correlation
+    return np.outer(np.hanning(roi[2]), np.hanning(roi[3])).astype(np.float32)
+
+def fft_shape(roi):
+    #roi shape zero padded to fast fft sizes (ie 409 -> 432), the window already tapers to 0
+    return (fft.next_fast_len(roi[2], real=True), fft.next_fast_len(roi[3], real=True))
+
+def block_spectra(block, roi, window, workers=-1):
+    '''
+    real fft of the windowed, mean subtracted roi of every frame of a (B, Y, X) block,
+    one batched transform over the block on `workers` threads (-1 = all cores),
+    padded to fft_shape(roi)
+    '''
+    y0, x0, h, w = roi
+    crop = np.asarray(block[..., y0:y0 + h, x0:x0 + w], dtype=np.float32)
+    crop = (crop - crop.mean(axis=(-2, -1), keepdims=True)) * window
+    return fft.rfft2(crop, s=fft_shape(roi), workers=workers)
+
+def spectrum(frame, roi, window):
+    #block_spectra of a single (Y, X) frame
+    return block_spectra(frame, roi, window)
+
+def _subpixel_offset(c_minus, c_0, c_plus):
+    #vertex of the parabola through 3 correlation values, vectorized
+    denom = c_minus - 2*c_0 + c_plus
+    safe = np.where(denom == 0, 1, denom)
+    return np.where(denom == 0, 0.0, 0.5 * (c_minus - c_plus) / safe)
+
+def phase_correlate_block(spectra, ref_spectrum, roi_shape, subpixel=False, workers=-1, max_shift=None, whitening=None):
+    '''
+    shifts (dy, dx) that move every frame of a block onto the reference
+
+    Parameters
+    ----------
+    spectra : complex np.ndarray (B, h, w//2 + 1) or (B, P, h, w//2 + 1)
+        block_spectra() of the frames (or of P patches per frame)
+    ref_spectrum : complex np.ndarray (h, w//2 + 1) or (P, h, w//2 + 1)
+        spectrum() of the reference (patches), computed once per pass
+    roi_shape : (int, int)
+        fft_shape(roi) of the roi the spectra were computed on
+    subpixel : bool
+        refine the correlation peaks with a parabola fit (else whole pixel shifts,
+        like subpixel=false in the macro)
+    max_shift : int
+        only peaks within +- max_shift pixels are considered (None = anywhere)
+    whitening : float
+        exponent p of cross / |cross|**p, None = WHITENING (0 = plain cross correlation,
+        1 = pure phase correlation)
+
+    Returns
+    -------
+    shifts : np.ndarray (B, 2) or (B, P, 2)
+    '''
+    h, w = roi_shape
+    cross = ref_spectrum * np.conj(spectra)
+    lead_shape = cross.shape[:-2] #ie (B,) or (B, n_patches) with one reference per patch
+    cross = cross.reshape((-1,) + cross.shape[-2:])
+    whitening = WHITENING if whitening is None else whitening
+    if whitening:
+        cross /= np.abs(cross)**whitening + 1e-12
+    corr = fft.irfft2(cross, s=roi_shape, workers=workers)
+    b = np.arange(corr.shape[0])
+    search = corr
+    if max_shift is not None:
+        search = corr.copy()
+        search[:, np.minimum(np.arange(h), h - np.arange(h)) > max_shift, :] = -np.inf
+        search[:, :, np.minimum(np.arange(w), w - np.arange(w)) > max_shift] = -np.inf
+    py, px = np.unravel_index(np.argmax(search.reshape(len(b), -1), axis=1), roi_shape)
+    dy, dx = py.astype(float), px.astype(float)
+    if subpixel:
+        c_0 = corr[b, py, px]
+        dy += _subpixel_offset(corr[b, (py - 1) % h, px], c_0, corr[b, (py + 1) % h, px])
+        dx += _subpixel_offset(corr[b, py, (px - 1) % w], c_0, corr[b, py, (px + 1) % w])
+    #peaks past the middle are negative shifts
+    dy[dy > h // 2] -= h
+    dx[dx > w // 2] -= w
+    return np.stack([dy, dx], axis=1).reshape(lead_shape + (2,))
+
+def phase_correlate(frame_spectrum, ref_spectrum, roi_shape, subpixel=False, whitening=None):
+    #phase_correlate_block of a single frame, returns (dy, dx)
+    dy, dx = phase_correlate_block(frame_spectrum[None], ref_spectrum, roi_shape, subpixel, whitening=whitening)[0]
+    return dy, dx
+
+def shift_frame(frame, dy, dx, out=None):
+    '''
+    translates a frame by (dy, dx), uncovered pixels are 0 (same as ImageJ Translate).
+    whole pixel shifts are a copy, subpixel shifts use cubic spline interpolation
+    '''
+    frame = np.asarray(frame, dtype=np.float32)
+    if out is None:
+        out = np.zeros_like(frame)
+    else:
+        out[:] = 0
+    if dy == int(dy) and dx == int(dx):
+        dy, dx = int(dy), int(dx)
+        h, w = frame.shape
+        out[max(dy, 0):h + min(dy, 0), max(dx, 0):w + min(dx, 0)] = \
+            frame[max(-dy, 0):h + min(-dy, 0), max(-dx, 0):w + min(-dx, 0)]
+        return out
+    ndimage.shift(frame, (dy, dx), output=out, order=3, mode='constant', cval=0.0)
+    return out
+
+def _shifted_sum(block, shifts, workers=-1):
+    '''
+    sum of the block frames after translation by shifts. whole pixel shifts are summed
+    by slicing (zero fill), subpixel shifts with one batched fourier shift (wraps at the
+    borders, fine for a mean reference)
+    '''
+    if np.all(shifts == np.round(shifts)):
+        total = np.zeros(block.shape[1:])
+        shifted = np.empty(block.shape[1:], dtype=np.float32)
+        for frame, (dy, dx) in zip(block, shifts):
+            total += shift_frame(frame, dy, dx, out=shifted)
+        return total
+    h, w = block.shape[1:]
+    ky = fft.fftfreq(h)[None, :, None]
+    kx = fft.rfftfreq(w)[None, None, :]
+    ramp = np.exp(-2j*np.pi*(ky*shifts[:, 0, None, None] + kx*shifts[:, 1, None, None]))
+    spectra = fft.rfft2(block, workers=workers) * ramp
+    return fft.irfft2(spectra.sum(axis=0), s=(h, w), workers=workers)
+
+def block_size(frame_shape, roi, memory_budget=2**30, max_block=4096):
+    '''
+    frames per block so the working arrays of one block fit in memory_budget bytes:
+    float32 frames + their full frame spectra (subpixel mean) + complex64 roi spectra
+    and cross power + float32 correlation
+    '''
+    frame_bytes = frame_shape[0]*frame_shape[1]*(4 + 8)
+    roi_bytes = roi[2]*(roi[3]//2 + 1)*(8 + 8 + 8) + roi[2]*roi[3]*(4 + 4)
+    #x2 for the block being read in the background while the current one is registered
+    return int(max(1, min(max_block, memory_budget // (2*(frame_bytes + roi_bytes)))))
+
+def _iter_blocks(movie, n_block, reader):
+    '''
+    yields (start, float32 block) over the movie; the next block is read on a
+    background thread while the caller works on the current one
+    '''
+    n = len(movie)
+    read = lambda start: np.asarray(movie[start:min(start + n_block, n)], dtype=np.float32)
+    future = reader.submit(read, 0)
+    for start in range(0, n, n_block):
+        block = future.result()
+        if start + n_block < n:
+            future = reader.submit(read, start + n_block)
+        yield start, block
+
+def downsample(block, factor):
+    #sum of factor x factor pixel bins (strided adds), rows / columns that do not fill a bin are dropped
+    h, w = block.shape[-2:]
+    h, w = h // factor * factor, w // factor * factor
+    binned = np.zeros(block.shape[:-2] + (h // factor, w // factor), dtype=np.float32)
+    for dy in range(factor):
+        for dx in range(factor):
+            binned += block[..., dy:h:factor, dx:w:factor]
+    return binned
+
+def registration_mode(resolution):
+    '''
+    registration settings for a frame size ([lines, pixels] from hf.get_resolution):
+    full resolution up to 512 px, 2x pyramid from 1024 px, 4x pyramid from 2048 px
+    '''
+    if resolution is None or max(resolution) < 1024:
+        return {'mode': 'full'}
+    return {'mode': 'pyramid', 'factor': 4 if max(resolution) >= 2048 else 2}
+
+class _Reference:
+    '''
+    a registration reference with its spectra computed once, shifts(block) registers
+    a (B, Y, X) float32 block against it
+
+    mode 'full': phase correlation over the whole central roi at full resolution.
+    mode 'pyramid': coarse shifts on factor x factor binned frames (roi fft factor**2
+    smaller), then a full resolution refinement on a central patch (patch x patch) of the
+    roi, searched only +- refine_radius pixels around the coarse shift.
+    '''
+    def __init__(self, ref_frame, roi_fraction=0.8, subpixel=False, workers=-1, mode='full',
+                 factor=2, refine_radius=None, patch=256):
+        ref_frame = np.asarray(ref_frame, dtype=np.float32)
+        self.mode = mode
+        self.subpixel = subpixel
+        self.workers = workers
+        self.roi = central_roi(ref_frame.shape, roi_fraction)
+        if mode == 'pyramid':
+            self.factor = factor
+            y0, x0, h, w = self.roi
+            #only the roi is binned, the coarse window is the whole binned roi
+            self.coarse_roi = (0, 0, h // factor, w // factor)
+            self.coarse_window = _window(self.coarse_roi)
+            self.coarse_shape = fft_shape(self.coarse_roi)
+            self.coarse_spectrum = spectrum(self._coarse(ref_frame), self.coarse_roi, self.coarse_window)
+            ph, pw = min(h, patch), min(w, patch)
+            self.patch = (y0 + (h - ph) // 2, x0 + (w - pw) // 2, ph, pw)
+            #the binned estimate is off by at most ~factor pixels
+            self.refine_radius = refine_radius if refine_radius is not None else 2*factor
+            self.window = _window(self.patch)
+            self.shape = fft_shape(self.patch)
+            self.spectrum = spectrum(ref_frame, self.patch, self.window)
+        else:
+            self.window = _window(self.roi)
+            self.shape = fft_shape(self.roi)
+            self.spectrum = spectrum(ref_frame, self.roi, self.window)
+
+    def _coarse(self, frames):
+        y0, x0, h, w = self.roi
+        return downsample(frames[..., y0:y0 + h, x0:x0 + w], self.factor)
+
+    def shifts(self, block):
+        if self.mode != 'pyramid':
+            return phase_correlate_block(block_spectra(block, self.roi, self.window, self.workers),
+                                         self.spectrum, self.shape, self.subpixel, self.workers)
+        guess = phase_correlate_block(block_spectra(self._coarse(block), self.coarse_roi, self.coarse_window, self.workers),
+                                      self.coarse_spectrum, self.coarse_shape, False, self.workers)
+        guess = np.rint(guess * self.factor).astype(int)
+        #the frame patch that lands on the reference patch after the coarse shift
+        y0, x0, ph, pw = self.patch
+        height, width = block.shape[1:]
+        ys = np.clip(y0 - guess[:, 0], 0, height - ph)
+        xs = np.clip(x0 - guess[:, 1], 0, width - pw)
+        patches = np.stack([frame[y:y + ph, x:x + pw] for frame, y, x in zip(block, ys, xs)])
+        residual = phase_correlate_block(block_spectra(patches, (0, 0, ph, pw), self.window, self.workers),
+                                         self.spectrum, self.shape, self.subpixel, self.workers,
+                                         max_shift=self.refine_radius)
+        return np.stack([y0 - ys, x0 - xs], axis=1) + residual
+
+def register_movie(movie, ref_slice=10, subpixel=False, roi_fraction=0.8, memory_budget=2**30, workers=-1,
+                   mode='full', factor=2, refine_radius=None):
+    '''
+    two pass rigid registration of a (T, Y, X) movie, in blocks of frames
+
+    Parameters
+    ----------
+    movie : array-like (T, Y, X)
+        np.memmap, zarr array or VirtualStack view, read one block at a time
+    ref_slice : int
+        1 based reference slice of pass 1 (the macro uses 10)
+    subpixel : bool
+        subpixel shifts
+    roi_fraction : float
+        matched window, central fraction of the field of view
+    memory_budget : int
+        bytes the block buffers may use; sets the number of frames per block
+    workers : int
+        scipy.fft threads for the batched transforms (-1 = all cores)
+    mode : 'full' or 'pyramid'
+        'full' correlates the whole 80% window at full resolution, the reference behaviour.
+        'pyramid' (coarse to fine) estimates the shift on factor x factor binned frames and
+        refines it at full resolution on a central 256 x 256 patch within +- refine_radius px.
+        speed: the coarse fft is factor**2 smaller and the refinement is a fixed 256 px
+        patch, so shift estimation on 512 x 1024 frames is ~2x faster at factor 2 and ~3x
+        at factor 4 (the gain grows with frame size; reading the movie and the mean are
+        unchanged). shifts up to ~40% of the window are still found, like full mode.
+        accuracy: the final shift comes from the full resolution patch; on test movies
+        with +-30 px motion it stayed within ~0.01 px rms of full mode (subpixel). it is
+        less robust on very dim / sparse frames, where the patch holds little signal
+        (use mode='full' there).
+        see registration_mode for the per session choice from the frame size
+    factor, refine_radius : int
+        pyramid mode only: binning factor (2 or 4), refinement search radius in full
+        resolution pixels (default 2*factor)
+
+    Returns
+    -------
+    result : dict
+        'shifts1', 'shifts2' -> (T, 2) arrays of (dy, dx) for stab 1 / stab 2,
+        'initial_mean', 'corrected_mean' -> (Y, X) float32 average projections,
+        'roi' -> (y0, x0, h, w),
+        'qc' -> per frame qc_table (net shift, its derivative, correlation to the pass 2
+        reference), 'crispness_before', 'crispness_after' -> crispness of the mean images
+    '''
+    n = len(movie)
+    frame_shape = tuple(movie.shape[1:])
+    settings = dict(roi_fraction=roi_fraction, subpixel=subpixel, workers=workers, mode=mode,
+                    factor=factor, refine_radius=refine_radius)
+    ref_index = min(max(ref_slice, 1), n) - 1
+    reference = _Reference(movie[ref_index], **settings)
+    n_block = block_size(frame_shape, reference.roi, memory_budget)
+    shifts1 = np.zeros((n, 2))
+    shifts2 = np.zeros((n, 2))
+    initial_sum = np.zeros(frame_shape)
+    pass1_sum = np.zeros(frame_shape)
+    corrected_sum = np.zeros(frame_shape)
+    frame_corr = np.zeros(n)
+    with ThreadPoolExecutor(max_workers=1) as reader:
+        #pass 1: shifts to the reference slice, and the mean of the corrected movie for pass 2
+        for start, block in _iter_blocks(movie, n_block, reader):
+            stop = start + len(block)
+            initial_sum += block.sum(axis=0)
+            shifts1[start:stop] = reference.shifts(block)
+            pass1_sum += _shifted_sum(block, shifts1[start:stop], workers)
+        #pass 2: the raw frames are matched to the pass 1 mean, stab 2 keeps what pass 1 missed
+        reference = _Reference(pass1_sum / n, **settings)
+        for start, block in _iter_blocks(movie, n_block, reader):
+            stop = start + len(block)
+            total = reference.shifts(block)
+            shifts2[start:stop] = total - shifts1[start:stop]
+            corrected_sum += _shifted_sum(block, total, workers)
+            frame_corr[start:stop] = frame_correlation(block, total, pass1_sum / n, reference.roi)
+    initial_mean = (initial_sum / n).astype(np.float32)
+    corrected_mean = (corrected_sum / n).astype(np.float32)
+    return {'shifts1': shifts1, 'shifts2': shifts2, 'roi': reference.roi,
+            'initial_mean': initial_mean, 'corrected_mean': corrected_mean,
+            'qc': qc_table(shifts1 + shifts2, frame_corr),
+            'crispness_before': crispness(initial_mean, reference.roi),
+            'crispness_after': crispness(corrected_mean, reference.roi)}
+
+def write_shift_table(path, shifts):
+    '''
+    saves (T, 2) (dy, dx) shifts as an ImageJ Results csv: ' ', Slice, dX, dY
+    (1 based rows, what saveAs("Results") writes for Align slices in stack)
+    '''
+    shifts = np.asarray(shifts)
+    slices = np.arange(1, len(shifts) + 1)
+    table = pd.DataFrame({' ': slices, 'Slice': slices, 'dX': shifts[:, 1], 'dY': shifts[:, 0]})
+    if np.all(shifts == np.round(shifts)):
+        table[['dX', 'dY']] = table[['dX', 'dY']].astype(int)
+    table.to_csv(path, index=False, float_format='%.3f')
+    return path
+
+def read_shift_table(path):
+    '''
+    reads a stab csv (written by Fiji or write_shift_table) into a (T, 2) array of
+    (dy, dx) indexed by slice - 1. missing / NaN shifts are 0 like in apply_motion_correction.ijm
+    '''
+    table = pd.read_csv(path)
+    table.columns = [c.strip() for c in table.columns]
+    n = int(table['Slice'].max())
+    shifts = np.zeros((n, 2))
+    rows = table['Slice'].values.astype(int) - 1
+    shifts[rows, 0] = table['dY'].fillna(0).values
+    shifts[rows, 1] = table['dX'].fillna(0).values
+    return shifts
+
+def motion_correct_TSeries(file_path, ref_slice=10, subpixel=False, roi_fraction=0.8, memory_budget=2**30, workers=-1,
+                          mode='auto'):
+    '''
+    python replacement for motion_correct_single_TSeries.ijm: registers the stack and
+    writes 'stab 1_refSlice_{ref_slice}.csv', 'stab 2.csv' and the initial / post correction
+    average projections next to it
+
+    Parameters
+    ----------
+    file_path : str
+        full path to the (Ch2) tif stack of a TSeries
+    ref_slice, subpixel, roi_fraction, memory_budget, workers :
+        see register_movie
+    the motion qc from the same pass is saved as f"{stack}_motion_qc.csv" (per frame)
+    and motion_qc_summary.csv (session row with qc_flags), see qc_summary
+    mode : 'auto', 'full' or 'pyramid'
+        'auto' picks full or pyramid registration from the session's resolution
+        (hf.get_resolution), see registration_mode
+
+    Returns
+    -------
+    outputs : list of str
+        the two stab csvs
+    '''
+    directory = os.path.dirname(file_path)
+    images_name = os.path.basename(file_path)
+    print("Opening: " + images_name)
+    movie = movie_store.open_tif(file_path)
+    if mode == 'auto':
+        from src import helper_functions as hf #not at the top: the TZ plane worker processes do not need it
+        resolution = hf.get_resolution(directory)
+        settings = registration_mode(resolution if resolution is not None else movie.shape[1:])
+    else:
+        settings = {'mode': mode}
+    result = register_movie(movie, ref_slice, subpixel, roi_fraction, memory_budget, workers, **settings)
+    del movie
+    tifffile.imwrite(os.path.join(directory, images_name + "_initial_z_projection.tif"), result['initial_mean'])
+    tifffile.imwrite(os.path.join(directory, images_name + "_post_correction_z_projection.tif"), result['corrected_mean'])
+    outputs = [write_shift_table(os.path.join(directory, f"stab 1_refSlice_{ref_slice}.csv"), result['shifts1']),
+               write_shift_table(os.path.join(directory, "stab 2.csv"), result['shifts2'])]
+    write_qc(directory, images_name, result['qc'], result['crispness_before'], result['crispness_after'])
+    logging.info(f"Motion correction complete for {images_name}")
+    print("Motion correction complete for " + images_name)
+    return outputs
+
+def net_shifts(stab_paths, n_frames=None):
+    '''
+    composes stab tables (applied one after the other, ie [stab 1, stab 2]) into one
+    (T, 2) net (dy, dx) shift per frame. two translations compose to their sum
+    '''
+    tables = [read_shift_table(path) for path in stab_paths]
+    n = n_frames if n_frames is not None else max(len(t) for t in tables)
+    shifts = np.zeros((n, 2))
+    for table in tables:
+        m = min(n, len(table))
+        shifts[:m] += table[:m]
+    return shifts
+
+def _keys_weights(t):
+    #catmull-rom cubic convolution (a = -0.5, ImageJ's bicubic) weights of samples -1, 0, 1, 2 at fraction t
+    t2, t3 = t*t, t*t*t
+    return (-0.5*t3 + t2 - 0.5*t,
+            1.5*t3 - 2.5*t2 + 1,
+            -1.5*t3 + 2*t2 + 0.5*t,
+            0.5*t3 - 0.5*t2)
+
+def _integer_shift(a, n, axis, out):
+    #out = a translated by whole pixels n along axis (0, 1), zero fill
+    out[:] = 0
+    size = a.shape[axis]
+    if abs(n) >= size:
+        return out
+    src = [slice(None)]*2
+    dst = [slice(None)]*2
+    src[axis] = slice(max(-n, 0), size + min(-n, 0))
+    dst[axis] = slice(max(n, 0), size + min(n, 0))
+    out[tuple(dst)] = a[tuple(src)]
+    return out
+
+def _cubic_shift_axis(a, s, axis, tmp):
+    '''
+    separable bicubic translation of a 2D frame by s pixels along one axis:
+    out(x) = a(x - s) from the 4 neighbouring samples, outside the frame is 0
+    '''
+    n = int(np.floor(s))
+    f = s - n
+    if f == 0:
+        return _integer_shift(a, n, axis, np.empty_like(a))
+    #a(x - n - f) = a(base + t) with base = x - n - 1, t = 1 - f
+    out = np.zeros_like(a)
+    for k, weight in zip((-1, 0, 1, 2), _keys_weights(1 - f)):
+        out += weight * _integer_shift(a, n + 1 - k, axis, tmp)
+    return out
+
+def _apply_block_bicubic(block, shifts):
+    out = np.empty_like(block)
+    tmp = np.empty(block.shape[1:], dtype=block.dtype)
+    for i, (dy, dx) in enumerate(shifts):
+        out[i] = _cubic_shift_axis(_cubic_shift_axis(block[i], dy, 0, tmp), dx, 1, tmp)
+    return out
+
+def _apply_block_fourier(block, shifts, workers=-1):
+    #one batched fourier shift for the block, then the uncovered borders are zeroed like Translate
+    h, w = block.shape[1:]
+    ky = fft.fftfreq(h)[None, :, None]
+    kx = fft.rfftfreq(w)[None, None, :]
+    ramp = np.exp(-2j*np.pi*(ky*shifts[:, 0, None, None] + kx*shifts[:, 1, None, None]))
+    out = fft.irfft2(fft.rfft2(block, workers=workers) * ramp, s=(h, w), workers=workers).astype(np.float32)
+    for frame, (dy, dx) in zip(out, np.ceil(np.abs(shifts)).astype(int) * np.sign(shifts).astype(int)):
+        if dy > 0:
+            frame[:dy] = 0
+        elif dy < 0:
+            frame[dy:] = 0
+        if dx > 0:
+            frame[:, :dx] = 0
+        elif dx < 0:
+            frame[:, dx:] = 0
+    return out
+
+def _to_dtype(block, dtype):
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        return np.clip(np.rint(block), info.min, info.max).astype(dtype)
+    return block.astype(dtype)
+
+def apply_shifts(movie, shifts, out, method='bicubic', memory_budget=2**30, workers=-1):
+    '''
+    writes movie translated by shifts into out, block by block in one streaming pass
+
+    Parameters
+    ----------
+    movie : array-like (T, Y, X)
+        input movie (memmap, zarr, VirtualStack view)
+    shifts : np.ndarray (T, 2)
+        net (dy, dx) per frame, ie net_shifts([stab 1, stab 2])
+    out : array-like (T, Y, X)
+        output, ie a tifffile.memmap; values are rounded / clipped to its dtype
+    method : 'bicubic' or 'fourier'
+        'bicubic': separable cubic convolution, same kernel as ImageJ Translate (bicubic).
+        'fourier': exact band limited shift with one batched fft per block
+    '''
+    frame_shape = tuple(movie.shape[1:])
+    n_block = block_size(frame_shape, central_roi(frame_shape), memory_budget)
+    with ThreadPoolExecutor(max_workers=1) as reader:
+        for start, block in _iter_blocks(movie, n_block, reader):
+            stop = start + len(block)
+            if method == 'fourier':
+                corrected = _apply_block_fourier(block, shifts[start:stop], workers)
+            else:
+                corrected = _apply_block_bicubic(block, shifts[start:stop])
+            out[start:stop] = _to_dtype(corrected, out.dtype)
+            if hasattr(out, 'flush'):
+                out.flush()
+    return out
+
+def apply_motion_correction(file_path, stab_paths=None, out_path=None, method='bicubic', memory_budget=2**30, workers=-1):
+    '''
+    python replacement for apply_motion_correction.ijm: composes the stab tables of the
+    stack into one shift per frame and writes the corrected stack in a single pass
+    (one interpolation, one read and one write of the data)
+
+    Parameters
+    ----------
+    file_path : str
+        full path to the tif stack to correct
+    stab_paths : list of str
+        stab tables in the order they were computed. default: 'stab 1*.csv' then
+        'stab 2*.csv' found next to the stack
+    out_path : str
+        corrected stack, default f"{file_path}_motion_corrected.tif" (uncompressed BigTIFF)
+    method, memory_budget, workers :
+        see apply_shifts
+
+    Returns
+    -------
+    out_path : str, or None if there are no stab tables
+    '''
+    directory = os.path.dirname(file_path)
+    if stab_paths is None:
+        stab_paths = (sorted(glob.glob(os.path.join(glob.escape(directory), '*stab 1*.csv')))[:1]
+                      + sorted(glob.glob(os.path.join(glob.escape(directory), '*stab 2*.csv')))[:1])
+    if not stab_paths:
+        print(f"No stab csvs for {file_path}")
+        return None
+    if out_path is None:
+        out_path = file_path + "_motion_corrected.tif"
+    movie = movie_store.open_tif(file_path)
+    shifts = net_shifts(stab_paths, len(movie))
+    out = tifffile.memmap(out_path, shape=movie.shape, dtype=movie.dtype,
+                          bigtiff=True, photometric='minisblack', metadata={'axes': 'TYX'})
+    try:
+        apply_shifts(movie, shifts, out, method, memory_budget, workers)
+    finally:
+        del out, movie
+    logging.info(f"Saved {out_path}")
+    print(f"Saved {out_path}")
+    return out_path
+
+def patch_grid(frame_shape, patch=128, overlap=0.5):
+    '''
+    top left corners (ys, xs) and centers (cy, cx) of overlapping patch x patch tiles
+    covering the frame; the last tile of each axis is aligned to the frame edge
+    '''
+    grid = []
+    for size in frame_shape:
+        p = min(patch, size)
+        step = max(1, int(p * (1 - overlap)))
+        starts = list(range(0, size - p + 1, step))
+        if starts[-1] != size - p:
+            starts.append(size - p)
+        grid.append(np.asarray(starts))
+    ys, xs = grid
+    p_y, p_x = min(patch, frame_shape[0]), min(patch, frame_shape[1])
+    return ys, xs, ys + (p_y - 1) / 2, xs + (p_x - 1) / 2
+
+def _patches(block, ys, xs, p_y, p_x):
+    #(B, ny*nx, p_y, p_x) stack of the tiles of every frame
+    return np.stack([block[:, y:y + p_y, x:x + p_x] for y in ys for x in xs], axis=1)
+
+def _interp_matrix(size, centers):
+    #(size, n) linear interpolation weights from the patch centers to every pixel, clamped at the edges
+    eye = np.eye(len(centers))
+    return np.stack([np.interp(np.arange(size), centers, eye[k]) for k in range(len(centers))], axis=1).astype(np.float32)
+
+def displacement_field(patch_shifts, ry, rx):
+    '''
+    (B, ny, nx, 2) patch shifts -> (B, Y, X) dy and dx fields, interpolated between
+    the patch centers with the matrices from _interp_matrix (two matrix products)
+    '''
+    dy = ry @ patch_shifts[..., 0].astype(np.float32) @ rx.T
+    dx = ry @ patch_shifts[..., 1].astype(np.float32) @ rx.T
+    return dy, dx
+
+def remap_block(block, dy, dx):
+    '''
+    out(y, x) = frame(y - dy(y, x), x - dx(y, x)) for every frame of a block, bilinear,
+    vectorized over the block. samples from outside the frame are 0 (like Translate)
+    '''
+    n, h, w = block.shape
+    yy = np.arange(h, dtype=np.float32)[None, :, None] - dy
+    xx = np.arange(w, dtype=np.float32)[None, None, :] - dx
+    #a sample is inside the frame if it lies within [0, h-1] x [0, w-1] (a small tolerance for
+    #the float error of the displacement field keeps the last row / column)
+    valid = (yy > -1e-3) & (yy < h - 1 + 1e-3) & (xx > -1e-3) & (xx < w - 1 + 1e-3)
+    #the top left corner of the 2x2 neighbourhood stays inside, so the last row / column is
+    #read with a weight of 1 on the far neighbour
+    y0 = np.clip(np.floor(yy), 0, h - 2).astype(np.int64)
+    x0 = np.clip(np.floor(xx), 0, w - 2).astype(np.int64)
+    fy = np.clip(yy - y0, 0, 1)
+    fx = np.clip(xx - x0, 0, 1)
+    index = (y0 * w + x0).reshape(n, -1)
+    flat = block.reshape(n, -1)
+    take = lambda offset: np.take_along_axis(flat, index + offset, axis=1).reshape(n, h, w)
+    out = (take(0) * (1 - fy) * (1 - fx) + take(1) * (1 - fy) * fx
+           + take(w) * fy * (1 - fx) + take(w + 1) * fy * fx)
+    out[~valid] = 0
+    return out
+
+def register_piecewise(movie, rigid_shifts, out, patch=128, overlap=0.5, max_shift=10, subpixel=True,
+                       memory_budget=2**30, workers=-1):
+    '''
+    piecewise rigid correction on top of the rigid shifts: the field of view is split into
+    overlapping patches, every patch of every frame is registered (one batched fft over
+    all patches of a block, on `workers` threads) against the same patch of the rigidly
+    corrected mean, the patch shifts are interpolated into a smooth displacement field and
+    each raw frame is remapped once with rigid + local displacement. one streaming pass
+    for estimation and correction after one pass for the reference mean.
+
+    Parameters
+    ----------
+    movie : array-like (T, Y, X)
+        raw movie
+    rigid_shifts : np.ndarray (T, 2)
+        net rigid (dy, dx) per frame, ie net_shifts([stab 1, stab 2])
+    out : array-like (T, Y, X)
+        corrected output (ie tifffile.memmap), values rounded / clipped to its dtype
+    patch, overlap : int, float
+        patch size in pixels and fraction of overlap between neighbouring patches
+    max_shift : int
+        largest local shift (pixels) searched per patch after rigid correction
+    subpixel : bool
+        subpixel patch shifts
+    memory_budget : int
+        bytes for the block buffers (the remap needs ~12 float arrays of the block)
+
+    Returns
+    -------
+    result : dict
+        'patch_shifts' -> (T, ny, nx, 2) local (dy, dx) per patch, 'centers_y', 'centers_x'
+    '''
+    n = len(movie)
+    frame_shape = tuple(movie.shape[1:])
+    ys, xs, cy, cx = patch_grid(frame_shape, patch, overlap)
+    p_y, p_x = min(patch, frame_shape[0]), min(patch, frame_shape[1])
+    ry, rx = _interp_matrix(frame_shape[0], cy), _interp_matrix(frame_shape[1], cx)
+    n_block = int(max(1, min(1024, memory_budget // (frame_shape[0]*frame_shape[1]*4*14))))
+    window = _window((0, 0, p_y, p_x))
+    shape = fft_shape((0, 0, p_y, p_x))
+    patch_shifts = np.zeros((n, len(ys), len(xs), 2), dtype=np.float32)
+    with ThreadPoolExecutor(max_workers=1) as reader:
+        #reference: mean of the rigidly corrected movie
+        total = np.zeros(frame_shape)
+        for start, block in _iter_blocks(movie, n_block, reader):
+            total += _shifted_sum(block, rigid_shifts[start:start + len(block)], workers)
+        ref = (total / n).astype(np.float32)
+        ref_spectra = block_spectra(_patches(ref[None], ys, xs, p_y, p_x)[0], (0, 0, p_y, p_x), window, workers)
+        for start, block in _iter_blocks(movie, n_block, reader):
+            stop = start + len(block)
+            rigid = rigid_shifts[start:stop].astype(np.float32)
+            corrected = remap_block(block, np.broadcast_to(rigid[:, 0, None, None], block.shape),
+                                    np.broadcast_to(rigid[:, 1, None, None], block.shape))
+            spectra = block_spectra(_patches(corrected, ys, xs, p_y, p_x), (0, 0, p_y, p_x), window, workers)
+            local = phase_correlate_block(spectra, ref_spectra, shape, subpixel, workers, max_shift=max_shift)
+            patch_shifts[start:stop] = local.reshape(len(block), len(ys), len(xs), 2)
+            dy, dx = displacement_field(patch_shifts[start:stop], ry, rx)
+            out[start:stop] = _to_dtype(remap_block(block, dy + rigid[:, 0, None, None], dx + rigid[:, 1, None, None]), out.dtype)
+            if hasattr(out, 'flush'):
+                out.flush()
+    return {'patch_shifts': patch_shifts, 'centers_y': cy, 'centers_x': cx}
+
+def motion_correct_piecewise(file_path, patch=128, overlap=0.5, max_shift=10, out_path=None,
+                             memory_budget=2**30, workers=-1):
+    '''
+    piecewise rigid correction of a TSeries stack: uses the rigid stab tables next to the
+    stack (running motion_correct_TSeries first if they are missing) and writes
+        f"{file_path}_piecewise_corrected.tif"   corrected stack (uncompressed BigTIFF)
+        f"{file_path}_piecewise_shifts.npz"      patch_shifts (T, ny, nx, 2), centers_y, centers_x
+
+    Returns
+    -------
+    out_path : str
+    '''
+    directory = os.path.dirname(file_path)
+    stab_paths = (sorted(glob.glob(os.path.join(glob.escape(directory), '*stab 1*.csv')))[:1]
+                  + sorted(glob.glob(os.path.join(glob.escape(directory), '*stab 2*.csv')))[:1])
+    if len(stab_paths) < 2:
+        stab_paths = motion_correct_TSeries(file_path, memory_budget=memory_budget, workers=workers)
+    if out_path is None:
+        out_path = file_path + "_piecewise_corrected.tif"
+    movie = movie_store.open_tif(file_path)
+    rigid_shifts = net_shifts(stab_paths, len(movie))
+    out = tifffile.memmap(out_path, shape=movie.shape, dtype=movie.dtype,
+                          bigtiff=True, photometric='minisblack', metadata={'axes': 'TYX'})
+    try:
+        result = register_piecewise(movie, rigid_shifts, out, patch, overlap, max_shift,
+                                    memory_budget=memory_budget, workers=workers)
+    finally:
+        del out, movie
+    np.savez_compressed(file_path + "_piecewise_shifts.npz", **result)
+    logging.info(f"Saved {out_path}")
+    print(f"Saved {out_path}")
+    return out_path
+
+def _register_plane(directory, plane, channel, ref_slice, subpixel, roi_fraction, memory_budget, workers):
+    #one z plane of a TZSeries, run in a worker process
+    movie = movie_store.open_movie(directory, channel, plane)
+    result = register_movie(movie, ref_slice, subpixel, roi_fraction, memory_budget, workers)
+    return plane, result
+
+def motion_correct_TZSeries(directory, channel='Ch2', ref_slice=1, subpixel=False, roi_fraction=0.8,
+                            max_workers=None, memory_budget=2**29):
+    '''
+    python replacement for mo_corr_TZ_to_Zstack.ijm: every z plane of a TZSeries (the per
+    plane stacks written by batch_concat_TZSeries, a zarr store, or the raw frames) is
+    registered over time in parallel processes, with the same two passes as the TSeries.
+    the corrected mean of each plane comes out of the same pass, no extra read.
+    writes, like the macro:
+        {directory}/MoCorr_transforms/{plane stack}_stab 1_refSlice_{ref_slice}.csv, ..._stab 2.csv
+        {directory}/MoCorr_mean/{plane stack}_mean.tif
+        {directory}/MoCorr_mean/mo_corr_mean_ZStack.tif   (Z, Y, X) float32, planes in order
+    plus the per plane motion qc tables (MoCorr_transforms/) and motion_qc_summary.csv
+
+    Parameters
+    ----------
+    directory : str
+        TZSeries session folder
+    channel : str
+        channel that is registered
+    ref_slice : int
+        1 based reference time point of pass 1 (the macro uses 1)
+    max_workers : int
+        planes registered at the same time (None = one per core). each process runs its
+        ffts single threaded so the cores are not oversubscribed. the workers are started
+        with spawn on macOS and re-import the calling script, so its script level code
+        must be behind if __name__ == '__main__': (see batch_motion_correct.py)
+    subpixel, roi_fraction, memory_budget :
+        see register_movie. memory_budget is per process
+
+    Returns
+    -------
+    outputs : list of str
+        shift tables, plane means and the Z stack; empty if there are no planes
+    '''
+    planes = movie_store.find_planes(directory, channel)
+    if not planes:
+        print(f"No {channel} planes in {directory}")
+        return []
+    dir_name = os.path.basename(os.path.normpath(directory))
+    transforms_dir = os.path.join(directory, 'MoCorr_transforms')
+    mean_dir = os.path.join(directory, 'MoCorr_mean')
+    os.makedirs(transforms_dir, exist_ok=True)
+    os.makedirs(mean_dir, exist_ok=True)
+    outputs = []
+    means = {}
+    qc = {} #per plane qc tables and mean image crispness
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(_register_plane, directory, plane, channel, ref_slice, subpixel,
+                               roi_fraction, memory_budget, 1) for plane in planes]
+        for future in as_completed(futures):
+            plane, result = future.result()
+            name = f"{dir_name}-{str(plane).zfill(6)}-{channel}"
+            outputs.append(write_shift_table(os.path.join(transforms_dir, f"{name}_stab 1_refSlice_{ref_slice}.csv"), result['shifts1']))
+            outputs.append(write_shift_table(os.path.join(transforms_dir, f"{name}_stab 2.csv"), result['shifts2']))
+            mean_path = os.path.join(mean_dir, f"{name}_mean.tif")
+            tifffile.imwrite(mean_path, result['corrected_mean'])
+            outputs.append(mean_path)
+            means[plane] = result['corrected_mean']
+            qc[plane] = (name, result['qc'], result['crispness_before'], result['crispness_after'])
+            logging.info(f"Motion correction complete for {name}")
+    zstack_path = os.path.join(mean_dir, 'mo_corr_mean_ZStack.tif')
+    tifffile.imwrite(zstack_path, np.stack([means[plane] for plane in planes]),
+                     photometric='minisblack', metadata={'axes': 'ZYX'})
+    outputs.append(zstack_path)
+    print(f"Saved {zstack_path}")
+    #per plane qc tables next to the shift tables, one session summary (worst plane)
+    qc_paths, _ = write_qc(directory, dir_name, {qc[p][0]: qc[p][1] for p in planes},
+                           [qc[p][2] for p in planes], [qc[p][3] for p in planes], qc_dir=transforms_dir)
+    outputs.extend(qc_paths)
+    return sorted(outputs)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 26 09:48:13 2026
+
+@author: emmaodom
+
+pooled ROI catalog in python_dataframes: master_roi_info.csv (as before) and a typed
+master_roi_info.parquet next to it (identifier / ROI type columns as categories,
+geometry as numbers) that loads in milliseconds. written by extract_roi_info.py, the
+spine IDs of src/spine_matching.py are added to the same files.
+
+pyarrow is optional: pip install pyarrow. without it only the csv is written / read.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+#identifier columns at the front of the ROI table, stored as categories in the parquet catalog
+ID_COLUMNS = ['directory', 'animal', 'cell', 'dend', 'date']
+CATEGORY_COLUMNS = ['directory', 'animal', 'cell', 'dend', 'date', 'type', 'spine_id']
+NUMERIC_COLUMNS = ['left', 'top', 'width', 'height', 'n', 'position', 'area (u^2)']
+CSV_NAME = 'master_roi_info.csv'
+PARQUET_NAME = 'master_roi_info.parquet'
+
+def to_catalog(data):
+    '''
+    typed copy of the ROI table for parquet: identifier and ROI type columns as
+    categories, geometry as numbers, polygon coordinates as lists
+    '''
+    catalog = data.copy()
+    for col in CATEGORY_COLUMNS:
+        if col in catalog.columns:
+            catalog[col] = catalog[col].astype('string').astype('category')
+    for col in NUMERIC_COLUMNS:
+        if col in catalog.columns:
+            catalog[col] = pd.to_numeric(catalog[col], errors='coerce')
+    for col in catalog.columns:
+        if catalog[col].dtype != object:
+            continue
+        values = catalog[col].dropna()
+        if len(values) and values.map(lambda v: isinstance(v, list)).all():
+            #x / y coordinate lists of polygon ROIs, missing for ovals
+            catalog[col] = catalog[col].map(lambda v: v if isinstance(v, list) else None)
+        else:
+            catalog[col] = catalog[col].map(lambda v: None if v is None or (isinstance(v, float) and np.isnan(v)) else str(v))
+    return catalog
+
+def save_roi_catalog(data, path_save, csv=True, parquet=True):
+    '''
+    writes master_roi_info.csv and / or master_roi_info.parquet into path_save.
+    the parquet file is skipped with a message if pyarrow is not installed
+
+    Returns
+    -------
+    outputs : list of str
+    '''
+    os.makedirs(path_save, exist_ok=True)
+    outputs = []
+    if csv:
+        outputs.append(os.path.join(path_save, CSV_NAME))
+        data.to_csv(outputs[-1], index=False)
+    if parquet:
+        if pyarrow is None:
+            print("pyarrow is not installed, master_roi_info.parquet not written")
+        else:
+            outputs.append(os.path.join(path_save, PARQUET_NAME))
+            to_catalog(data).to_parquet(outputs[-1], index=False)
+    return outputs
+
+def load_roi_catalog(path_save):
+    '''
+    pooled ROI table from path_save: the parquet catalog if there is one (and pyarrow),
+    otherwise master_roi_info.csv
+    '''
+    parquet_path = os.path.join(path_save, PARQUET_NAME)
+    if pyarrow is not None and os.path.exists(parquet_path):
+        return pd.read_parquet(parquet_path)
+    return pd.read_csv(os.path.join(path_save, CSV_NAME))
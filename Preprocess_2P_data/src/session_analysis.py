@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 27 10:05:52 2026
+
+@author: emmaodom
+
+compute-once analysis of one spine/background trace csv. SessionAnalysis reads the csv
+and the session xml once, and every derived result (background subtracted traces, F0,
+dF/F, rolling mean / std, event detection, event rate, variance) is computed lazily and
+memoized per (f0_, window_size), with the least recently used results evicted past
+max_results. the module level functions of plot_dFF.py delegate to it through
+get_session(), so a full metrics + plotting run does every computation exactly once:
+    sa = get_session(file_path)
+    sa.dFF('mode', 30)              # computed
+    sa.event_detection('mode', 30)  # reuses the dFF above
+    sa.event_rate('mode', 30)       # reuses the event detection
+the tables returned by a SessionAnalysis are the memoized objects themselves, shared by
+every caller of the session: treat them as read only (the plot_dFF get_* functions
+return copies).
+"""
+
+import os
+import pandas as pd
+from collections import OrderedDict
+
+from src import helper_functions as hf
+from src import baseline
+
+#f0_ options whose F0 does not depend on the rolling window
+STATIC_F0 = ('mode', 'mean')
+
+class SessionAnalysis:
+    '''
+    Parameters
+    ----------
+    file_path : str
+        spine/background trace csv (ImageJ Multi Measure layout, columns spine, background, ...)
+    max_results : int
+        memoized results kept (each is a frames x spines table)
+    baseline_method : 'exact' or 'decimate'
+        rolling quantile method of the 'rolling10' F0, see src/baseline.py
+    '''
+    def __init__(self, file_path, max_results=32, baseline_method='exact'):
+        self.file_path = file_path
+        self.baseline_method = baseline_method
+        self.directory = os.path.dirname(file_path)
+        self.max_results = max_results
+        self._results = OrderedDict()
+        self._raw = None
+        self._meta = None
+        self._meta_loaded = False
+
+    def _memo(self, key, compute):
+        #LRU memo of derived tables
+        if key in self._results:
+            self._results.move_to_end(key)
+            return self._results[key]
+        value = compute()
+        self._results[key] = value
+        if len(self._results) > self.max_results:
+            self._results.popitem(last=False)
+        return value
+
+    @property
+    def raw(self):
+        #csv structure: each column is an ROI, each row is fluorescence (mean grey value) at a timepoint
+        if self._raw is None:
+            df = pd.read_csv(self.file_path)
+            #remove first column, which is just index values from imageJ results file
+            self._raw = df.loc[:, df.columns != ' ']
+        return self._raw
+
+    @property
+    def num_spines(self):
+        return int(self.raw.shape[1] / 2)
+
+    @property
+    def meta(self):
+        #SessionMetadata of the session xml, parsed once (None without an xml)
+        if not self._meta_loaded:
+            self._meta = hf.get_session_metadata(self.directory)
+            self._meta_loaded = True
+        return self._meta
+
+    @property
+    def frame_period(self):
+        return self.meta.frame_period if self.meta is not None else None
+
+    @property
+    def avg(self):
+        return self.meta.avg if self.meta is not None else None
+
+    @property
+    def sampling_rate(self):
+        #units: Hz, number frames per second
+        return 1/(self.avg*self.frame_period)
+
+    @property
+    def duration(self):
+        return self.meta.duration if self.meta is not None else None
+
+    def window_frames(self, window_size):
+        #num of frames to match duration of window_size (seconds)
+        return int(window_size*self.sampling_rate)
+
+    def bgr_subtracted(self):
+        '''
+        spine roi mean grey value - mean grey of the paired background roi, one column per spine
+        '''
+        def compute():
+            values = self.raw.to_numpy(dtype=float)
+            return pd.DataFrame(values[:, 0::2] - values[:, 1::2], index=self.raw.index)
+        return self._memo(('bgr_subtracted',), compute)
+
+    def _key(self, f0_, window_size):
+        return (f0_, None if f0_ in STATIC_F0 else window_size)
+
+    def f0(self, f0_='mode', window_size=30):
+        '''
+        F0 per spine (a Series) or per frame and spine (a DataFrame, rolling options),
+        see plot_dFF.get_dFF for the f0_ options
+        '''
+        def compute():
+            spine_bgr_subtracted = self.bgr_subtracted()
+            if f0_ == 'mode':
+                #most common value for each ROI, middle mode if there are several
+                f0 = spine_bgr_subtracted.mode().median()
+                #replace any 0 values with nonzero value, to prevent errors when calculating df/f trace
+                return f0.replace(0, 1)
+            if f0_ == 'mean':
+                return spine_bgr_subtracted.mean()
+            if f0_ == 'rolling10':
+                #10th percentile of a rolling window of window_size seconds
+                    #min_periods=1 reports a value for all indices before the window is full
+                return baseline.rolling_quantile(spine_bgr_subtracted, self.window_frames(window_size), 0.1,
+                                                 min_periods=1, method=self.baseline_method)
+            if f0_ == 'rollingMean':
+                return baseline.rolling_mean(spine_bgr_subtracted, self.window_frames(window_size), min_periods=1)
+            raise ValueError(f"Unknown f0_ option {f0_!r}")
+        return self._memo(('f0',) + self._key(f0_, window_size), compute)
+
+    def dFF(self, f0_='mode', window_size=30):
+        #(f(t)-f0)/f0, each column is the dFF of a single spine roi
+        def compute():
+            f0 = self.f0(f0_, window_size)
+            return self.bgr_subtracted().subtract(f0).div(f0)
+        return self._memo(('dFF',) + self._key(f0_, window_size), compute)
+
+    def rolling_std(self, f0_='mode', window_size=30):
+        #rolling std of the dFF, min_periods frames needed (8) before a std is reported, 1 before that
+        def compute():
+            std = self.dFF(f0_, window_size).rolling(window=self.window_frames(window_size), min_periods=8).std()
+            return std.fillna(1)
+        return self._memo(('rolling_std', f0_, window_size), compute)
+
+    def rolling_mean(self, f0_='mode', window_size=30):
+        def compute():
+            return self.dFF(f0_, window_size).rolling(window=self.window_frames(window_size), min_periods=1).mean()
+        return self._memo(('rolling_mean', f0_, window_size), compute)
+
+    def event_detection(self, f0_='mode', window_size=30):
+        #dFF above rolling mean + 3 rolling std, element by element
+        def compute():
+            threshold = self.rolling_mean(f0_, window_size) + (3*self.rolling_std(f0_, window_size))
+            return self.dFF(f0_, window_size).gt(threshold)
+        return self._memo(('event_detection', f0_, window_size), compute)
+
+    def event_rate(self, f0_='mode', window_size=30):
+        #events per second of every spine
+        return self._memo(('event_rate', f0_, window_size),
+                          lambda: self.event_detection(f0_, window_size).sum()/self.duration)
+
+    def variance(self, state='dFF', f0_='mode', window_size=30):
+        if state == 'raw':
+            return self._memo(('variance', 'raw'), lambda: self.raw.var())
+        if state == 'bgr_subtracted':
+            return self._memo(('variance', 'bgr_subtracted'), lambda: self.bgr_subtracted().var())
+        if state == 'dFF':
+            return self._memo(('variance', 'dFF') + self._key(f0_, window_size),
+                              lambda: self.dFF(f0_, window_size).var())
+        raise ValueError(f"Unknown state {state!r}")
+
+#one SessionAnalysis per trace csv, the least recently used sessions are dropped
+_SESSIONS = OrderedDict()
+MAX_SESSIONS = 8
+
+def get_session(file_path):
+    '''
+    shared SessionAnalysis of file_path; a new one is made if the csv changed on disk.
+    its tables are shared by every caller and must not be modified in place (no
+    fillna(inplace=True) or new columns), .copy() them first
+    '''
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size)
+    session = _SESSIONS.get(key)
+    if session is None:
+        session = SessionAnalysis(file_path)
+        _SESSIONS[key] = session
+        if len(_SESSIONS) > MAX_SESSIONS:
+            _SESSIONS.popitem(last=False)
+    else:
+        _SESSIONS.move_to_end(key)
+    return session
+
+def clear_sessions():
+    _SESSIONS.clear()
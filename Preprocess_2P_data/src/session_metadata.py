@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 10:02:11 2026
+
+@author: emmaodom
+
+SessionMetadata parses the Bruker PrairieView xml of an imaging session ONCE
+(streaming with ET.iterparse, see stream_xml) and keeps everything the
+helper_functions getters need:
+    - every PVStateValue of the session level PVStateShard
+    - the sequence type and the cycle / Z (frame index) structure
+    - frame timing (relativeTime, absoluteTime) for every frame
+the getters in helper_functions are thin wrappers around this object,
+so a script that asks for 14 pieces of metadata only parses the xml one time.
+the parsed fields are also kept in a persistent sqlite cache (src/metadata_cache.py)
+so reruns over an unchanged dataset do not parse the xml at all.
+"""
+
+import os
+import numpy as np
+from array import array
+import xml.etree.ElementTree as ET
+from functools import lru_cache
+
+from src import metadata_cache
+
+class SessionMetadata:
+    '''
+    compact, parse-once view of a PrairieView imaging xml file
+
+    Parameters
+    ----------
+    xml_file : str
+        full path to the imaging metadata xml (NOT the VoltageRecording xml)
+
+    Attributes
+    ----------
+    state : dict
+        PVStateValue key -> value. simple values are stored as strings,
+        IndexedValue entries as a list of attribute dicts (index, value, description)
+        and SubindexedValues as a dict of index -> list of attribute dicts
+    sequence_type : str or None
+        'type' attribute of the first Sequence element ie "TSeries Timed Element"
+    date_str : str or None
+        raw 'date' attribute of the PVScan element
+    timing : dict
+        frame count and the frame timing scalars used by the getters (see summarize_frames)
+    relative_time, absolute_time : np.ndarray (float)
+        per frame timing in seconds, in file order
+    frame_cycle, frame_index : np.ndarray (int)
+        cycle of the parent Sequence and the index of each frame
+        (for TZSeries the frame index is the z plane)
+    '''
+    def __init__(self, xml_file, record=None, cache_key=None):
+        self.xml_file = xml_file
+        self._cache_key = cache_key #(mtime_ns, size) if this object should be written to the disk cache
+        self._frames = None
+        if record is not None:
+            #rebuilt from the on-disk metadata cache, frame arrays are re-read only if asked for
+            self.state = record['state']
+            self.sequence_type = record['sequence_type']
+            self.date_str = record['date_str']
+            self._timing = record['timing']
+            return
+        #only the header is read here (stops at the first Sequence),
+        #the frame table is streamed the first time timing information is needed
+        header, _ = stream_xml(xml_file, header_only=True)
+        self.state = header['state']
+        self.sequence_type = header['sequence_type']
+        self.date_str = header['date_str']
+        self._timing = None
+        self._store()
+
+    def _parse_frames(self):
+        try:
+            header, frames = stream_xml(self.xml_file)
+            complete = True
+        except ET.ParseError as e:
+            #truncated xml (ie still being written by PrairieView), keep the frames read so far
+            print(f"Error parsing the XML file: {e}")
+            frames = e.frames
+            complete = False
+        self._frames = frames
+        self._timing = summarize_frames(frames)
+        if complete:
+            self._store()
+
+    def _store(self):
+        if self._cache_key is not None:
+            metadata_cache.get_cache().put(self.xml_file, *self._cache_key, self.to_record())
+
+    def to_record(self):
+        '''
+        json serializable summary (state, sequence type, date and frame timing scalars)
+        that is stored in the on-disk metadata cache, see src/metadata_cache.py
+        '''
+        return {
+            'state': self.state,
+            'sequence_type': self.sequence_type,
+            'date_str': self.date_str,
+            'timing': self._timing,
+            }
+
+    @property
+    def timing(self):
+        if self._timing is None:
+            self._parse_frames()
+        return self._timing
+
+    @property
+    def frames(self):
+        #per frame arrays, streamed on first use
+        if self._frames is None:
+            self._parse_frames()
+        return self._frames
+
+    @property
+    def relative_time(self):
+        return self.frames['relativeTime']
+
+    @property
+    def absolute_time(self):
+        return self.frames['absoluteTime']
+
+    @property
+    def frame_cycle(self):
+        return self.frames['cycle']
+
+    @property
+    def frame_index(self):
+        return self.frames['index']
+
+    def get_state(self, key, default=None):
+        return self.state.get(key, default)
+
+    def get_indexed(self, key, match, field='index'):
+        '''
+        returns the 'value' string of the IndexedValue of PVStateValue key
+        whose attribute field (index or description) equals match
+        '''
+        for indexed_value in self.state.get(key, []) or []:
+            if isinstance(indexed_value, dict) and indexed_value.get(field) == match:
+                return indexed_value.get('value', '0')
+        return None
+
+    @property
+    def n_frames(self):
+        return self.timing['n_frames']
+
+    @property
+    def seq_code(self):
+        '''
+        'T', 'Z' or 'TZ' (same as helper_functions.report_sequence_type)
+        '''
+        seq_type = self.sequence_type
+        if seq_type is not None:
+            if "TSeries" in seq_type and "ZSeries" not in seq_type:
+                return 'T'
+            if "ZSeries" in seq_type and "TSeries" not in seq_type:
+                return 'Z'
+            if "TSeries" in seq_type and "ZSeries" in seq_type:
+                return 'TZ'
+        return None
+
+    @property
+    def max_Z_index(self):
+        #max frame index within cycle 1
+        if self.timing['max_Z_index'] is None:
+            print("No Sequence element with cycle='1' found.")
+        return self.timing['max_Z_index']
+
+    @property
+    def frame_period(self):
+        fp = self.state.get('framePeriod')
+        if fp is None:
+            return None
+        return float(fp)
+
+    @property
+    def is_single_frame(self):
+        if self.timing['n_timed'] < 2:
+            print('Only one frame detected')
+            return True
+        return False
+
+    @property
+    def avg(self):
+        '''
+        number of averages per scan: time between the first two frames / frame period
+        '''
+        fp = self.frame_period
+        T2_T1 = self.timing['first_interval'] #time between first two frames
+        if T2_T1 is None:
+            print('Only one frame detected')
+            return None
+        return round(T2_T1 / fp)
+
+    @property
+    def laser_power(self):
+        value = self.get_indexed('laserPower', 'Insight Pockels', field='description')
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            print("Error in laser power value.")
+            return None
+
+    def pmt_gain(self, channel_description):
+        value = self.get_indexed('pmtGain', channel_description, field='description')
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            print("Error in PMT gain value.")
+            return None
+
+    @property
+    def wavelength(self):
+        #wavelength of the laser with non-zero power
+        try:
+            laser_power = {v.get('index'): float(v.get('value', 0)) for v in self.state.get('laserPower', [])}
+            laser_wavelength = {v.get('index'): int(v.get('value', 0)) for v in self.state.get('laserWavelength', [])}
+        except (ValueError, AttributeError):
+            print("Error in value format.")
+            return None
+        for index, power in laser_power.items():
+            if power > 0: #non-zero power indicates active laser
+                return laser_wavelength.get(index, None)
+        return None
+
+    @property
+    def objective(self):
+        #can switch out with objectiveLensMag for numerical value
+        return self.state.get('objectiveLens')
+
+    @property
+    def resolution(self):
+        lines_per_frame = self.state.get('linesPerFrame')
+        pixels_per_line = self.state.get('pixelsPerLine')
+        if lines_per_frame is not None and pixels_per_line is not None:
+            return [int(lines_per_frame), int(pixels_per_line)]
+        return None
+
+    @property
+    def microns_per_pixel(self):
+        '''
+        returns microns_per_pixels with unit microns squared
+        '''
+        try:
+            x = self.get_indexed('micronsPerPixel', 'XAxis')
+            y = self.get_indexed('micronsPerPixel', 'YAxis')
+            if x is not None and y is not None:
+                return float(x)*float(y)
+        except ValueError:
+            print("Error in value format.")
+        return None
+
+    @property
+    def duration(self):
+        '''
+        duration of the imaging session in seconds, from the first to the last frame.
+        uses absoluteTime so it is also correct for TZSeries, where relativeTime
+        restarts at 0 in every cycle
+        '''
+        if self.n_frames == 0:
+            print("No Frame elements found in the XML file.")
+            return None
+        return self.timing['duration']
+
+    @property
+    def date(self):
+        '''
+        date in the format 'YYYY/MM/DD' or None if the date is not found
+        '''
+        if not self.date_str:
+            return None
+        try:
+            date_parts = self.date_str.split(' ')[0].split('/')
+            return '/'.join([date_parts[2], date_parts[0], date_parts[1]])
+        except IndexError:
+            print("Error in date format.")
+            return None
+
+def _parse_state_value(pv_state_value):
+    '''
+    returns the value of a PVStateValue element: a string for simple values,
+    a list of attribute dicts for IndexedValue entries, or a dict of
+    index -> list of attribute dicts for SubindexedValues
+    '''
+    if 'value' in pv_state_value.attrib:
+        return pv_state_value.attrib['value']
+    indexed = [dict(v.attrib) for v in pv_state_value.findall('IndexedValue')]
+    if indexed:
+        return indexed
+    subindexed = {}
+    for sub in pv_state_value.findall('SubindexedValues'):
+        subindexed[sub.attrib.get('index')] = [dict(v.attrib) for v in sub.findall('SubindexedValue')]
+    return subindexed
+
+def stream_xml(xml_file, header_only=False):
+    '''
+    streams a PrairieView xml with ET.iterparse in one bounded memory pass.
+    elements are cleared as soon as they are read, so a multi-hour TSeries
+    never has more than one Frame in memory.
+
+    Parameters
+    ----------
+    xml_file : str
+        path to the imaging metadata xml
+    header_only : bool
+        stop at the first Sequence element (after reading its type). use this
+        when you only need the session level PVStateValues / sequence type / date
+
+    Returns
+    -------
+    header : dict
+        'state' (PVStateValue key -> value, see _parse_state_value), 'sequence_type', 'date_str'
+    frames : dict of np.ndarray or None
+        'relativeTime', 'absoluteTime' (float, seconds), 'cycle', 'index' (int) for
+        every Frame in file order. None if header_only.
+        if the xml is truncated an ET.ParseError is raised with the frames read
+        so far attached as e.frames
+    '''
+    header = {'state': {}, 'sequence_type': None, 'date_str': None}
+    relative_time, absolute_time = array('d'), array('d')
+    frame_cycle, frame_index = array('i'), array('i')
+    depth = 0
+    root = None
+    sequence = None
+    cycle = 1
+
+    def _frames():
+        return {
+            'relativeTime': np.frombuffer(relative_time, dtype=float).copy(),
+            'absoluteTime': np.frombuffer(absolute_time, dtype=float).copy(),
+            'cycle': np.frombuffer(frame_cycle, dtype=np.int32).astype(int),
+            'index': np.frombuffer(frame_index, dtype=np.int32).astype(int),
+            }
+
+    with open(xml_file, 'rb') as f:
+        try:
+            for event, elem in ET.iterparse(f, events=('start', 'end')):
+                if event == 'start':
+                    depth += 1
+                    if depth == 1:
+                        root = elem
+                        if elem.tag.endswith('PVScan'):
+                            header['date_str'] = elem.attrib.get('date', None)
+                    elif elem.tag == 'Sequence':
+                        if header['sequence_type'] is None and 'type' in elem.attrib:
+                            header['sequence_type'] = elem.attrib['type']
+                        if header_only:
+                            return header, None
+                        sequence = elem
+                        cycle = int(elem.attrib.get('cycle', 1))
+                    continue
+                depth -= 1
+                tag = elem.tag
+                if tag == 'Frame':
+                    attrib = elem.attrib
+                    relative_time.append(float(attrib.get('relativeTime', 'nan')))
+                    absolute_time.append(float(attrib.get('absoluteTime', 'nan')))
+                    frame_cycle.append(cycle)
+                    frame_index.append(int(attrib.get('index', 0)))
+                    #drop the frame (and its File / PVStateShard children) from the Sequence
+                    if sequence is not None and depth == 2:
+                        del sequence[:]
+                    else:
+                        elem.clear()
+                elif depth == 1:
+                    #direct child of PVScan: the session level PVStateShard or a finished Sequence
+                    if tag == 'PVStateShard':
+                        for pv_state_value in elem.findall('PVStateValue'):
+                            key = pv_state_value.attrib.get('key')
+                            if key is not None and key not in header['state']: #keep first occurrence
+                                header['state'][key] = _parse_state_value(pv_state_value)
+                    if tag == 'Sequence':
+                        sequence = None
+                    root.clear()
+        except ET.ParseError as e:
+            e.frames = None if header_only else _frames()
+            raise
+    if header_only:
+        return header, None
+    return header, _frames()
+
+def summarize_frames(frames):
+    '''
+    reduces the per frame arrays to the few scalars the getters need
+    (these are what the on-disk cache keeps instead of the full frame table)
+    '''
+    relative_time = frames['relativeTime']
+    absolute_time = frames['absoluteTime']
+    timed = relative_time[~np.isnan(relative_time)]
+    in_cycle1 = frames['index'][frames['cycle'] == 1]
+    duration = None
+    if len(absolute_time) and not np.isnan(absolute_time[[0, -1]]).any():
+        duration = float(absolute_time[-1] - absolute_time[0])
+    elif len(relative_time):
+        duration = float(relative_time[-1])
+    return {
+        'n_frames': int(len(relative_time)),
+        'n_timed': int(len(timed)),
+        'first_interval': float(timed[1] - timed[0]) if len(timed) >= 2 else None,
+        'duration': duration,
+        'max_Z_index': int(in_cycle1.max()) if len(in_cycle1) else None,
+        }
+
+@lru_cache(maxsize=64)
+def _load(xml_file, mtime_ns, size, use_cache):
+    #mtime and size are part of the key so an edited xml is parsed again
+    if not use_cache:
+        return SessionMetadata(xml_file)
+    record = metadata_cache.get_cache().get(xml_file, mtime_ns, size)
+    return SessionMetadata(xml_file, record=record, cache_key=(mtime_ns, size))
+
+def load(xml_file, use_cache=True):
+    '''
+    returns a (memoized) SessionMetadata for xml_file, or None if it can not be parsed
+    use_cache: also look up / store the parsed fields in the persistent sqlite
+        metadata cache so unchanged xml files are not parsed again on the next run
+    '''
+    try:
+        st = os.stat(xml_file)
+        return _load(xml_file, st.st_mtime_ns, st.st_size, use_cache)
+    except ET.ParseError:
+        print("Error parsing the XML file.")
+        return None
+    except OSError as e:
+        print(f"An error occurred: {e}")
+        return None
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 26 11:20:36 2026
+
+@author: emmaodom
+
+longitudinal spine matching: links the spine ROIs of the same dendrite
+('_cellN_dendM_') across imaging dates and gives them stable spine IDs
+    289N_cell1_dend2_s004
+in the pooled ROI catalog (extract_roi_info.pool_roi_info / src/roi_catalog.py).
+
+for every (animal, cell, dend) the sessions are taken in date order:
+    1. the mean image of each session (motion corrected average projection) is
+       registered to the first session with the same phase correlation as
+       src/registration.py, so the ROI centroids of every day are in the
+       coordinates of the first day
+    2. the centroids of the day are matched to the spines known so far with a
+       KD-tree (scipy.spatial.cKDTree) inside max_distance pixels, and the pairs are
+       made one to one with linear_sum_assignment on the gated distances
+    3. matched spines keep their ID (and their position is updated to the new day),
+       unmatched ones get the next free ID
+the ROIs of a RoiSet are interleaved spine, background, spine, background ... (same
+layout as the trace csvs), so only the even rows are matched and every background
+ROI gets the ID of the spine before it.
+"""
+
+import os
+import glob
+import logging
+import numpy as np
+import pandas as pd
+import tifffile
+from scipy.spatial import cKDTree
+from scipy.optimize import linear_sum_assignment
+
+from src import registration
+
+#average projections written by motion correction, in order of preference
+MEAN_IMAGE_PATTERNS = ['*_post_correction_z_projection.tif', 'online_mean.tif']
+
+def find_mean_image(directory):
+    #motion corrected mean image of a session, None if there is none
+    for pattern in MEAN_IMAGE_PATTERNS:
+        matches = sorted(glob.glob(os.path.join(glob.escape(directory), pattern)))
+        if matches:
+            return matches[0]
+    return None
+
+def _read_mean(directory):
+    path = find_mean_image(directory)
+    if path is None:
+        return None
+    image = tifffile.imread(path)
+    return image.reshape(image.shape[-2:]) if image.ndim > 2 else image
+
+def register_images(reference, image, roi_fraction=0.8):
+    '''
+    (dy, dx) that moves image onto reference (subpixel phase correlation on the
+    central roi_fraction of the field of view), None if the shapes differ
+    '''
+    if reference.shape != image.shape:
+        return None
+    roi = registration.central_roi(reference.shape, roi_fraction)
+    window = registration._window(roi)
+    ref_spectrum = registration.spectrum(np.asarray(reference, dtype=np.float32), roi, window)
+    spec = registration.spectrum(np.asarray(image, dtype=np.float32), roi, window)
+    return registration.phase_correlate(spec, ref_spectrum, registration.fft_shape(roi), subpixel=True)
+
+def roi_centroids(rois):
+    #(n, 2) centroids (y, x) in pixels from the ROI bounding boxes (left, top, width, height)
+    left = pd.to_numeric(rois['left'], errors='coerce').to_numpy(dtype=float)
+    top = pd.to_numeric(rois['top'], errors='coerce').to_numpy(dtype=float)
+    width = pd.to_numeric(rois['width'], errors='coerce').to_numpy(dtype=float)
+    height = pd.to_numeric(rois['height'], errors='coerce').to_numpy(dtype=float)
+    return np.column_stack([top + height / 2, left + width / 2])
+
+def match_points(known, new, max_distance=5.0):
+    '''
+    one to one matching of new points to known points within max_distance
+
+    Parameters
+    ----------
+    known : np.ndarray (n_known, 2)
+    new : np.ndarray (n_new, 2)
+
+    Returns
+    -------
+    pairs : list of (new index, known index)
+    '''
+    if len(known) == 0 or len(new) == 0:
+        return []
+    #only pairs closer than the gate are candidates, the rest never enter the assignment
+    distances = cKDTree(new).sparse_distance_matrix(cKDTree(known), max_distance, output_type='coo_matrix')
+    if distances.nnz == 0:
+        return []
+    rows, cols = np.unique(distances.row), np.unique(distances.col)
+    cost = np.full((len(rows), len(cols)), max_distance * 1e3)
+    cost[np.searchsorted(rows, distances.row), np.searchsorted(cols, distances.col)] = distances.data
+    r, c = linear_sum_assignment(cost)
+    keep = cost[r, c] <= max_distance
+    return list(zip(rows[r[keep]], cols[c[keep]]))
+
+def _spine_rows(rois):
+    #positions (within the session table, RoiSet order) of the spine ROIs: even rows
+    return np.arange(0, len(rois), 2)
+
+def match_dendrite(rois, prefix, max_distance=5.0, roi_fraction=0.8):
+    '''
+    spine IDs for the ROIs of one (animal, cell, dend) across its sessions
+
+    Parameters
+    ----------
+    rois : pd.DataFrame
+        catalog rows of one dendrite (columns directory, date, left, top, width, height),
+        RoiSet order within every session
+    prefix : str
+        start of the IDs, ie '289N_cell1_dend2'
+    max_distance : float
+        largest centroid distance (pixels, after registration) of a match
+
+    Returns
+    -------
+    ids : pd.Series of str, index of rois
+    offsets : dict, directory -> (dy, dx) registration to the first session
+    '''
+    ids = pd.Series(None, index=rois.index, dtype=object)
+    offsets = {}
+    sessions = rois[['directory', 'date']].drop_duplicates('directory')
+    sessions = sessions.sort_values(['date', 'directory'], na_position='last')['directory']
+    reference = None
+    known_pos = np.zeros((0, 2))
+    known_ids = []
+    for directory in sessions:
+        session = rois[rois['directory'] == directory]
+        image = _read_mean(directory)
+        offset = (0.0, 0.0)
+        if reference is None:
+            #the first session with a mean image is the reference frame
+            reference = image
+        elif image is None:
+            logging.warning(f"{directory}: no mean image, ROIs matched without registration")
+        else:
+            shift = register_images(reference, image, roi_fraction)
+            if shift is None:
+                logging.warning(f"{directory}: mean image size differs from the first session, not registered")
+            else:
+                offset = shift
+        offsets[directory] = offset
+        spines = _spine_rows(session)
+        positions = roi_centroids(session.iloc[spines]) + np.asarray(offset)
+        valid = np.flatnonzero(np.isfinite(positions).all(axis=1))
+        session_ids = [None]*len(spines)
+        matched = set()
+        for i, k in match_points(known_pos, positions[valid], max_distance):
+            session_ids[valid[i]] = known_ids[k]
+            known_pos[k] = positions[valid[i]] #follow slow drift of the spine
+            matched.add(valid[i])
+        for i in valid:
+            if i not in matched:
+                session_ids[i] = f"{prefix}_s{len(known_ids):03d}"
+                known_ids.append(session_ids[i])
+                known_pos = np.vstack([known_pos, positions[i]])
+        #background ROIs share the ID of their spine
+        for j, spine_id in zip(spines, session_ids):
+            ids.iloc[ids.index.get_indexer(session.index[j:j + 2])] = spine_id
+    return ids, offsets
+
+def match_spines(catalog, max_distance=5.0, roi_fraction=0.8):
+    '''
+    adds stable 'spine_id' (and the registration 'offset_y', 'offset_x' of each session
+    to the first session of its dendrite) to the pooled ROI table
+
+    Parameters
+    ----------
+    catalog : pd.DataFrame
+        extract_roi_info.pool_roi_info() / roi_catalog.load_roi_catalog() table
+    max_distance : float
+        distance gate in pixels
+    roi_fraction : float
+        central fraction of the mean images used for registration
+
+    Returns
+    -------
+    catalog : pd.DataFrame (copy)
+    '''
+    catalog = catalog.copy()
+    catalog['spine_id'] = None
+    catalog['offset_y'] = np.nan
+    catalog['offset_x'] = np.nan
+    keys = catalog[['animal', 'cell', 'dend']].astype('string')
+    dendrites = catalog[keys.notna().all(axis=1)].groupby([keys['animal'], keys['cell'], keys['dend']], sort=True)
+    for (animal, cell, dend), rois in dendrites:
+        ids, offsets = match_dendrite(rois, f"{animal}_cell{cell}_dend{dend}", max_distance, roi_fraction)
+        catalog.loc[ids.index, 'spine_id'] = ids
+        offset = rois['directory'].map(offsets)
+        catalog.loc[rois.index, 'offset_y'] = offset.map(lambda o: o[0])
+        catalog.loc[rois.index, 'offset_x'] = offset.map(lambda o: o[1])
+        logging.info(f"{animal} cell{cell} dend{dend}: {ids.nunique()} spines over {len(offsets)} sessions")
+    return catalog
+
+def update_catalog(path_save, max_distance=5.0, roi_fraction=0.8):
+    '''
+    loads the ROI catalog from path_save (python_dataframes), matches the spines and
+    writes the catalog back with the spine IDs (csv, and parquet if pyarrow is installed)
+    '''
+    from src import roi_catalog
+    catalog = match_spines(roi_catalog.load_roi_catalog(path_save), max_distance, roi_fraction)
+    roi_catalog.save_roi_catalog(catalog, path_save)
+    return catalog
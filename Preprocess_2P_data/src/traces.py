@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 25 14:31:48 2026
+
+@author: emmaodom
+
+spine / background trace extraction in python, replaces the hand made ImageJ Multi
+Measure exports ('*spine0_bgr1*.csv'). the ROIs of RoiSet.zip (oval, polygon, freehand,
+rectangle) are rasterized once into one sparse (n_rois x pixels) weight matrix, every
+row holding 1 / area on the pixels of that ROI. the mean grey value of every ROI in
+every frame of a block is then one sparse x dense product:
+    traces[block] = (W @ block.reshape(B, Y*X).T).T
+so hundreds of ROIs over 20k frames are measured in one streaming read of the movie.
+the columns keep the RoiSet order, which is the interleaved spine, background, spine,
+background ... layout plot_dFF.get_bgr_subtracted_trace expects.
+
+the movie is the corrected stack if apply_motion_correction / motion_correct_piecewise
+wrote one, otherwise the concatenated (or raw) movie with the stab 1 + stab 2 shifts
+applied block by block on the fly.
+
+read_roi is needed for RoiSet.zip (pip install read-roi), masks can be passed without it.
+"""
+
+import os
+import glob
+import logging
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from concurrent.futures import ThreadPoolExecutor
+
+from src import movie_store
+from src import registration
+
+try:
+    from read_roi import read_roi_zip
+except ImportError:
+    read_roi_zip = None
+
+def _pixel_centers(y0, y1, x0, x1):
+    ys, xs = np.mgrid[y0:y1, x0:x1]
+    return ys, xs, ys + 0.5, xs + 0.5
+
+def _inside_polygon(x, y, px, py):
+    #even-odd crossing test of the points (px, py) against the closed polygon (x, y), vectorized over points
+    inside = np.zeros(px.shape, dtype=bool)
+    for x0, y0, x1, y1 in zip(x, y, np.roll(x, -1), np.roll(y, -1)):
+        if y0 == y1:
+            continue
+        crosses = (y0 > py) != (y1 > py)
+        inside ^= crosses & (px < x0 + (py - y0) * (x1 - x0) / (y1 - y0))
+    return inside
+
+def roi_pixels(roi, frame_shape):
+    '''
+    flat pixel indices of one read_roi ROI dict inside a frame of frame_shape.
+    a pixel belongs to the ROI if its center is inside, like ImageJ's masks
+
+    Parameters
+    ----------
+    roi : dict
+        one value of read_roi_zip(), keys 'type' and 'left', 'top', 'width', 'height'
+        (oval, rectangle) or 'x', 'y' (polygon, freehand, traced)
+    frame_shape : (int, int)
+
+    Returns
+    -------
+    pixels : np.ndarray of int, empty if the ROI type is not an area or is off the frame
+    '''
+    height, width = frame_shape
+    kind = roi.get('type')
+    if kind in ('oval', 'rectangle'):
+        left, top, w, h = roi['left'], roi['top'], roi['width'], roi['height']
+        y0, y1 = max(int(np.floor(top)), 0), min(int(np.ceil(top + h)), height)
+        x0, x1 = max(int(np.floor(left)), 0), min(int(np.ceil(left + w)), width)
+        if y1 <= y0 or x1 <= x0:
+            return np.array([], dtype=np.int64)
+        ys, xs, cy, cx = _pixel_centers(y0, y1, x0, x1)
+        if kind == 'oval':
+            inside = (((cx - left - w/2) / (w/2))**2 + ((cy - top - h/2) / (h/2))**2) <= 1
+        else:
+            inside = np.ones(ys.shape, dtype=bool)
+    elif kind in ('polygon', 'freehand', 'traced'):
+        x, y = np.asarray(roi['x'], dtype=float), np.asarray(roi['y'], dtype=float)
+        y0, y1 = max(int(np.floor(y.min())), 0), min(int(np.ceil(y.max())) + 1, height)
+        x0, x1 = max(int(np.floor(x.min())), 0), min(int(np.ceil(x.max())) + 1, width)
+        if y1 <= y0 or x1 <= x0:
+            return np.array([], dtype=np.int64)
+        ys, xs, cy, cx = _pixel_centers(y0, y1, x0, x1)
+        inside = _inside_polygon(x, y, cx, cy)
+    else:
+        print(f"ROI {roi.get('name')} of type {kind} has no area, skipped")
+        return np.array([], dtype=np.int64)
+    return (ys[inside] * width + xs[inside]).astype(np.int64)
+
+def _weights(pixel_lists, frame_shape):
+    #sparse (n_rois, Y*X) matrix, 1 / area on the pixels of every ROI
+    counts = np.array([len(p) for p in pixel_lists])
+    rows = np.repeat(np.arange(len(pixel_lists)), counts)
+    cols = np.concatenate(pixel_lists) if len(pixel_lists) else np.array([], dtype=np.int64)
+    values = np.repeat(1.0 / np.maximum(counts, 1), counts)
+    return sparse.csr_matrix((values, (rows, cols)),
+                             shape=(len(pixel_lists), frame_shape[0]*frame_shape[1]), dtype=np.float32)
+
+def roi_weights(rois, frame_shape):
+    '''
+    Parameters
+    ----------
+    rois : dict
+        read_roi_zip() output, name -> ROI dict, in RoiSet order
+    frame_shape : (int, int)
+
+    Returns
+    -------
+    weights : scipy.sparse.csr_matrix (n_rois, Y*X)
+    names : list of str
+    '''
+    names = list(rois)
+    return _weights([roi_pixels(rois[name], frame_shape) for name in names], frame_shape), names
+
+def mask_weights(masks):
+    #same weight matrix from (n_rois, Y, X) boolean masks
+    masks = np.asarray(masks, dtype=bool)
+    return _weights([np.flatnonzero(m) for m in masks], masks.shape[1:])
+
+def read_rois(roi_zip_path):
+    #read_roi_zip with the same error handling as extract_roi_info.get_roi_sess, None on failure
+    if read_roi_zip is None:
+        print("Reading RoiSet.zip needs the read_roi package (pip install read-roi)")
+        return None
+    try:
+        return read_roi_zip(roi_zip_path)
+    except Exception as e:
+        print(f"An error occurred while processing {roi_zip_path}: {e}")
+        return None
+
+def measure(weights, frames):
+    '''
+    mean grey value of every ROI in every frame, (B, Y, X) or (Y, X) -> (B, n_rois) or (n_rois,).
+    ROIs without pixels are NaN
+    '''
+    frames = np.asarray(frames, dtype=np.float32)
+    flat = frames.reshape(-1, weights.shape[1])
+    traces = np.asarray(weights @ flat.T).T
+    traces[:, np.diff(weights.indptr) == 0] = np.nan
+    return traces[0] if frames.ndim == 2 else traces
+
+def extract_traces(movie, weights, shifts=None, memory_budget=2**30):
+    '''
+    streams the movie once in blocks and measures every ROI in every frame
+
+    Parameters
+    ----------
+    movie : array-like (T, Y, X)
+        registered movie, or raw movie + shifts
+    weights : scipy.sparse matrix (n_rois, Y*X)
+        roi_weights() / mask_weights()
+    shifts : np.ndarray (T, 2), optional
+        net (dy, dx) per frame (registration.net_shifts) applied (bicubic) to each block
+        before measuring, for movies that were not corrected on disk
+    memory_budget : int
+        bytes the block buffers may use
+
+    Returns
+    -------
+    traces : np.ndarray (T, n_rois) float32
+    '''
+    frame_shape = tuple(movie.shape[1:])
+    n_block = registration.block_size(frame_shape, registration.central_roi(frame_shape), memory_budget)
+    traces = np.zeros((len(movie), weights.shape[0]), dtype=np.float32)
+    with ThreadPoolExecutor(max_workers=1) as reader:
+        for start, block in registration._iter_blocks(movie, n_block, reader):
+            stop = start + len(block)
+            if shifts is not None:
+                block = registration._apply_block_bicubic(np.asarray(block, dtype=np.float32), shifts[start:stop])
+            traces[start:stop] = measure(weights, block)
+    return traces
+
+def write_traces(path, traces, names):
+    '''
+    Multi Measure layout: ' ' column with the 1 based slice number, then one
+    'Mean(name)' column per ROI, read by plot_dFF.get_raw_fluorescence_trace
+    '''
+    df = pd.DataFrame(traces, columns=[f"Mean({name})" for name in names])
+    df.index = np.arange(1, len(df) + 1)
+    df.to_csv(path, index_label=' ')
+    return path
+
+def find_corrected(directory, channel='Ch2'):
+    #motion corrected stack of a session (piecewise before rigid), None if there is none
+    for suffix in ('_piecewise_corrected.tif', '_motion_corrected.tif'):
+        matches = sorted(glob.glob(os.path.join(glob.escape(directory), f"*-{channel}.tif{suffix}")))
+        if matches:
+            return matches[0]
+    return None
+
+def extract_session_traces(directory, channel='Ch2', roi_zip_path=None, out_path=None, memory_budget=2**30):
+    '''
+    spine / background traces of a TSeries session from its RoiSet.zip
+
+    Parameters
+    ----------
+    directory : str
+        session folder
+    channel : str
+        channel that is measured
+    roi_zip_path : str
+        default {directory}/RoiSet.zip
+    out_path : str
+        default f"{dir_name}_spine0_bgr1_traces.csv" in the session folder (found by
+        plot_dFF.get_roi_trace_files like the Multi Measure exports)
+
+    Returns
+    -------
+    out_path : str, or None if the ROIs or the movie could not be read
+    '''
+    roi_zip_path = roi_zip_path if roi_zip_path is not None else os.path.join(directory, 'RoiSet.zip')
+    if not os.path.exists(roi_zip_path):
+        print(f"No RoiSet.zip in {directory}")
+        return None
+    rois = read_rois(roi_zip_path)
+    if not rois:
+        return None
+    if len(rois) % 2:
+        logging.warning(f"{roi_zip_path}: odd number of ROIs ({len(rois)}), the last spine has no background")
+    shifts = None
+    corrected = find_corrected(directory, channel)
+    try:
+        if corrected is not None:
+            movie = movie_store.open_tif(corrected)
+        else:
+            movie = movie_store.open_movie(directory, channel)
+            stab_paths = (sorted(glob.glob(os.path.join(glob.escape(directory), '*stab 1*.csv')))[:1]
+                          + sorted(glob.glob(os.path.join(glob.escape(directory), '*stab 2*.csv')))[:1])
+            if stab_paths:
+                shifts = registration.net_shifts(stab_paths, len(movie))
+            else:
+                logging.warning(f"{directory}: no motion correction found, measuring the raw movie")
+    except FileNotFoundError as e:
+        print(e)
+        return None
+    weights, names = roi_weights(rois, tuple(movie.shape[1:]))
+    traces = extract_traces(movie, weights, shifts, memory_budget)
+    if out_path is None:
+        dir_name = os.path.basename(os.path.normpath(directory))
+        out_path = os.path.join(directory, f"{dir_name}_spine0_bgr1_traces.csv")
+    write_traces(out_path, traces, names)
+    print(f"Saved {out_path}")
+    return out_path
+
+def batch_extract_traces(input_dir, channel='Ch2', overwrite=False, memory_budget=2**30):
+    '''
+    extract_session_traces for every session under input_dir that has a RoiSet.zip,
+    skipping sessions that already have a trace csv unless overwrite
+
+    Returns
+    -------
+    outputs : list of str
+    '''
+    from src import discovery
+    outputs = []
+    for session in discovery.discover_sessions(input_dir, include_root=True):
+        if session.roi_zip is None or (session.trace_csvs and not overwrite):
+            continue
+        out_path = extract_session_traces(session.directory, channel, session.roi_zip, memory_budget=memory_budget)
+        if out_path is not None:
+            outputs.append(out_path)
+    return outputs
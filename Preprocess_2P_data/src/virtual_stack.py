@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 20 15:06:31 2026
+
+@author: emmaodom
+
+lazy, read-only virtual stack over the raw single frame OME tifs of a session,
+so motion correction / projections / trace extraction can run straight on the
+PrairieView output and batch_concat becomes optional archival.
+
+VirtualStack is indexed like a numpy array with axes (T, Z, C, Y, X):
+    vs[100:200, 0, 1]        -> time points 100-199 of plane 0, Ch2 as (100, Y, X)
+    vs.movie('Ch2')[:500]    -> (T, Y, X) view of one channel (and plane)
+frames are memory mapped straight from the uncompressed tif pages (no decode, no copy
+until the values are used) and the next files are prefetched on a background thread.
+"""
+
+import os
+import threading
+import numpy as np
+import tifffile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from src.frame_index import FrameIndex
+from src import session_metadata
+
+def _channel_number(channel):
+    #'Ch2' or 2 -> 2
+    if isinstance(channel, str):
+        return int(channel.replace('Ch', ''))
+    return int(channel)
+
+class VirtualStack:
+    '''
+    Parameters
+    ----------
+    file_list : list of str
+        raw frame tifs of ONE session (ie discovery.Session.raw_tifs)
+    seq_code : 'T', 'Z' or 'TZ'
+        how the file names map to axes. for 'TZ' the cycle is time and the 6 digit
+        index is the z plane, for 'T' / 'Z' the (cycle, index) order is the single
+        time / z axis. taken from the session xml by from_session
+    prefetch : int
+        number of following files warmed up in the background after each read
+    cache_size : int
+        number of memory mapped files kept open
+
+    Attributes
+    ----------
+    shape : tuple (T, Z, C, Y, X)
+    channels : list of int
+        channel number of each C position
+    '''
+    def __init__(self, file_list, seq_code='T', prefetch=8, cache_size=256):
+        self.index = FrameIndex(file_list)
+        table = self.index.table
+        if len(table) == 0:
+            raise ValueError("No PrairieView frame files to build a VirtualStack from.")
+        self.channels = self.index.channels
+        c_pos = np.searchsorted(self.channels, table['channel'].values)
+        if seq_code == 'TZ':
+            t_keys, t_pos = np.unique(table['cycle'].values, return_inverse=True)
+            z_keys, z_pos = np.unique(table['plane'].values, return_inverse=True)
+        else:
+            t_keys, t_pos = np.unique(table['cycle'].values.astype(np.int64)*1_000_000 + table['plane'].values,
+                                      return_inverse=True)
+            z_keys, z_pos = np.array([0]), np.zeros(len(table), dtype=int)
+            if seq_code == 'Z':
+                #a ZSeries is one time point with many planes
+                t_keys, z_keys = z_keys, t_keys
+                t_pos, z_pos = z_pos, t_pos
+        #(T, Z, C) grid of row numbers into the file table, -1 where a frame is missing
+        self._grid = np.full((len(t_keys), len(z_keys), len(self.channels)), -1, dtype=np.int64)
+        self._grid[t_pos.ravel(), z_pos.ravel(), c_pos] = np.arange(len(table))
+        self._paths = table['path'].values
+        with tifffile.TiffFile(self._paths[0], is_ome=False) as tif:
+            page = tif.pages[0]
+            self.frame_shape = tuple(page.shape)
+            self.dtype = page.dtype
+        self.shape = self._grid.shape + self.frame_shape
+        self.ndim = len(self.shape)
+        self.prefetch = prefetch
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock() #the prefetch thread shares the cache
+        self._pool = ThreadPoolExecutor(max_workers=2) if prefetch else None
+        self._z_keys = z_keys if seq_code == 'TZ' else None
+
+    @classmethod
+    def from_session(cls, session, **kwargs):
+        '''
+        session: discovery.Session or session folder (raw frames are globbed then)
+        '''
+        if isinstance(session, str):
+            from src import discovery
+            session = discovery.classify_files(session, os.listdir(session))
+        meta = session_metadata.load(session.xml) if session.xml else None
+        seq_code = meta.seq_code if meta is not None and meta.seq_code else 'T'
+        return cls(session.raw_tifs, seq_code=seq_code, **kwargs)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _map(self, row):
+        '''
+        memory map of one frame file, (Y, X). uncompressed contiguous pages are mapped
+        in place, anything else is decoded once
+        '''
+        with self._lock:
+            frame = self._cache.get(row)
+            if frame is not None:
+                self._cache.move_to_end(row)
+                return frame
+        path = self._paths[row]
+        with tifffile.TiffFile(path, is_ome=False) as tif:
+            page = tif.pages[0]
+            contiguous = bool(page.is_contiguous) and page.compression == 1
+            offset = page.dataoffsets[0] if contiguous else None
+            byteorder = tif.byteorder
+            if not contiguous:
+                frame = page.asarray()
+        if contiguous:
+            frame = np.memmap(path, dtype=self.dtype.newbyteorder(byteorder), mode='r',
+                              offset=offset, shape=self.frame_shape)
+        with self._lock:
+            self._cache[row] = frame
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return frame
+
+    def _warm(self, rows):
+        #read the frame bytes once so they are in the OS page cache when needed
+        for row in rows:
+            try:
+                np.asarray(self._map(row)).sum()
+            except (OSError, ValueError):
+                pass
+
+    def _prefetch_after(self, rows):
+        if self._pool is None or len(rows) == 0:
+            return
+        last = int(rows.max())
+        nxt = [r for r in range(last + 1, min(last + 1 + self.prefetch, len(self._paths))) if r not in self._cache]
+        if nxt:
+            self._pool.submit(self._warm, nxt)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = key.index(Ellipsis)
+            key = key[:i] + (slice(None),)*(self.ndim - len(key) + 1) + key[i+1:]
+        key = key + (slice(None),)*(self.ndim - len(key))
+        grid = self._grid[key[:3]]
+        yx = key[3:]
+        frame_out_shape = np.empty(self.frame_shape, dtype=bool)[yx].shape
+        out = np.zeros(np.shape(grid) + frame_out_shape, dtype=self.dtype)
+        grid = np.asarray(grid)
+        for pos in np.ndindex(grid.shape):
+            row = grid[pos]
+            if row >= 0: #missing frames stay 0
+                out[pos] = self._map(row)[yx]
+        self._prefetch_after(grid[grid >= 0])
+        return out
+
+    def movie(self, channel='Ch2', plane=None):
+        '''
+        (T, Y, X) view of one channel and plane. plane is the 6 digit plane ID (1 based)
+        of a TZSeries, same as movie_store.open_movie; None for TSeries / ZSeries
+        '''
+        c = self.channels.index(_channel_number(channel))
+        z = 0
+        if plane is not None and self._z_keys is not None:
+            z = int(np.searchsorted(self._z_keys, plane))
+            if z >= len(self._z_keys) or self._z_keys[z] != plane:
+                raise KeyError(f"No plane {plane} in this VirtualStack")
+        return _MovieView(self, z, c)
+
+    def close(self):
+        self._cache.clear()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+
+class _MovieView:
+    '''
+    array-like (T, Y, X) over one channel / plane of a VirtualStack
+    '''
+    def __init__(self, stack, plane, c):
+        self.stack = stack
+        self.plane = plane
+        self.c = c
+        self.shape = (stack.shape[0],) + stack.frame_shape
+        self.dtype = stack.dtype
+        self.ndim = 3
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),)*(3 - len(key))
+        return self.stack[key[0], self.plane, self.c, key[1], key[2]]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[:]
+        return data.astype(dtype) if dtype is not None else data
@@ -19,17 +19,24 @@ import logging
 import xml.etree.ElementTree as ET 
 
 from src import helper_functions as hf
+from src import discovery
+from src import motion_qc
 #from plot_dFF import get_event_rate, get_variance
 
 #ADD ANIMAL ID, CAN MOST LIKELY USE THE PARENT DIR
-def extract_metadata(directory):
+def extract_metadata(directory, session=None):
+    '''
+    session: optional discovery.Session for directory, its classified file lists are
+    used for the batch_concat / motion correction checks instead of globbing again
+    '''
     # Check if 'SingleImage' is in the directory name
     if 'SingleImage' in directory:
         return None 
-    if hf.check_if_single_frame(directory):
+    #parse the xml once, every field below is read from the same SessionMetadata
+    meta = hf.get_session_metadata(directory)
+    if meta is not None and meta.is_single_frame:
         return None
-    xml = hf.get_xml_image(directory)
-    if xml is not None:
+    if meta is not None:
         match = re.search(r'(?i)_cell(\d+)_dend(\d+)_', directory)
         if match:
             cell_number = match.group(1)
@@ -44,20 +51,26 @@ def extract_metadata(directory):
         else:
             animal_id = None
         # Use your helper functions to extract data from the XML file
-        date = hf.get_imaging_date(directory)
-        seq_type = hf.report_sequence_type(directory) 
-        frame_period = hf.get_frame_period(directory) #time per frame
-        avg = hf.get_avg(directory) #num averages per scan
+        date = meta.date
+        seq_type = meta.seq_code
+        frame_period = meta.frame_period #time per frame
+        avg = meta.avg #num averages per scan
         sampling_rate = 1/(avg*frame_period) #units: Hz, number frames per second
-        duration = hf.get_imaging_session_duration(directory)
-        laser_power = hf.get_laser_power(directory)
-        pmt_gain = hf.get_pmt_gain(directory, "Ch 2 GaAsP")#make two calls if need ch1 and ch2
-        wavelength = hf.get_wavelength(directory)
-        objective = hf.get_objective(directory)
-        resolution = hf.get_resolution(directory)
-        microns = hf.get_microns_per_pixel(directory)
-        batch_concat = hf.check_batch_concat(directory)
-        double_motion_corrected = hf.check_double_motion_correct(directory)
+        duration = meta.duration
+        laser_power = meta.laser_power
+        pmt_gain = meta.pmt_gain("Ch 2 GaAsP")#make two calls if need ch1 and ch2
+        wavelength = meta.wavelength
+        objective = meta.objective
+        resolution = meta.resolution
+        microns = meta.microns_per_pixel
+        #motion qc written by the python motion correction (None if it has not run)
+        qc = motion_qc.read_qc_summary(directory) or {}
+        if session is not None:
+            batch_concat = session.batch_concat
+            double_motion_corrected = session.double_motion_corrected
+        else:
+            batch_concat = hf.check_batch_concat(directory)
+            double_motion_corrected = hf.check_double_motion_correct(directory)
         # Construct and return a dictionary of the extracted data
         #return date, seq_type, frame_period, avg, sampling_rate, duration, laser_power, pmt_gain, wavelength, double_motion_corrected,   # other metrics
         return {
@@ -77,7 +90,11 @@ def extract_metadata(directory):
             'resolution':resolution,
             'microns_per_pixel(u^2)': microns,
             'batch_concat':batch_concat,
-            '2x_motion_corrected':double_motion_corrected[2]
+            '2x_motion_corrected':double_motion_corrected[2],
+            'motion_qc_flags': qc.get('qc_flags'),
+            'motion_mean_corr': qc.get('mean_corr'),
+            'motion_max_shift': qc.get('max_shift'),
+            'crispness_gain': qc.get('crispness_gain')
             # Add other metrics here...
             }
     else:
@@ -86,16 +103,15 @@ def extract_metadata(directory):
 def summarize(input_dir):
     #add lines here or in helper function to filter out singleimage folders. 
     data = []
-    for root, dirs, files in os.walk(input_dir):
-        for dir in dirs:
-            directory = os.path.join(root, dir)
-            # Extract metadata using helper functions
-            metadata = extract_metadata(directory)
-            # Check if metadata is extracted, handle cases where it's not
-            if metadata:
-                # Add directory information
-                metadata['Directory'] = dir
-                data.append(metadata)
+    #one scandir pass over the tree, only folders with an imaging xml are summarized
+    for session in discovery.imaging_sessions(input_dir):
+        # Extract metadata using helper functions
+        metadata = extract_metadata(session.directory, session)
+        # Check if metadata is extracted, handle cases where it's not
+        if metadata:
+            # Add directory information
+            metadata['Directory'] = session.name
+            data.append(metadata)
     # Create a DataFrame from the collected data
     df = pd.DataFrame(data)
     #convert cell and dend to integers 
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Nov  1 10:12:44 2026
+
+@author: emmaodom
+
+sparse image check of src/registration.py: frames of gaussian blobs (spine like, on a
+dark background) moved by known whole pixel shifts are registered to the unmoved frame,
+and the wrong shift components are counted for a few whitening exponents. run from
+Preprocess_2P_data:
+    python test_scripts/check_registration_sparse.py
+registration.WHITENING should have 0 wrong components on every row.
+"""
+
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src import registration
+
+def blob_image(size, sigma, rng, density=1/800):
+    #sum of random gaussian blobs, about one blob per 1/density pixels
+    yy, xx = np.mgrid[:size, :size]
+    image = np.zeros((size, size))
+    for _ in range(int(size*size*density)):
+        cy, cx = rng.uniform(0, size, 2)
+        image += rng.uniform(0.5, 2) * np.exp(-((yy - cy)**2 + (xx - cx)**2) / (2*sigma**2))
+    return image*100 + 10
+
+def wrong_components(whitening, sigma, max_motion, noise, seed=0, n_frames=60, size=256, margin=30):
+    rng = np.random.default_rng(seed)
+    scene = blob_image(size + 2*margin, sigma, rng)
+    reference = scene[margin:margin + size, margin:margin + size]
+    motion = rng.integers(-max_motion, max_motion + 1, size=(n_frames, 2))
+    frames = np.stack([scene[margin - dy:margin - dy + size, margin - dx:margin - dx + size] for dy, dx in motion])
+    if noise:
+        frames = rng.poisson(frames)
+    roi = registration.central_roi(reference.shape)
+    window = registration._window(roi)
+    shifts = registration.phase_correlate_block(registration.block_spectra(frames.astype(np.float32), roi, window),
+                                                registration.spectrum(reference.astype(np.float32), roi, window),
+                                                registration.fft_shape(roi), whitening=whitening)
+    #the shift that moves a frame back onto the reference undoes its motion
+    return int((np.round(shifts) != -motion).sum()), motion.size
+
+if __name__ == '__main__':
+    exponents = sorted({1.0, registration.WHITENING, 0.0}, reverse=True)
+    print('sigma  motion  noise   ' + ' '.join(f"{'p=' + str(p):>7}" for p in exponents))
+    for sigma in (1.5, 3, 6):
+        for max_motion in (3, 12):
+            for noise in (False, True):
+                counts = [wrong_components(p, sigma, max_motion, noise) for p in exponents]
+                print(f"{sigma:<6} +-{max_motion:<5} {str(noise):<7} " + ' '.join(f"{c[0]:>3}/{c[1]:<3}" for c in counts))
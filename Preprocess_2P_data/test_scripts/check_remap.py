@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Nov  2 09:41:27 2026
+
+@author: emmaodom
+
+checks of registration.remap_block, the bilinear remap of the piecewise rigid correction:
+    - a zero displacement returns the block unchanged (last row and column included)
+    - a whole pixel shift matches registration.shift_frame (zero fill like Translate)
+    - a subpixel shift matches scipy.ndimage.map_coordinates (order=1) inside the frame
+run from Preprocess_2P_data:
+    python test_scripts/check_remap.py
+"""
+
+import os
+import sys
+import numpy as np
+from scipy import ndimage
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src import registration
+
+def check_identity(block):
+    zero = np.zeros(block.shape, dtype=np.float32)
+    out = registration.remap_block(block, zero, zero)
+    assert np.array_equal(out, block), f"identity remap changed the block, max error {np.abs(out - block).max()}"
+
+def check_integer_shift(block, dy, dx):
+    out = registration.remap_block(block, np.full(block.shape, dy, np.float32), np.full(block.shape, dx, np.float32))
+    expected = np.stack([registration.shift_frame(frame, dy, dx) for frame in block])
+    assert np.array_equal(out, expected), f"shift ({dy}, {dx}) differs from shift_frame, max error {np.abs(out - expected).max()}"
+
+def check_subpixel_shift(block, dy, dx):
+    out = registration.remap_block(block, np.full(block.shape, dy, np.float32), np.full(block.shape, dx, np.float32))
+    h, w = block.shape[1:]
+    yy, xx = np.mgrid[:h, :w]
+    coords = np.stack([yy - dy, xx - dx])
+    inside = (coords[0] >= 0) & (coords[0] <= h - 1) & (coords[1] >= 0) & (coords[1] <= w - 1)
+    for frame, result in zip(block, out):
+        expected = ndimage.map_coordinates(frame, coords, order=1)
+        assert np.allclose(result[inside], expected[inside], atol=1e-3), f"subpixel shift ({dy}, {dx}) differs"
+        assert not result[~inside].any(), f"subpixel shift ({dy}, {dx}) kept samples from outside the frame"
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    block = rng.uniform(0, 100, size=(3, 6, 7)).astype(np.float32)
+    check_identity(block)
+    for dy, dx in [(1, 0), (0, -2), (2, 3), (-1, -1)]:
+        check_integer_shift(block, dy, dx)
+    for dy, dx in [(0.5, 0), (-0.25, 1.75), (1.3, -0.6)]:
+        check_subpixel_shift(block, dy, dx)
+    print("remap_block checks passed")